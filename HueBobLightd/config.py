@@ -136,6 +136,34 @@ class BobHueConfig(ConfigParser):
         port = server.get('port', 19333)
         return port
 
+    @property
+    def server_mode(self):
+        """ Return the server mode, tcp or asyncio (default tcp) """
+        server = self.data.get('server', {})
+        mode = server.get('mode', 'tcp')
+        return mode
+
+    @property
+    def udp_port(self):
+        """ Return the UDP frame server port number, None if disabled """
+        server = self.data.get('server', {})
+        port = server.get('udpPort', None)
+        return port
+
+    @property
+    def metrics_port(self):
+        """ Return the metrics HTTP server port number, None if disabled """
+        server = self.data.get('server', {})
+        port = server.get('metricsPort', None)
+        return port
+
+    @property
+    def udp_priority(self):
+        """ Return the priority of UDP frame clients (default 128) """
+        server = self.data.get('server', {})
+        priority = server.get('udpPriority', 128)
+        return priority
+
     @property
     def bridge_address(self):
         """ Return the bridge address """
@@ -163,9 +191,10 @@ class BobHueConfig(ConfigParser):
         if self.data.get('bridges'):
             for bridge in self.data.get('bridges'):
                 if bridge.get('address'):
-                    address = bridge.get('address')
-                    if not validators.domain(address) \
-                            and not validators.ip_address.ipv4(address):
+                    # An optional port e.g. for the bridge simulator
+                    address, _, port = bridge.get('address').partition(':')
+                    if (port and not port.isdigit()) or (not validators.domain(address) \
+                            and not validators.ip_address.ipv4(address)):
                         self.logger.error('Incorrect bridge "address" parameter in conf file')
                         result = False
                 else:
@@ -179,6 +208,29 @@ class BobHueConfig(ConfigParser):
                     self.logger.error('Missing "username" parameter in conf file')
                     result = False
 
+                rate = bridge.get('rate', 10)
+                if not isinstance(rate, (int, float)) or rate <= 0:
+                    self.logger.error('"rate" parameter must be greater than 0 in bridge: %s',
+                                      bridge.get('address'))
+                    result = False
+                min_rate = bridge.get('minRate', 2)
+                max_rate = bridge.get('maxRate', 20)
+                if not isinstance(min_rate, (int, float)) or not isinstance(max_rate, (int, float)) \
+                        or not 0 < min_rate <= max_rate:
+                    self.logger.error('"minRate" and "maxRate" parameters must be greater '
+                                      'than 0 and minRate no more than maxRate in bridge: %s',
+                                      bridge.get('address'))
+                    result = False
+                burst = bridge.get('burst', 1)
+                if not isinstance(burst, int) or burst < 1:
+                    self.logger.error('"burst" parameter must be 1 or more in bridge: %s',
+                                      bridge.get('address'))
+                    result = False
+                if bridge.get('transport', 'requests') not in ('requests', 'pipelined'):
+                    self.logger.error('"transport" parameter must be "requests" or "pipelined" '
+                                      'in bridge: %s', bridge.get('address'))
+                    result = False
+
                 if bridge.get('lights'):
                     for light in bridge.get('lights'):
                         light_id = light.get('id')
@@ -260,6 +312,52 @@ class BobHueConfig(ConfigParser):
                         and not validators.ip_address.ipv4(address):
                     self.logger.error('Incorrect server "address" parameter in conf file')
                     result = False
+            if server.get('udpPort') is not None \
+                    and not isinstance(server.get('udpPort'), int):
+                self.logger.error('"udpPort" parameter not integer in "server"')
+                result = False
+            if server.get('metricsPort') is not None \
+                    and not isinstance(server.get('metricsPort'), int):
+                self.logger.error('"metricsPort" parameter not integer in "server"')
+                result = False
+            if server.get('udpPriority') is not None:
+                priority = server.get('udpPriority')
+                if not isinstance(priority, int) or priority > 255 or priority < 0:
+                    self.logger.error('"udpPriority" parameter must be between 0 & 255 in "server"')
+                    result = False
+            if server.get('mode'):
+                if server.get('mode') not in ('tcp', 'asyncio'):
+                    self.logger.error('"mode" parameter must be tcp or asyncio in "server"')
+                    result = False
+        if self.data.get('clientTimeout') is not None:
+            timeout = self.data.get('clientTimeout')
+            if not isinstance(timeout, (int, float)) or timeout <= 0:
+                self.logger.error('"clientTimeout" parameter must be more than 0. Using default: 5.')
+                self.data['clientTimeout'] = 5
+        if self.data.get('logInterval') is not None:
+            interval = self.data.get('logInterval')
+            if not isinstance(interval, (int, float)) or interval < 0:
+                self.logger.error('"logInterval" parameter must be 0 or more. Using default: 10.')
+                self.data['logInterval'] = 10
+        if self.data.get('colorThreshold') is not None:
+            threshold = self.data.get('colorThreshold')
+            if not isinstance(threshold, (int, float)) or threshold < 0:
+                self.logger.error('"colorThreshold" parameter must be 0 or more. Using default: 0.002.')
+                self.data['colorThreshold'] = 0.002
+        if self.data.get('brightnessThreshold') is not None:
+            threshold = self.data.get('brightnessThreshold')
+            if not isinstance(threshold, int) or threshold < 0:
+                self.logger.error('"brightnessThreshold" parameter must be 0 or more. Using default: 3.')
+                self.data['brightnessThreshold'] = 3
+        if self.data.get('smoothing') is not None:
+            smoothing = self.data.get('smoothing')
+            if not isinstance(smoothing, (int, float)) or smoothing < 0:
+                self.logger.error('"smoothing" parameter must be 0 or more. Using default: 0.')
+                self.data['smoothing'] = 0
+        if self.data.get('dynamicBrightness') is not None:
+            if not isinstance(self.data.get('dynamicBrightness'), bool):
+                self.logger.error('"dynamicBrightness" parameter must be true or false. Using default: false.')
+                self.data['dynamicBrightness'] = False
         if self.data.get('transitiontime'):
             t_time = self.data.get('transitiontime')
             if t_time > 10 or t_time < 1:
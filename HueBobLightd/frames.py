@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Frames
+This module contains the classes for combining the light colors sent by
+each connected client into the colors sent to the lights
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import logging
+from array import array
+from math import exp
+from time import time, monotonic
+
+# A light the client has not set a color for
+NAN = float('nan')
+
+# Doubles per slot in a frame: red, green, blue and the time received
+STRIDE = 4
+
+
+class FrameLayer():
+    """
+    The light colors sent by one client
+    The colors are kept in flat arrays of red, green, blue doubles indexed
+    by the light's slot in the LightRegistry, each followed by the monotonic
+    time the color was received for tracing its latency. The client writes
+    to the back array and publish() swaps it to the front, so the updater
+    always reads a whole frame without taking any locks. A light without a
+    color is NaN.
+    Attributes:
+        name: name of the client for log messages
+        priority: boblight priority from 0 to 255, the lowest number wins
+        front: the last frame published
+        back: the frame being written by the client
+        unused: slots of the lights the client has declared it does not use
+        updated: time the client last sent a frame
+        synced: monotonic time the last frame was published
+    """
+    def __init__(self, name, priority=128):
+        self.name = name
+        self.priority = priority
+        self.front = array('d')
+        self.back = array('d')
+        self.unused = set()
+        self.updated = 0.0
+        self.synced = 0.0
+
+    def __repr__(self):
+        return 'FrameLayer: name({}), priority({:d})'.format(self.name, self.priority)
+
+    def set_color(self, slot, red, green, blue, received=0.0):
+        """ Set the color of the light in a slot in the next frame """
+        back = self.back
+        index = slot * STRIDE
+        if index >= len(back):
+            back.extend([NAN] * (index + STRIDE - len(back)))
+        back[index] = red
+        back[index + 1] = green
+        back[index + 2] = blue
+        back[index + 3] = received
+
+    def color(self, slot):
+        """ Return the color of a slot in the last frame, None if not set """
+        front = self.front
+        index = slot * STRIDE
+        if index < len(front) and front[index] == front[index]:
+            return (front[index], front[index + 1], front[index + 2])
+        return None
+
+    def set_use(self, slot, use):
+        """ Declare whether the client uses a light """
+        if use:
+            self.unused.discard(slot)
+        else:
+            self.unused.add(slot)
+            index = slot * STRIDE
+            if index < len(self.back):
+                self.back[index] = self.back[index + 1] = self.back[index + 2] = NAN
+
+    def publish(self):
+        """
+        Make the frame written so far the frame the updater reads
+        The next frame starts as a copy so lights that are not sent again
+        keep their color
+        """
+        frame = self.back
+        self.back = frame[:]
+        self.front = frame
+        self.updated = time()
+        self.synced = monotonic()
+
+    def clear(self):
+        """ Forget the light colors e.g. when the lights are rebuilt """
+        self.back = array('d')
+        self.front = array('d')
+        self.unused.clear()
+
+    def is_active(self, now, timeout):
+        """ A layer is active while its client keeps sending frames """
+        return now - self.updated < timeout
+
+
+class ColorFilter():
+    """
+    Exponential smoothing of a light's color over time
+    Flicker from the grabber is smoothed out so fewer distinct colors are
+    sent to the bridge, while a change bigger than jump e.g. a scene cut
+    goes straight through.
+    Attributes:
+        time_constant: seconds to move 63% of the way to a new color, 0 is off
+        jump: a change of any of red, green or blue bigger than this is not
+            smoothed
+        default_time_constant: used when a client turns on interpolation for
+            a light that has no smoothing configured
+        rgb: the smoothed color
+        target: the color the filter is moving towards
+    """
+    jump = 0.25
+    default_time_constant = 0.5
+
+    def __init__(self, time_constant=0.0):
+        self.time_constant = time_constant
+        self.rgb = None
+        self.target = None
+        self.stamp = monotonic()
+        self.single_change = False
+
+    def __repr__(self):
+        return 'ColorFilter: time_constant({:.2f})'.format(self.time_constant)
+
+    def set_interpolation(self, interpolate, time_constant=0.0):
+        """ Turn smoothing on, with time_constant or the default, or off """
+        if interpolate:
+            self.time_constant = time_constant or self.default_time_constant
+        else:
+            self.time_constant = 0.0
+
+    def settled(self):
+        """ Return True once the smoothed color has reached the target """
+        return self.rgb == self.target
+
+    def step(self, target):
+        """ Move the smoothed color towards the target and return it """
+        now = monotonic()
+        elapsed = now - self.stamp
+        self.stamp = now
+        self.target = target
+        rgb = self.rgb
+        if not self.time_constant or rgb is None or self.single_change:
+            self.single_change = False
+            self.rgb = target
+            return target
+        if rgb == target:
+            return rgb
+        deltas = [new - old for new, old in zip(target, rgb)]
+        biggest = max(abs(delta) for delta in deltas)
+        alpha = 1 - exp(-elapsed / self.time_constant)
+        if biggest > self.jump or biggest * (1 - alpha) < 0.002:
+            # Jump to big changes, and finish once the difference left
+            # is too small to matter
+            self.rgb = target
+        else:
+            self.rgb = tuple(old + alpha * delta for old, delta in zip(rgb, deltas))
+        return self.rgb
+
+
+class FrameCompositor():
+    """
+    Combines the frame layers of all the connected clients
+    For each light the highest priority active layer that has a color for
+    the light wins. When that client goes quiet or disconnects the next
+    layer takes over.
+    The list of layers is replaced, never modified, so the updater can
+    composite while clients connect and disconnect.
+    """
+    logger = None
+
+    def __init__(self, timeout=5.0):
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.layers = list()
+        self.owners = dict()
+        self.timeout = timeout
+
+    def add_layer(self, layer):
+        """ Add a client's layer """
+        self.layers = self.layers + [layer]
+        self.logger.debug('Added %r', layer)
+
+    def remove_layer(self, layer):
+        """ Remove a client's layer, its lights go to the next layer """
+        self.layers = [lyr for lyr in self.layers if lyr is not layer]
+        self.logger.debug('Removed %r', layer)
+
+    def _ranked_layers(self, now):
+        """ Return the active layers, highest priority first """
+        active = [lyr for lyr in self.layers if lyr.is_active(now, self.timeout)]
+        # Same priority goes to the client with the latest frame
+        active.sort(key=lambda lyr: (lyr.priority, -lyr.updated))
+        return active
+
+    def composite(self, lights, slots):
+        """
+        Set each light to the color of the layer that wins it
+        slots maps each light to its slot in the layers
+        Lights that no active layer has a color for keep their color
+        A light given a new color is also given the times its color was
+        received and synced, for tracing the latency of the frame
+        The layers are ranked and their published frames taken once, so all
+        the lights come from the same frame of each client
+        Each bridge worker composites its own lights, so only the owners of
+        the given lights are changed
+        """
+        ranked = [(layer, layer.front, layer.synced) for layer in self._ranked_layers(time())]
+        owners = self.owners
+        for light in lights:
+            slot = slots.get(light)
+            if slot is None:
+                continue  # The light has just been removed
+            index = slot * STRIDE
+            owner = None
+            for layer, front, synced in ranked:
+                # NaN is the only value not equal to itself
+                if index < len(front) and front[index] == front[index]:
+                    owner = layer
+                    rgb = (front[index], front[index + 1], front[index + 2])
+                    if light.rgb != rgb:
+                        light.set_color(*rgb)
+                        light.received = front[index + 3]
+                        light.synced = synced
+                    break
+            if owner is None:
+                owners.pop(light, None)
+            else:
+                owners[light] = owner
+
+    def usage(self, layer, slots):
+        """
+        Return the number of lights the layer is using
+        That is the lights it uses that are not owned by a higher
+        priority layer
+        """
+        count = 0
+        for light, slot in slots.items():
+            if slot in layer.unused:
+                continue
+            owner = self.owners.get(light)
+            if owner is None or owner is layer or owner.priority > layer.priority:
+                count += 1
+        return count
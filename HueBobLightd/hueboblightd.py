@@ -14,12 +14,17 @@ import platform
 import signal
 import socket
 from threading import Thread, Event
-from HueBobLightd.logger import init_logger
+from HueBobLightd.logger import init_logger, LogSampler
 from HueBobLightd.config import BobHueConfig
-from HueBobLightd.server import BobHueServer
+from HueBobLightd.server import BobHueServer, BobHueAsyncServer
 from HueBobLightd.server import BobHueRequestHandler
+from HueBobLightd.udpserver import BobHueUdpServer
+from HueBobLightd.recorder import SessionRecorder
+from HueBobLightd.metrics import MetricsServer
+from HueBobLightd.profiler import SamplingProfiler
 from HueBobLightd.lightupdate import LightsUpdater
-from HueBobLightd.huelights import HueLight, BridgeAddress
+from HueBobLightd.huelights import HueLight, BridgeAddress, close_sessions
+from HueBobLightd.transport import close_transport
 from pkg_resources import get_distribution
 from pkg_resources import DistributionNotFound, RequirementParseError
 
@@ -45,8 +50,13 @@ class BoblightDaemon():
         self.signal = None
         self.server_thread = None
         self.updater_thread = None
+        self.udp_thread = None
+        self.metrics_thread = None
         self.server = server
+        self.udp_server = None
+        self.metrics_server = None
         self.updater = updater
+        self.profiler = None
         self.lights = list()
 
     def __enter__(self):
@@ -56,6 +66,7 @@ class BoblightDaemon():
         if platform.system().lower() != 'windows':
             self.handlers['SIGHUP'] = signal.signal(signal.SIGHUP, self.signal_handler)
             self.handlers['SIGUSR1'] = signal.signal(signal.SIGUSR1, self.signal_handler)
+            self.handlers['SIGUSR2'] = signal.signal(signal.SIGUSR2, self.signal_handler)
         return self
 
     def __exit__(self, extype, exvalue, extraceback):
@@ -64,7 +75,11 @@ class BoblightDaemon():
         signal.signal(signal.SIGTERM, self.handlers['SIGTERM'])
         if platform.system().lower() != 'windows':
             signal.signal(signal.SIGHUP, self.handlers['SIGHUP'])
-            signal.signal(signal.SIGHUP, self.handlers['SIGUSR1'])
+            signal.signal(signal.SIGUSR1, self.handlers['SIGUSR1'])
+            signal.signal(signal.SIGUSR2, self.handlers['SIGUSR2'])
+        # Keep the stats of a profile left running
+        if self.profiler:
+            self.profiler.stop()
 
     def signal_handler(self, signum, frame):
         """ Save the signal for the wait method """
@@ -75,12 +90,19 @@ class BoblightDaemon():
             """
             If we get a SIGUSR1 signal then switch the log level
             in/out of DEBUG mode
+            The hot path checks the level for every block of requests and
+            every update so the change takes effect immediately
             """
             # self.logger.info('Log level was: %r', self.logger.getEffectiveLevel())
             if self.logger.getEffectiveLevel() == logging.DEBUG:
                 logging.getLogger().setLevel(logging.INFO)
             else:
                 logging.getLogger().setLevel(logging.DEBUG)
+        elif signum == signal.SIGUSR2:
+            # Start or stop profiling the server and updater threads,
+            # the stats are written to the log directory when stopped
+            if self.profiler:
+                self.profiler.toggle()
         else:
             self.event.set()
 
@@ -88,9 +110,19 @@ class BoblightDaemon():
         """ Create a list of lights from the configuration file data """
         # Retrieve the light tranition time
         transition = config.get_parameter('transitionTime', 3)
+        # Retrieve the color smoothing time
+        smoothing = config.get_parameter('smoothing', 0)
+        # Retrieve the smallest color and brightness changes worth sending
+        threshold = config.get_parameter('colorThreshold', 0.002)
+        bri_threshold = config.get_parameter('brightnessThreshold', 3)
+        # Retrieve whether the brightness follows the colors
+        dynamic_brightness = config.get_parameter('dynamicBrightness', False)
         # Create lights for all bridges
         for bridge in config.get_parameter('bridges'):
             bridge_addr = BridgeAddress(bridge['address'], bridge['username'])
+            # Requests per second and burst allowed by the bridge
+            self.updater.set_rate(bridge_addr, bridge.get('rate', 10), bridge.get('burst', 1),
+                                  bridge.get('minRate', 2), bridge.get('maxRate', 20))
             # Create a list of lights on the bridge
             for light in bridge.get('lights'):
                 new_light = {
@@ -98,6 +130,7 @@ class BoblightDaemon():
                     'name' : light['name'],
                     'hue_id' : light['id'],
                     'brightness' : light.get('brightness', 150),
+                    'dynamic_brightness' : light.get('dynamicBrightness', dynamic_brightness),
                     'gamut' : light.get('gamut', ''),
                     'scanarea' : (
                         light['vscan']['top'],
@@ -105,7 +138,11 @@ class BoblightDaemon():
                         light['hscan']['left'],
                         light['hscan']['right']
                     ),
-                    'transition' : light.get('transitionTime', transition)
+                    'transition' : light.get('transitionTime', transition),
+                    'smoothing' : light.get('smoothing', smoothing),
+                    'threshold' : threshold,
+                    'bri_threshold' : bri_threshold,
+                    'transport' : bridge.get('transport', 'requests')
                 }
                 self.lights.append(new_light)
 
@@ -126,7 +163,52 @@ class BoblightDaemon():
         self.server_thread.join()
         self.server_thread = None
         self.logger.debug('Closing Server socket')
-        self.server.socket.close()
+        self.server.server_close()
+
+    def start_udp_server(self, udp_addr, priority):
+        """ Create and start the UDP frame server thread """
+        if self.udp_server is None:
+            self.logger.info('Starting UDP Server thread %r', udp_addr)
+            self.udp_server = BobHueUdpServer(udp_addr, priority)
+            self.udp_server.data = self.updater
+            self.udp_thread = Thread(target=self.udp_server.serve_forever)
+            self.udp_thread.setDaemon(True)  # don't hang on exit
+            self.udp_thread.start()
+        else:
+            self.logger.debug('UDP Server thread already running')
+
+    def stop_udp_server(self):
+        """ Stop the UDP frame server thread, if running, and wait for it to exit """
+        if self.udp_server is not None:
+            self.logger.info('Stopping UDP Server thread')
+            self.udp_server.shutdown()
+            self.udp_thread.join()
+            self.udp_thread = None
+            self.udp_server.server_close()
+            self.udp_server = None
+
+    def start_metrics_server(self, metrics_addr):
+        """ Create and start the metrics HTTP server thread """
+        if self.metrics_server is None:
+            self.logger.info('Starting Metrics Server thread %r', metrics_addr)
+            self.metrics_server = MetricsServer(metrics_addr)
+            self.metrics_server.data = self.updater
+            self.metrics_thread = Thread(target=self.metrics_server.serve_forever)
+            self.metrics_thread.setDaemon(True)  # don't hang on exit
+            self.metrics_thread.start()
+        else:
+            self.logger.debug('Metrics Server thread already running')
+        self.metrics_server.udp_server = self.udp_server
+
+    def stop_metrics_server(self):
+        """ Stop the metrics server thread, if running, and wait for it to exit """
+        if self.metrics_server is not None:
+            self.logger.info('Stopping Metrics Server thread')
+            self.metrics_server.shutdown()
+            self.metrics_thread.join()
+            self.metrics_thread = None
+            self.metrics_server.server_close()
+            self.metrics_server = None
 
     def start_updater(self):
         """ Create and start the updater thread """
@@ -155,6 +237,12 @@ class BoblightDaemon():
         # Returns true if the signal was a SIGHUP
         return sig == signal.SIGHUP
 
+def create_server(socket_addr, mode):
+    """ Create the boblight server for the requested mode """
+    if mode == 'asyncio':
+        return BobHueAsyncServer(socket_addr)
+    return BobHueServer(socket_addr, BobHueRequestHandler)
+
 #pylint: disable=R0912
 def main():
     """
@@ -168,6 +256,11 @@ def main():
                         help='location of log files')
     parser.add_argument('--server', type=str, default=None,
                         help='IPv4 socket_addr of boblightd server')
+    parser.add_argument('--mode', type=str, default=None,
+                        choices=('tcp', 'asyncio'),
+                        help='server mode, overrides the configuration file')
+    parser.add_argument('--record', type=str, default=None,
+                        help='record the client sessions to this file for replaying')
     parser.add_argument('--debug', default=False,
                         action='store_true',
                         help='turn on debug logging information')
@@ -205,13 +298,22 @@ def main():
         socket_addr = (socket.gethostname(), conf.server_port)  # let the kernel assign a port
     # TODO: Figure out how to correctly get the hostname on iMac and Synology
     logger.info('gethostname() = %r', socket_addr)
-    server = BobHueServer(socket_addr, BobHueRequestHandler)
+    server_mode = args.mode or conf.server_mode
+    logger.info('Server mode: %s', server_mode)
+    server = create_server(socket_addr, server_mode)
+    recorder = SessionRecorder(args.record) if args.record else None
 
     with BoblightDaemon(server, updater) as bld:
+        bld.profiler = SamplingProfiler(os.path.dirname(logfile))
         try:
             while True:
                 # Retrieve the auto off value and turn into seconds
                 updater.auto_off_delay = conf.get_parameter('autoOff', False) * 60
+                # Seconds without a frame before a client's lights go to
+                # a lower priority client
+                updater.frames.timeout = conf.get_parameter('clientTimeout', 5)
+                # Seconds between the debug messages logged for every frame
+                LogSampler.interval = conf.get_parameter('logInterval', 10)
                 # Create lights for all bridges
                 bld.lights.clear()
                 bld.create_lights(conf)
@@ -226,6 +328,7 @@ def main():
 
                 # Store the update object as data in the server for the requesthandler
                 bld.server.data = bld.updater
+                bld.server.recorder = recorder
                 # Start the updater thread
                 logger.info('Starting lights update thread:')
                 bld.start_updater()
@@ -233,23 +336,41 @@ def main():
                 logger.info('Starting server update thread: %r',
                             socket_addr)
                 bld.start_server()
+                # (Re)start the UDP frame server if its address has changed
+                udp_addr = (socket_addr[0], conf.udp_port) if conf.udp_port else None
+                if bld.udp_server and bld.udp_server.server_address[1] != conf.udp_port:
+                    bld.stop_udp_server()
+                if udp_addr:
+                    bld.start_udp_server(udp_addr, conf.udp_priority)
+                    bld.udp_server.priority = conf.udp_priority
+                # (Re)start the metrics server if its address has changed
+                if bld.metrics_server and bld.metrics_server.server_address[1] != conf.metrics_port:
+                    bld.stop_metrics_server()
+                if conf.metrics_port:
+                    bld.start_metrics_server((socket_addr[0], conf.metrics_port))
 
                 # Wait until a signal occurs
                 if bld.wait():
                     # If true then we need to restart
+                    new_socket_addr = socket_addr
                     if args.server is None and conf.server_address:
                         new_socket_addr = (conf.server_address, conf.server_port)
-                        if new_socket_addr != socket_addr:
-                            # Only restart the server if it's socket_addr has changed
-                            bld.stop_server()
-                            del server
-                            socket_addr = new_socket_addr
-                            server = BobHueServer(socket_addr, BobHueRequestHandler)
+                    new_server_mode = args.mode or conf.server_mode
+                    if new_socket_addr != socket_addr or new_server_mode != server_mode:
+                        # Only restart the server if it's socket_addr or mode has changed
+                        bld.stop_server()
+                        del server
+                        socket_addr = new_socket_addr
+                        server_mode = new_server_mode
+                        server = create_server(socket_addr, server_mode)
+                        bld.server = server
                     # Shutdown the updater before we rebuild the lights
                     bld.stop_updater()
                 else:
                     # If false we need to exit
                     bld.stop_server()
+                    bld.stop_udp_server()
+                    bld.stop_metrics_server()
                     bld.stop_updater()
                     break
 
@@ -263,6 +384,11 @@ def main():
         except:
             logger.exception('Something bad happened :-(')
 
+    close_sessions()
+    close_transport()
+    if recorder:
+        recorder.close()
+
     logger.info('Exiting...')
 
     return
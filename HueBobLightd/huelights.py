@@ -10,12 +10,21 @@ Also includes a class for updating the lights via requests
 __author__ = "David Dix"
 __copyright__ = "Copyright 2017, David Dix"
 
-from collections import namedtuple
-from logging import getLogger
+import json
+import concurrent.futures
+from collections import namedtuple, Counter
+from logging import getLogger, DEBUG
 from threading import Lock
-from urllib.request import urlopen, URLError
+from time import monotonic
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from HueBobLightd.colorconvert import Converter, GamutA, GamutB, GamutC
+from HueBobLightd.logger import LogSampler
+from HueBobLightd.frames import ColorFilter
+from HueBobLightd.metrics import Histogram, TRACE_BUCKETS, TRACE_SPANS
+from HueBobLightd.transport import TransportError, TransportTimeout, StaleRequest
+from HueBobLightd.transport import shared_transport
 
 
 """
@@ -34,37 +43,230 @@ light than to ensure all lights are in sync with "old" values.
 
 BridgeAddress = namedtuple('BridgeAddress', 'address, username')
 
+# Transition time the bridge uses when a request does not include one
+DEFAULT_TRANSITION = 4
+
+# Hue error types that mean the bridge is too busy to handle the request
+# 901: Internal error, returned when the bridge is overloaded
+BUSY_ERRORS = (901,)
+
+# Headers sent with every state PUT, the body is always JSON
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Byte templates of the state fields, see encode_state
+XY_TEMPLATE = b'"xy":[%.4f,%.4f]'
+INT_TEMPLATES = {
+    'bri' : b'"bri":%d',
+    'transitiontime' : b'"transitiontime":%d'
+}
+
+# Keep-alive connections kept open to each bridge, see bridge_session
+SESSION_POOL_SIZE = 2
+
+_sessions = dict()
+_sessions_lock = Lock()
+
+
+def bridge_session(bridge):
+    """
+    Return the HTTP session shared by all the lights on a bridge
+    The session keeps up to SESSION_POOL_SIZE connections to the bridge
+    alive between requests, as setting up a connection is a good part of
+    each request and the bridge copes badly with the churn. The pool is
+    bounded, a request that finds all the connections in use waits for
+    one rather than opening an extra one to throw away. A request that
+    cannot connect is tried once more on a new connection. The sessions
+    outlive the lights so they are kept when the lights are rebuilt.
+    The bridge is on the local network so the proxy and netrc settings
+    of the environment are not looked up for every request.
+    """
+    session = _sessions.get(bridge)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(bridge)
+            if session is None:
+                session = requests.Session()
+                session.trust_env = False
+                retries = Retry(total=1, connect=1, read=0, status=0, redirect=0)
+                session.mount('http://', HTTPAdapter(pool_connections=1,
+                                                     pool_maxsize=SESSION_POOL_SIZE,
+                                                     pool_block=True,
+                                                     max_retries=retries))
+                _sessions[bridge] = session
+    return session
+
+
+def close_sessions():
+    """ Close the connections to all the bridges """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def encode_state(state):
+    """
+    Return a light state as the bytes of a JSON body
+    The fields the daemon sends are rendered straight from byte templates,
+    xy with the 4 decimals the bridge uses. A state with any other field
+    falls back to the json module.
+    """
+    parts = list()
+    for key, value in state.items():
+        if key == 'xy':
+            parts.append(XY_TEMPLATE % (value[0], value[1]))
+        elif key == 'on':
+            parts.append(b'"on":true' if value else b'"on":false')
+        elif key in INT_TEMPLATES:
+            parts.append(INT_TEMPLATES[key] % value)
+        else:
+            return json.dumps(state).encode()
+    return b'{' + b','.join(parts) + b'}'
+
+
+def classify_errors(response):
+    """
+    Return the error class of a decoded bridge response, None for success
+    The bridge answers with a 200 and a list of results, each either a
+    success or an error e.g. [{"error": {"type": 901, ...}}]
+        busy: the bridge is overloaded, the request should be sent again
+        rejected: the request was refused e.g. the light is off
+    """
+    if not isinstance(response, list):
+        return None
+    result = None
+    for item in response:
+        error = item.get('error') if isinstance(item, dict) else None
+        if error is not None:
+            if error.get('type') in BUSY_ERRORS:
+                return 'busy'
+            result = 'rejected'
+    return result
+
+
+def xy_to_uv(xy):
+    """
+    Convert a CIE 1931 xy point to CIE 1976 u'v'
+    Distances in u'v' are much closer to how different colors look than in xy
+    """
+    x, y = xy
+    denominator = -2 * x + 12 * y + 3
+    return (4 * x / denominator, 9 * y / denominator)
+
+
+def luminance(rgb):
+    """ Return the relative luminance of a float rgb color """
+    if rgb is None:
+        return 0.0
+    red, green, blue = rgb
+    return 0.2126 * red + 0.7152 * green + 0.0722 * blue
+
+
+class PendingUpdate():
+    """
+    An update to a light started by HueLight.start_update
+    Attributes:
+        started: monotonic time the update started
+        state: the light state of the update
+        changes: the fields of state sent to the bridge
+        rgb: the color converted to the state's xy
+        future: the transport's Future for the answer until it is handled
+        result: the result of the request once answered
+    """
+    #pylint: disable=R0903
+    def __init__(self, started, state, changes, rgb):
+        self.started = started
+        self.state = state
+        self.changes = changes
+        self.rgb = rgb
+        self.future = None
+        self.result = None
+
+    def done(self):
+        """ True once the bridge has answered """
+        return self.future is None or self.future.done()
+
 #pylint: disable=R0902
 class HueLight():
     """
     HueLight class
     Attributes:
-        lock: lock for accessing rgb member
+        bridge: BridgeAddress of the bridge the light is on
         url: url of light (bridge, username portion) NEEDS TO BE in request class
+        light_url, state_url: the light's urls, formatted once
+        session: the requests session shared by the lights on the bridge
+        transport: the PipelinedTransport used instead of the session when
+            the bridge's transport is pipelined, otherwise None
         hue_id: Hue id of light
         name: name of light
         brightness: Initial brightness of light
         scanarea: (top, bottom, left, right)
         converter: Colour Converter object
         rgb: float tuple(red, green, blue) of new color
+        rgb_converted: the rgb last converted to xy_new
+        smoothing: configured seconds for the color filter, 0 is off
+        filter: smooths rgb before it is converted
         xy_new: int tuple(hue, sat, bri) new color
         xy_previous: int tuple(hue, sat, bri) last color
+        dynamic_brightness: brightness follows the luminance of the color,
+            up to brightness, rather than staying at brightness
+        bri_new: new brightness
+        bri_previous: last brightness sent
+        acked: the state fields the bridge last acknowledged, only the
+            fields that differ from these are sent
         in_use: on / off
+        stats: counts of colors set, puts sent, puts failed, changes
+            suppressed and errors by class
+        latency: seconds taken by the last request to the bridge
+        error: error class of the last request, None if it succeeded
+        received: monotonic time the client sent the color, set with synced
+            by the FrameCompositor
+        synced: monotonic time the client synced the frame with the color
+        trace: histograms of the time from the client to the bridge for
+            each color acknowledged, split into the spans
+                sync: received until the client's sync
+                queue: sync until the update started
+                conversion: update start until the request was sent
+                http: request sent until the bridge answered
+                total: received until the bridge answered
+        log_sampler: rate limits the debug messages logged per update
+        threshold: smallest u'v' color change that is sent to the bridge
+        bri_threshold: smallest brightness change that is sent to the bridge
     """
     logger = None
 
     def __init__(self, **kwargs):
         if type(self).logger is None:
             type(self).logger = getLogger(type(self).__name__)
-        self.lock = Lock()
         self.in_use = False
         self.is_on = False
         self.rgb = (0.0, 0.0, 0.0)
+        self.rgb_converted = None
+        self.rgb_sent = None
+        self.pending = False
+        self.latency = 0.0
+        self.error = None
+        self.sent_time = monotonic()
+        self.received = 0.0
+        self.synced = 0.0
+        self.traced = 0.0
+        self.put_start = 0.0
+        self.put_done = 0.0
+        self.put_debug = False
+        self.trace = {span: Histogram(TRACE_BUCKETS) for span in TRACE_SPANS}
         self.xy_new = (0, 0)
         self.xy_previous = (0, 0)
+        self.acked = dict()
+        self.stats = Counter()
+        self.log_sampler = LogSampler()
         bridge = kwargs.get('address')
         if bridge is None:
             raise ValueError('Light address has no value')
+        self.bridge = bridge
+        self.session = bridge_session(bridge)
+        self.transport = None
+        if kwargs.get('transport') == 'pipelined':
+            self.transport = shared_transport()
         self.url = 'http://{}/api/{}'.format(bridge.address, bridge.username)
         self.name = kwargs.get('name')
         if self.name is None:
@@ -72,10 +274,23 @@ class HueLight():
         self.hue_id = kwargs.get('hue_id')
         if self.hue_id is None:
             raise ValueError('Light id has no value')
+        self.light_url = '{}/lights/{}'.format(self.url, self.hue_id)
+        self.state_url = self.light_url + '/state'
+        # The paths of the urls for the pipelined transport
+        self.api_path = '/api/{}'.format(bridge.username).encode()
+        self.light_path = '{}/lights/{}'.format(self.api_path.decode(), self.hue_id).encode()
+        self.state_path = self.light_path + b'/state'
         self.brightness = kwargs.get('brightness', 150)
+        self.dynamic_brightness = kwargs.get('dynamic_brightness', False)
+        self.bri_new = self.brightness
+        self.bri_previous = self.brightness
         self.converter = Converter(self._get_gamut(kwargs.get('gamut', 'GamutC')))
         self.scanarea = kwargs.get('scanarea', (0, 100, 0, 100))
         self.transition = kwargs.get('transition', 3)
+        self.smoothing = kwargs.get('smoothing', 0.0)
+        self.filter = ColorFilter(self.smoothing)
+        self.threshold = kwargs.get('threshold', 0.002)
+        self.bri_threshold = kwargs.get('bri_threshold', 3)
         self.logger.debug('Light: %r', self)
         # self.logger.debug('Light: name(%s) initialised: bridge(%r) id(%s) area%r, gamut(%s)',
         #                   self.name, address[0], self.hue_id,
@@ -107,27 +322,110 @@ class HueLight():
         Send a PUT request to the specified light
         I use a short timeout on the request because if the bridge is too
         busy to handle it in that time the state would have changed anyway
+        The latency and error class of the request are kept for the bridge
+        worker to adjust its rate. A busy bridge counts as a failure so the
+        color is sent again. A rejected request is counted but not failed,
+        sending the same state again would only be rejected again.
+        The body is rendered by encode_state and the response is only
+        decoded when it holds an error. A request the pipelined transport
+        dropped because it could not be sent in time is a stale failure.
+        """
+        return self._finish_put(self._start_put(state, timeout), timeout)
+
+    def _start_put(self, state, timeout=1):
+        """
+        Start a PUT request to the light and return a Future of
+        (status, content, answered) for _finish_put
+        The pipelined transport only queues the request, over the session
+        the bridge has answered before this returns
+        """
+        self.put_debug = self.logger.isEnabledFor(DEBUG) and self.log_sampler.sample('put')
+        if self.put_debug:
+            self.logger.debug('PUT: %s : %r (%d skipped)', self.state_url, state,
+                              self.log_sampler.skipped('put'))
+        self.stats['puts'] += 1
+        self.put_start = monotonic()
+        body = encode_state(state)
+        if self.transport is not None:
+            return self.transport.submit(self.bridge.address, b'PUT', self.state_path,
+                                         body, timeout)
+        future = concurrent.futures.Future()
+        try:
+            resp = self.session.request('PUT', self.state_url, data=body,
+                                        headers=JSON_HEADERS, timeout=timeout)
+            future.set_result((resp.status_code, resp.content, monotonic()))
+        except requests.exceptions.RequestException as exc:
+            future.set_exception(exc)
+        return future
+
+    def _finish_put(self, future, timeout=1):
+        """
+        Wait for the answer to a PUT started by _start_put and return True
+        if it succeeded, see _put
         """
         result = True
-        url = '{}/lights/{}/state'.format(self.url, self.hue_id)
-        self.logger.debug('PUT: %s : %r', url, state)
+        url = self.state_url
+        debug = self.put_debug
+        error = None
+        end = None
         try:
-            resp = requests.put(url=url, json=state, timeout=timeout)
-            #pylint: disable=W0613
-            if resp.ok:
-                self.logger.debug('Response: %s', resp.json())
+            # The transport keeps the deadline, this is a backstop
+            status, content, end = future.result(timeout + 1)
+            if status < 400:
+                # Only decode the response when it holds an error
+                if b'"error"' in content:
+                    error = classify_errors(json.loads(content.decode()))
+                if debug:
+                    self.logger.debug('Response: %s', content.decode())
+                if error == 'rejected' and self.log_sampler.sample('rejected'):
+                    self.logger.info('Light(%s:%s) request rejected: %s (%d skipped)',
+                                     self.name, self.hue_id, content.decode(),
+                                     self.log_sampler.skipped('rejected'))
             else:
-                self.logger.debug('Response Error: %s', resp.text)
-                result = False
-        except requests.exceptions.Timeout:
+                self.logger.debug('Response Error: %s', content.decode())
+                error = 'http'
+        except StaleRequest:
+            self.logger.debug('Stale request dropped for url: %s', url)
+            error = 'stale'
+        except (requests.exceptions.Timeout, TransportTimeout, concurrent.futures.TimeoutError):
             self.logger.info('Timeout error for url: %s', url)
-            result = False
-        except requests.exceptions.ConnectionError:
+            error = 'timeout'
+            future.cancel()
+        except (requests.exceptions.ConnectionError, TransportError):
             self.logger.info('ConnectionError error for url: %s', url)
-            result = False
+            error = 'connection'
+            self.reconnect()
+        if end is None:
+            end = monotonic()
+        self.latency = end - self.put_start
+        self.put_done = end
+        self.error = error
 
+        if error is not None:
+            self.stats[error] += 1
+            result = error == 'rejected'
+        if not result:
+            self.stats['failed'] += 1
         return result
 
+    def _trace(self, started):
+        """
+        Add the spans of the color just acknowledged to the trace
+        histograms, started is when the update began
+        Each frame is only traced the first time one of its colors is
+        acknowledged, later steps of the color filter are not
+        """
+        received = self.received
+        if not received or received == self.traced:
+            return
+        self.traced = received
+        trace = self.trace
+        trace['sync'].observe(max(0.0, self.synced - received))
+        trace['queue'].observe(max(0.0, started - self.synced))
+        trace['conversion'].observe(self.put_start - started)
+        trace['http'].observe(self.put_done - self.put_start)
+        trace['total'].observe(self.put_done - received)
+
     def _attributes(self, timeout=1):
         """
         Send a GET Attributes request to the bridge for the specified light
@@ -136,49 +434,118 @@ class HueLight():
         self.logger.debug('Get light (%s:%s) attributes',
                           self.name, self.hue_id)
         result = None
-        url = '{}/lights/{}'.format(self.url, self.hue_id)
+        url = self.light_url
         self.logger.debug('GET: %s', url)
         try:
-            resp = requests.get(url=url, timeout=timeout)
-            if resp.ok:
-                result = resp.json()
+            ok, content = self._request('GET', url, self.light_path, timeout=timeout)
+            if ok:
+                result = json.loads(content.decode())
                 self.logger.debug('Response: %s', result)
             else:
-                self.logger.debug('Response Error: %s', resp.text)
-        except requests.exceptions.Timeout:
+                self.logger.debug('Response Error: %s', content.decode())
+        except (requests.exceptions.Timeout, TransportTimeout):
             self.logger.info('Timeout error for url: %s', url)
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, TransportError):
             self.logger.info('ConnectionError error for url: %s', url)
+            self.reconnect()
 
         return result
 
+    def _request(self, method, url, path, body=None, timeout=1):
+        """
+        Send a request to the bridge and return (ok, content)
+        The request goes over the pipelined transport, using path, if the
+        light has one, otherwise over the bridge's session using url
+        Raises the requests or transport exception if it fails
+        """
+        #pylint: disable=R0913
+        if self.transport is not None:
+            status, content = self.transport.request(self.bridge.address, method.encode(), path,
+                                                     body or b'', timeout)
+            return status < 400, content
+        if body is None:
+            resp = self.session.request(method, url, timeout=timeout)
+        else:
+            resp = self.session.request(method, url, data=body, headers=JSON_HEADERS,
+                                        timeout=timeout)
+        return resp.ok, resp.content
+
     def connect(self):
         """ Attempt to connect to the bridge and return true if successful """
         self.logger.info('Connect: %s', self.url)
         try:
-            urlopen(self.url, timeout=1)
-            return True
-        except URLError:
+            return self._request('GET', self.url, self.api_path)[0]
+        except (requests.exceptions.RequestException, TransportError):
+            self.reconnect()
             return False
 
+    def reconnect(self):
+        """
+        Drop the bridge's kept connections after a connection error so the
+        next request starts a new one rather than reusing a broken one
+        The pipelined transport closes its failed connections itself
+        """
+        if self.transport is None:
+            self.session.close()
+
     def validate(self):
-        """ Verify with the bridge that this light exists """
-        self.in_use = 'state' in self._attributes()
+        """
+        Verify with the bridge that this light exists
+        The light's current state is the starting point for the acked state
+        The bridge answers a light it does not have with a list of errors
+        """
+        attributes = self._attributes()
+        state = attributes.get('state') if isinstance(attributes, dict) else None
+        self.in_use = state is not None
+        if self.in_use:
+            self.acked = {key: state[key] for key in ('on', 'bri') if key in state}
+            if 'xy' in state:
+                self.acked['xy'] = tuple(state['xy'])
         return self.in_use
 
+    def _changes(self, state):
+        """ Return the fields of state that differ from the acked state """
+        acked = self.acked
+        return {key: value for key, value in state.items() if acked.get(key) != value}
+
+    @staticmethod
+    def _payload(changes, transition=None):
+        """ Return the changes with transition added if it is not the bridge's default """
+        payload = dict(changes)
+        if transition is not None and transition != DEFAULT_TRANSITION:
+            payload['transitiontime'] = transition
+        return payload
+
+    def _acknowledged(self, result, changes):
+        """ Add the changes to the acked state if the bridge applied them """
+        # A rejected request was not applied, so leave it out of the model
+        if result and self.error is None:
+            self.acked.update(changes)
+
+    def _send(self, state, transition=None, timeout=1):
+        """
+        Send the fields of state that differ from the acked state
+        transition is added when there are fields to send
+        Returns the result of the PUT, True if there was nothing to send
+        """
+        changes = self._changes(state)
+        if not changes:
+            return True
+        result = self._put(self._payload(changes, transition), timeout)
+        self._acknowledged(result, changes)
+        return result
+
     def turn_on(self):
         """ Turn on the light if it is not already on """
         if not self.is_on:
             self.is_on = True
-            self.xy_new = self.converter.rgb_to_xy(0.1, 0.1, 0.1)
             state = {
                 'on' : True,
-                'xy' : [*self.xy_new],
                 'bri' : self.brightness
             }
             # Send the update to the light
             self.logger.info('Turn on light(%s:%s)', self.name, self.hue_id)
-            self._put(state, timeout=1)
+            self._send(state, timeout=1)
 
     def turn_off(self):
         """ Turn off the light if light is on """
@@ -189,7 +556,7 @@ class HueLight():
             }
             # Send the update to the light
             self.logger.info('Turn off light(%s:%s)', self.name, self.hue_id)
-            self._put(state)
+            self._send(state)
 
     def set_color(self, red, green, blue):
         """
@@ -200,47 +567,133 @@ class HueLight():
         We don't do any conversions in this function as it is continually
         called and we don't want to waste time converting the values until
         we actually plan to update the light
+        Only the light's bridge worker sets the color, from a published
+        frame, so no lock is needed
         """
-        with self.lock:
-            self.rgb = (red, green, blue)
-        self.logger.debug('Set light(%s:%s) color: %r',
-                          self.name, self.hue_id, self.rgb)
+        self.rgb = (red, green, blue)
+        # Counted rather than logged, see LightsUpdater.log_summary
+        self.stats['colors'] += 1
 
-    def update(self):
+    def changed(self):
         """
-        Send an update to the light if required
-        We only send and update if the colour has changed
+        Return True if the light needs an update sent to the bridge
         We convert the rgb color here as it is done less often than setting
-        the color
+        the color, and only when it has changed since the last conversion
+        The xy is rounded to the 4 decimals the bridge uses, and a change
+        smaller than threshold from the last color sent is suppressed as
+        nobody would see it. Small changes still add up until they pass
+        the threshold. While the color filter is still moving a small step
+        is only held back, it is not counted as suppressed until the filter
+        has reached the client's color.
         """
+        # Smooth then convert the rbg to xy
+        rgb = self.filter.step(self.rgb)
+        if rgb != self.rgb_converted:
+            x, y = self.converter.rgb_to_xy(*rgb)
+            self.xy_new = (round(x, 4), round(y, 4))
+            self.rgb_converted = rgb
+            if self.dynamic_brightness:
+                self.bri_new = max(1, round(self.brightness * luminance(rgb)))
+            if self.xy_new == self.xy_previous and self.bri_new == self.bri_previous:
+                self.pending = False
+            else:
+                self.pending = (self.color_difference() >= self.threshold or
+                                abs(self.bri_new - self.bri_previous) >= self.bri_threshold)
+                if not self.pending and self.filter.settled():
+                    self.stats['suppressed'] += 1
+        return self.pending
 
-        # Convert the rbg to hsv
-        with self.lock:
-            self.xy_new = self.converter.rgb_to_xy(*self.rgb)
+    def settled(self):
+        """ Return False while the color filter is still moving towards the color """
+        return self.filter.settled()
 
-        if self.xy_new != self.xy_previous:
-            # Colour has changed so build a command to send to the bridge
-            self.logger.debug('Light(%s:%s) changed: RGB:%r, XY:%r -> %r',
+    def color_difference(self):
+        """ Return the u'v' distance between the last color sent and the new one """
+        old_u, old_v = xy_to_uv(self.xy_previous)
+        new_u, new_v = xy_to_uv(self.xy_new)
+        return ((new_u - old_u) ** 2 + (new_v - old_v) ** 2) ** 0.5
+
+    def difference(self):
+        """
+        Return how visible the change since the last successful update is
+        This is the u'v' distance between the colors plus the change in
+        luminance scaled so that black to white counts as much as a big
+        change of hue. Call changed() first to convert the color.
+        """
+        delta = self.color_difference()
+        return delta + 0.25 * abs(luminance(self.rgb_converted) - luminance(self.rgb_sent))
+
+    def start_update(self):
+        """
+        Start sending an update to the light if required
+        We only send and update if the colour has changed, and then only
+        the fields the bridge does not already have
+        Returns None if no request was needed, otherwise a PendingUpdate to
+        pass to finish_update. Over the pipelined transport the request is
+        only queued, so the bridge worker can have requests for several
+        lights in flight, over the session it has been answered already.
+        """
+        started = monotonic()
+        if not self.changed():
+            return None
+
+        # Colour has changed so build a command to send to the bridge
+        if self.logger.isEnabledFor(DEBUG) and self.log_sampler.sample('changed'):
+            self.logger.debug('Light(%s:%s) changed: RGB:%r, XY:%r -> %r (%d skipped)',
                               self.name, self.hue_id, self.rgb,
-                              self.xy_previous, self.xy_new)
-            state = {
-                'transitiontime' : self.transition,
-                'xy' : [*self.xy_new]
-            }
-            # If the light has been turned off due to autoOff then turn it on
-            if not self.is_on:
-                self.is_on = True
-                state['on'] = True
-                state['bri'] = self.brightness
+                              self.xy_previous, self.xy_new,
+                              self.log_sampler.skipped('changed'))
+        # If the light has been turned off due to autoOff this turns
+        # it on again
+        self.is_on = True
+        state = {
+            'on' : True,
+            'xy' : self.xy_new,
+            'bri' : self.bri_new
+        }
+        pending = PendingUpdate(started, state, self._changes(state), self.rgb_converted)
+        if not pending.changes:
+            # The bridge already has this state
+            self._updated(pending)
+            return None
+        payload = self._payload(pending.changes, self.transition)
+        if self.transport is None:
+            pending.result = self._put(payload)
+        else:
+            pending.future = self._start_put(payload)
+        return pending
 
-            # Send the update to the light
-            # Only update xy_previous if the update request was successful
-            if self._put(state):
-                self.xy_previous = self.xy_new
-        # else:
-        #     # Color hasn't changed
-        #     self.logger.debug('Light(%s:%s) color has not changed: '
-        #                       'RGB:%r, XY:%r == %r',
-        #                       self.name, self.hue_id,
-        #                       self.rgb,
-        #                       self.xy_previous, self.xy_new)
+    def finish_update(self, pending):
+        """
+        Wait for the answer to an update from start_update
+        Only update xy_previous if the update request was successful
+        Returns False if the update failed to send
+        """
+        result = pending.result
+        if pending.future is not None:
+            result = pending.result = self._finish_put(pending.future)
+            pending.future = None
+        self._acknowledged(result, pending.changes)
+        if result:
+            self._updated(pending)
+            if self.error is None:
+                self._trace(pending.started)
+        return result
+
+    def _updated(self, pending):
+        """ Record the state of the update as the last one sent """
+        self.xy_previous = pending.state['xy']
+        self.bri_previous = pending.state['bri']
+        self.rgb_sent = pending.rgb
+        self.pending = False
+        self.sent_time = monotonic()
+
+    def update(self):
+        """
+        Send an update to the light if required and wait for the answer
+        Returns False if the update failed to send
+        """
+        pending = self.start_update()
+        if pending is None:
+            return True
+        return self.finish_update(pending)
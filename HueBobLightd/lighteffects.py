@@ -9,8 +9,14 @@ __copyright__ = "Copyright 2017, David Dix"
 
 import logging
 import argparse
+import bisect
+import colorsys
+import random
 import socket
+from threading import Thread, Lock
+from time import perf_counter, sleep
 from HueBobLightd.logger import init_logger
+from HueBobLightd.recorder import read_session
 from pkg_resources import get_distribution, DistributionNotFound
 
 try:
@@ -20,28 +26,235 @@ except DistributionNotFound:
     __version__ = 'dev'
 
 
+# Upper limits of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+
+class LoadResults():
+    """ Results collected from all the load clients """
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = list()
+        self.lines = 0
+        self.frames = 0
+        self.connections = 0
+        self.dropped = 0
+
+    def add(self, latencies, lines, frames, dropped):
+        """ Add the results of one client """
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.lines += lines
+            self.frames += frames
+            self.connections += 1
+            self.dropped += dropped
+
+    def histogram(self):
+        """ Return the number of latencies in each of the LATENCY_BUCKETS """
+        counts = [0] * len(LATENCY_BUCKETS)
+        for latency in self.latencies:
+            counts[bisect.bisect_left(LATENCY_BUCKETS, latency * 1000)] += 1
+        return counts
+
+
+def read_lines(conn, count):
+    """ Read a number of response lines from the server """
+    data = b''
+    while data.count(b'\n') < count:
+        received = conn.recv(4096)
+        if not received:
+            raise ConnectionError('Server closed the connection')
+        data += received
+    return data.decode().splitlines()
+
+
+def round_trip(conn, request, count=1):
+    """ Send a request and return the response lines and the latency """
+    start = perf_counter()
+    conn.sendall(request)
+    lines = read_lines(conn, 1)
+    if count is None:
+        # The first line of get lights gives the number of lines that follow
+        count = int(lines[0].split()[1]) + 1
+    if count > len(lines):
+        lines = lines + read_lines(conn, count - len(lines))
+    return lines, perf_counter() - start
+
+
+def recorded_frames(filename):
+    """
+    Return the frames of colors in a session recording
+    Each frame is a list of rgb tuples in the order the lights were first seen
+    """
+    slots = dict()
+    frames = list()
+    frame = dict()
+    for _, _, line in read_session(filename):
+        parts = line.split()
+        if len(parts) == 7 and parts[0] == b'set' and parts[3] == b'rgb':
+            slot = slots.setdefault(parts[2], len(slots))
+            frame[slot] = (float(parts[4]), float(parts[5]), float(parts[6]))
+        elif parts == [b'sync'] and frame:
+            frames.append([frame.get(slot, (0.0, 0.0, 0.0)) for slot in range(len(slots))])
+    if not frames:
+        raise ValueError('No frames in {}'.format(filename))
+    return frames
+
+
+def make_pattern(name, fps, recording=None):
+    """
+    Return a function giving the rgb tuple for a light index in a frame
+        static: a fixed color for each light
+        ramp: each light ramps up and down in brightness every 2 seconds
+        random: a random color for every light in every frame
+        recorded: the colors from a session recording, repeated
+    """
+    if name == 'static':
+        return lambda frame, index: colorsys.hsv_to_rgb((index * 0.15) % 1.0, 1.0, 1.0)
+    if name == 'ramp':
+        period = max(int(fps * 2), 2)
+        return lambda frame, index: (abs((frame + index) % period * 2 / period - 1.0),) * 3
+    if name == 'random':
+        rand = random.Random()
+        return lambda frame, index: (rand.random(), rand.random(), rand.random())
+    if name == 'recorded':
+        frames = recorded_frames(recording)
+        def recorded(frame, index):
+            colors = frames[frame % len(frames)]
+            return colors[index % len(colors)]
+        return recorded
+    raise ValueError('Unknown pattern: {}'.format(name))
+
+
+def load_client(address, args, pattern, results):
+    """
+    Run one load client: time hello & get lights, then send frames at the
+    target rate, timing a get version request every probe interval
+    """
+    logger = logging.getLogger('LoadClient')
+    latencies = list()
+    lines = 0
+    frames = 0
+    dropped = 0
+    try:
+        conn = socket.create_connection(address, timeout=5)
+        try:
+            _, latency = round_trip(conn, b'hello\n')
+            latencies.append(latency)
+            response, latency = round_trip(conn, b'get lights\n', count=None)
+            latencies.append(latency)
+            lightids = [line.split()[1].encode() for line in response[1:]]
+            if args.lights:
+                lightids = lightids[:args.lights]
+            interval = 1.0 / args.fps
+            probe_frames = max(int(args.probe * args.fps), 1)
+            start = perf_counter()
+            deadline = start + args.duration
+            next_frame = start
+            while next_frame < deadline:
+                delay = next_frame - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                request = [b'set light %s rgb %f %f %f\n' % (lightid, *pattern(frames, index))
+                           for index, lightid in enumerate(lightids)]
+                request.append(b'sync\n')
+                conn.sendall(b''.join(request))
+                lines += len(request)
+                frames += 1
+                if frames % probe_frames == 0:
+                    _, latency = round_trip(conn, b'get version\n')
+                    latencies.append(latency)
+                    lines += 1
+                next_frame += interval
+        finally:
+            conn.close()
+    except OSError as exc:
+        logger.info('Connection dropped: %r', exc)
+        dropped = 1
+    results.add(latencies, lines, frames, dropped)
+
+
+def run_load(address, args):
+    """ Run the load clients and report the results """
+    logger = logging.getLogger('LightEffects')
+    pattern = make_pattern(args.pattern, args.fps, args.recording)
+    results = LoadResults()
+    logger.info('Starting %d clients: %s lights, %.1ffps, %s pattern for %.0fs',
+                args.clients, args.lights or 'all', args.fps, args.pattern, args.duration)
+    clients = [Thread(target=load_client, args=(address, args, pattern, results))
+               for _ in range(args.clients)]
+    start = perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = perf_counter() - start
+
+    logger.info('Sent %d lines, %d frames in %.1fs: %.0f lines/sec, %.1f frames/sec',
+                results.lines, results.frames, elapsed,
+                results.lines / elapsed, results.frames / elapsed)
+    logger.info('Connections: %d, dropped: %d', results.connections, results.dropped)
+    latencies = sorted(results.latencies)
+    if latencies:
+        logger.info('Request latency: min %.2fms, median %.2fms, 99%% %.2fms, max %.2fms',
+                    latencies[0] * 1000, latencies[len(latencies) // 2] * 1000,
+                    latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000)
+        counts = results.histogram()
+        scale = 50 / max(counts)
+        labels = ['<= {:g}ms'.format(limit) for limit in LATENCY_BUCKETS[:-1]]
+        labels.append('> {:g}ms'.format(LATENCY_BUCKETS[-2]))
+        for label, count in zip(labels, counts):
+            logger.info('  %10s | %-50s %d', label, '#' * int(count * scale + 0.5), count)
+    return results
+
+
 def main():
     """
     The client sends messages that the AppleTV4 would send
+    With --clients it runs as a load generator instead
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('--server', type=str, default=socket.gethostname(),
                         help='IPv4 address of boblightd server')
+    parser.add_argument('--port', type=int, default=19333,
+                        help='port of boblightd server')
+    parser.add_argument('--clients', type=int, default=0,
+                        help='run as a load generator with this many clients')
+    parser.add_argument('--lights', type=int, default=0,
+                        help='number of lights each load client sets (default: all)')
+    parser.add_argument('--fps', type=float, default=60.0,
+                        help='frames per second sent by each load client')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds to run the load for')
+    parser.add_argument('--pattern', type=str, default='random',
+                        choices=('static', 'ramp', 'random', 'recorded'),
+                        help='colors sent by the load clients')
+    parser.add_argument('--recording', type=str, default=None,
+                        help='session recording for the recorded pattern')
+    parser.add_argument('--probe', type=float, default=1.0,
+                        help='seconds between the get version latency probes')
     parser.add_argument('--debug', default=False,
                         action='store_true',
                         help='turn on debug logging information')
     parser.add_argument('--version', action='version',
                         version=__version__)
     args = parser.parse_args()
+    if args.pattern == 'recorded' and not args.recording:
+        parser.error('the recorded pattern needs --recording')
 
     # Initialise the logger
     init_logger('lighteffects.log', args.debug)
     logger = logging.getLogger('LightEffects')
 
-    address = (args.server, 19333)
+    address = (args.server, args.port)
     # address = ('192.168.123.192', 19333)
     logger.info('Server on %s', address)
 
+    if args.clients:
+        run_load(address, args)
+        logging.info('Exiting...')
+        return
+
     # Connect to the server
     logger.info('creating socket')
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -2,21 +2,471 @@
 """
 LightsUpdater
 This module contains a class for sending updates to the lights using the
-messages and values recieved from the server
+messages and values recieved from the server, with a worker per hue bridge
 """
 
 __author__ = "David Dix"
 __copyright__ = "Copyright 2017, David Dix"
 
 import logging
-from time import time
-from threading import Event
+import concurrent.futures
+from collections import Counter
+from time import time, monotonic
+from threading import Event, Condition, Lock, Thread
+from HueBobLightd.logger import LogSampler
+from HueBobLightd.frames import FrameCompositor
+from HueBobLightd.metrics import Histogram, LATENCY_BUCKETS, TICK_BUCKETS, TRACE_SPANS
+
+
+class LightRegistry():
+    """
+    Index of the lights keyed by their boblight light id 'name:id'
+    Lookups accept the id as a str or as the raw bytes sent by a client.
+    The list of lights is replaced, never modified, so it can be iterated
+    while lights are added or removed. Every change bumps the generation
+    so that any cached lookups can be thrown away.
+    Each light's slot is its position in the list, and the index of its
+    color in the FrameLayer arrays.
+    """
+    def __init__(self):
+        self.lights = list()
+        self.index = dict()
+        self.slots = dict()
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.lights)
+
+    def __iter__(self):
+        return iter(self.lights)
+
+    def __contains__(self, lightid):
+        return lightid in self.index
+
+    @staticmethod
+    def light_id(light):
+        """ Return the boblight id of a light """
+        return '{}:{}'.format(light.name, light.hue_id)
+
+    def get(self, lightid):
+        """ Return the light for the str or bytes light id, None if unknown """
+        return self.index.get(lightid)
+
+    def slot(self, lightid):
+        """ Return the slot for the str or bytes light id, None if unknown """
+        return self.slots.get(self.index.get(lightid))
+
+    def add(self, light):
+        """ Add the light, returns False if the light id is already in use """
+        lightid = self.light_id(light)
+        if lightid in self.index:
+            return False
+        self.slots[light] = len(self.lights)
+        self.lights = self.lights + [light]
+        self.index[lightid] = light
+        self.index[lightid.encode()] = light
+        self.generation += 1
+        return True
+
+    def remove(self, light):
+        """ Remove the light, returns False if it was not in the registry """
+        lightid = self.light_id(light)
+        if self.index.get(lightid) is not light:
+            return False
+        self.generation += 1
+        del self.index[lightid]
+        del self.index[lightid.encode()]
+        self.lights = [lite for lite in self.lights if lite is not light]
+        # The lights after the one removed move down a slot
+        self.slots = {lite: slot for slot, lite in enumerate(self.lights)}
+        return True
+
+
+class TokenBucket():
+    """
+    Token bucket limiting the requests sent to a bridge
+    Tokens are added at rate per second up to burst. Each request to the
+    bridge takes one token.
+    """
+    def __init__(self, rate=10.0, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+
+    def __repr__(self):
+        return 'TokenBucket: rate({:.1f}), burst({:.0f})'.format(self.rate, self.burst)
+
+    def _refill(self, now):
+        """ Add the tokens accumulated since the last refill """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        """ Change the rate, the tokens so far are added at the old rate """
+        self._refill(monotonic())
+        self.rate = float(rate)
+
+    def delay(self):
+        """ Return the seconds until a token is available, 0 if there is one """
+        self._refill(monotonic())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """ Take a token, returns False if there is none available """
+        self._refill(monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateController():
+    """
+    Adjusts the rate of a bridge's token bucket from the bridge responses
+    The rate creeps up while the bridge answers quickly without errors and
+    is cut when it is busy, times out or slows down, so a bridge that is
+    also serving sensors and apps gets as many requests as it can handle.
+    Attributes:
+        latency_target: seconds a healthy bridge takes to answer
+        increase: requests per second added for each second of healthy answers
+        decrease: the rate is multiplied by this when the bridge is struggling
+        holdoff: seconds after a decrease before the rate is changed again
+    """
+    logger = None
+    latency_target = 0.15
+    increase = 0.5
+    decrease = 0.7
+    holdoff = 1.0
+
+    def __init__(self, bucket, min_rate=2.0, max_rate=20.0):
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.bucket = bucket
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.decrease_time = 0.0
+
+    def __repr__(self):
+        return 'RateController: rate({:.1f}), min({:.1f}), max({:.1f})'.format(
+            self.bucket.rate, self.min_rate, self.max_rate)
+
+    def observe(self, latency, error):
+        """
+        Adjust the rate from the latency and error class of a request
+        A rejected request says nothing about the load so only its latency
+        is used
+        """
+        now = monotonic()
+        if now - self.decrease_time < self.holdoff:
+            # Give the bridge time to recover from the last decrease
+            return
+        rate = self.bucket.rate
+        if error not in (None, 'rejected') or latency > self.latency_target:
+            new_rate = max(self.min_rate, rate * self.decrease)
+            self.decrease_time = now
+            self.logger.debug('Bridge %s (latency %.0fms), rate %.1f -> %.1f',
+                              error or 'slow', latency * 1000, rate, new_rate)
+        else:
+            # Each request adds its share so the rate goes up by increase
+            # every second
+            new_rate = min(self.max_rate, rate + self.increase / rate)
+        if new_rate != rate:
+            self.bucket.set_rate(new_rate)
+
+
+class BridgeWorker():
+    """
+    Sends the frames to the lights on one hue bridge
+    Each worker has its own thread, connection to the bridge and token
+    bucket, so a slow or missing bridge does not hold up the others
+    Over the pipelined transport the worker does not wait for each answer,
+    up to depth lights have a request in flight to the bridge
+    Attributes:
+        age_weight: score added per second a changed light has waited
+        retry_delay: seconds a light that failed to send is held back, doubled
+            for each failure in a row up to retry_max
+        settle_interval: seconds between the steps of a light's color filter
+            that is still moving when there are no new frames
+        answer_wait: most seconds to wait for an answer before checking
+            whether the worker has been asked to exit
+        depth: most requests in flight to the bridge, 1 unless the lights
+            use the pipelined transport
+        latency: histogram of the bridge response times
+        tick_duration: histogram of the time to composite the frame and
+            pick the next light, without the request to the bridge
+        tick_lateness: histogram of how late each send started after its
+            token was available
+    """
+    logger = None
+    age_weight = 0.05
+    retry_delay = 0.5
+    retry_max = 5.0
+    settle_interval = 0.1
+    answer_wait = 1.0
+
+    def __init__(self, updater, bridge, lights, rate=10.0, burst=1, min_rate=2.0, max_rate=20.0):
+        #pylint: disable=R0913
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.updater = updater
+        self.bridge = bridge
+        self.lights = lights
+        transport = lights[0].transport
+        self.depth = 1 if transport is None else transport.capacity
+        self.bucket = TokenBucket(rate, burst)
+        self.controller = RateController(self.bucket, min_rate, max_rate)
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.tick_duration = Histogram(TICK_BUCKETS)
+        self.tick_lateness = Histogram(TICK_BUCKETS)
+        self.frame_ready = Condition()
+        self.frame_pending = False
+        self.retries = dict()  # HueLight: (retry time, failures in a row)
+        self.checked_time = 0.0  # When the lights were last checked for changes
+        self.thread = None
+
+    def __repr__(self):
+        return 'BridgeWorker: address({}), lights({:d}), {!r}, {!r}'.format(
+            self.bridge.address, len(self.lights), self.bucket, self.controller)
+
+    def start(self):
+        """ Start the worker thread """
+        self.thread = Thread(target=self.run, name='Bridge-{}'.format(self.bridge.address))
+        self.thread.setDaemon(True)  # don't hang on exit
+        self.thread.start()
+
+    def join(self):
+        """ Wait for the worker thread to exit """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def notify(self):
+        """ Wake the worker to send a new frame """
+        with self.frame_ready:
+            self.frame_pending = True
+            self.frame_ready.notify()
+
+    def wake(self):
+        """ Wake the worker without a frame e.g. to exit """
+        with self.frame_ready:
+            self.frame_ready.notify()
+
+    def connect(self):
+        """ Connect to the bridge, returns False if asked to exit first """
+        exit_event = self.updater.exit_event
+        while not self.lights[0].connect():
+            self.logger.error('Failed to connect to hue bridge %s. Retrying...',
+                              self.bridge.address)
+            if exit_event.wait(timeout=1):
+                return False
+        self.logger.info('Connection established to hue bridge %s', self.bridge.address)
+        return True
+
+    def initialise(self):
+        """ Turn on the lights that exist on the bridge """
+        for light in self.lights:
+            if light.validate():
+                light.turn_on()
+            else:
+                self.logger.debug('Light(%s:%s) does not exist on bridge',
+                                  light.name, light.hue_id)
+
+    def next_light(self, lights, in_flight=()):
+        """
+        Return the changed light to send next, None if all are up to date
+        The light with the most visible change since it was last sent goes
+        first, so scene cuts are sent before small drifts. The age term
+        makes sure a light with a small change is not left waiting forever.
+        A light that failed to send is skipped until its retry time, and a
+        light in in_flight is skipped until its answer arrives.
+        """
+        now = monotonic()
+        retries = self.retries
+        best_light = None
+        best_score = -1.0
+        for light in lights:
+            if light in in_flight:
+                continue
+            if light.changed():
+                retry = retries.get(light)
+                if retry is not None and retry[0] > now:
+                    continue
+                score = light.difference() + self.age_weight * (now - light.sent_time)
+                if score > best_score:
+                    best_light = light
+                    best_score = score
+            elif light in retries:
+                # Nothing left to send e.g. the color went back to the last one sent
+                del retries[light]
+        return best_light
+
+    def backoff(self, light):
+        """ Hold back a light that failed to send so the other lights get their turn """
+        failures = self.retries.get(light, (0.0, 0))[1] + 1
+        delay = min(self.retry_max, self.retry_delay * 2 ** (failures - 1))
+        self.retries[light] = (monotonic() + delay, failures)
+
+    def wake_delay(self, lights):
+        """
+        Return the seconds until the lights need looking at without a new
+        frame, None if they can wait for the next frame
+        That is when a light that failed is due to be sent again, or the
+        next step of a color filter that has not reached its color yet,
+        as a light's color only moves when it is looked at
+        """
+        now = monotonic()
+        wake = None
+        if self.retries:
+            wake = min(retry for retry, _ in self.retries.values())
+        if not all(light.settled() for light in lights):
+            settle = self.checked_time + self.settle_interval
+            wake = settle if wake is None else min(wake, settle)
+        return None if wake is None else max(0.0, wake - now)
+
+    def send(self, lights):
+        """
+        Send the changed lights, one light each time a token is available
+        The frame is composited again for each light so it is sent the
+        latest color, not the one from when the frame started.
+        Over the session each light's request is answered before the next
+        light is sent. Over the pipelined transport the answers are handled
+        as they arrive, while the next lights are sent as their tokens
+        become available, so the bridge's latency does not limit the rate.
+        Returns None if asked to exit and True once all the lights are up
+        to date or held back after failing
+        """
+        exit_event = self.updater.exit_event
+        in_flight = dict()  # HueLight: PendingUpdate
+        due = None
+        while True:
+            if exit_event.is_set():
+                return None
+            delay = self.bucket.delay()
+            if delay:
+                due = monotonic() + delay
+            if in_flight and (delay or len(in_flight) >= self.depth):
+                # Handle the answers while waiting for a token or a space
+                self.collect(in_flight, delay or self.answer_wait)
+                continue
+            if delay and exit_event.wait(delay):
+                return None
+            start = monotonic()
+            # Take each light's color from the client that owns it
+            self.updater.frames.composite(lights, self.updater.registry.slots)
+            light = self.next_light(lights, in_flight)
+            self.checked_time = start
+            if light is None:
+                if not in_flight:
+                    return True
+                # A light that fails may need sending again
+                self.collect(in_flight, self.answer_wait)
+                continue
+            # The request is left out so the tick is the same work over
+            # either transport, the bridge's answer is in latency
+            self.tick_duration.observe(monotonic() - start)
+            if due is not None:
+                self.tick_lateness.observe(max(0.0, start - due))
+                due = None
+            pending = light.start_update()
+            if pending is None:
+                # The bridge already has the light's state, only a request
+                # takes a token and tells the controller about the bridge
+                continue
+            self.bucket.consume()
+            if pending.done():
+                self.finish(light, pending)
+            else:
+                in_flight[light] = pending
+
+    def collect(self, in_flight, timeout):
+        """
+        Wait up to timeout seconds for an answer to one of the requests
+        in flight, then handle all the answers that have arrived
+        """
+        concurrent.futures.wait([pending.future for pending in in_flight.values()],
+                                timeout, concurrent.futures.FIRST_COMPLETED)
+        for light, pending in list(in_flight.items()):
+            if pending.done():
+                del in_flight[light]
+                self.finish(light, pending)
+
+    def finish(self, light, pending):
+        """ Handle the answer to a light's update """
+        sent = light.finish_update(pending)
+        self.controller.observe(light.latency, light.error)
+        self.latency.observe(light.latency)
+        if sent:
+            self.retries.pop(light, None)
+        else:
+            # The light is still changed, it is held back while the
+            # other lights are sent and tried again at its retry time
+            self.backoff(light)
+
+    def run(self):
+        """
+        Main loop for updating the lights on the bridge
+        Handles connecting to the bridge, turning on the lights and
+        sending the colour updates
+        """
+        updater = self.updater
+        if not self.connect():
+            self.logger.debug('Exiting %r: 1', self)
+            return
+
+        self.initialise()
+        self.logger.info('Lights have been turned on: %r', self)
+
+        """
+        The loop sleeps until a sync arrives with a new frame. The changed
+        lights are then sent one at a time, biggest change first, as each
+        token becomes available. Spreading the requests like this gives the bridge
+        a steady stream rather than bursts, and each light is sent the
+        latest frame. Philips recommend no more than 10 requests per second
+        per bridge.
+        With no new frames the loop only wakes while a light's color
+        filter is still moving, when a light that failed is due to be sent
+        again, and at the auto off deadline.
+        """
+        lights_inuse = [light for light in self.lights if light.in_use]
+        while True:
+            with self.frame_ready:
+                while not updater.exit_event.is_set():
+                    if self.frame_pending:
+                        timeout = 0
+                    else:
+                        timeout = self.wake_delay(lights_inuse)
+                        if updater.auto_off_delay and any(light.is_on for light in lights_inuse):
+                            auto_off = updater.last_synctime + updater.auto_off_delay - time()
+                            timeout = auto_off if timeout is None else min(timeout, auto_off)
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.frame_ready.wait(timeout)
+                if updater.exit_event.is_set():
+                    break
+                frame_pending = self.frame_pending or self.wake_delay(lights_inuse) == 0
+                self.frame_pending = False
+                last_synctime = updater.last_synctime
+
+            if frame_pending:
+                if self.send(lights_inuse) is None:
+                    break
+                updater.log_summary(lights_inuse)
+            elif updater.auto_off_delay and time() - last_synctime >= updater.auto_off_delay:
+                # The lights that failed wait for the next frame
+                self.retries.clear()
+                for light in lights_inuse:
+                    light.turn_off()
+
+        self.logger.debug('Exiting %r: 2', self)
 
 
 class LightsUpdater():
     """
-    Class for connecting to the hue bridge and updating the
-    configured lights as fast as the bridge will allow
+    Class for connecting to the hue bridges and updating the
+    configured lights as fast as each bridge will allow
     """
     logger = None
 
@@ -27,20 +477,28 @@ class LightsUpdater():
         self.exit_event = Event()
         if type(self).logger is None:
             type(self).logger = logging.getLogger(type(self).__name__)
-        self.lights = list()
+        self.registry = LightRegistry()
+        self.frames = FrameCompositor()
+        self.counters = Counter()  # Requests received by all the clients
+        self.bridge_rates = dict()  # BridgeAddress: (rate, burst, min_rate, max_rate)
+        self.workers = list()
         self.last_synctime = time()
         self.auto_off_delay = 300  # Default to 5 mins
+        self.log_sampler = LogSampler()
+        self.summary_lock = Lock()
+        self.summary_time = time()
+        self.summary_stats = dict()
+        self.summary_trace = dict()
+
+    @property
+    def lights(self):
+        """ The list of lights to update """
+        return self.registry.lights
 
     def add(self, new_light):
         """ Add a light to the list of lights to update """
-        # First check that the light does not currently exist in the list
-        matches = [
-            light for light in self.lights
-            if light.name == new_light.name
-            and light.hue_id == new_light.hue_id
-        ]
-        if not matches:
-            self.lights.append(new_light)
+        # The registry refuses a light that already exists
+        if self.registry.add(new_light):
             self.logger.debug('Added light(%s:%s)',
                               new_light.name, new_light.hue_id)
         else:
@@ -50,77 +508,118 @@ class LightsUpdater():
     def remove(self, light):
         """ Remove the specified light from the list """
         self.logger.debug('Removing light%s:%s)', light.name, light.hue_id)
-        self.lights = [lite for lite in self.lights if lite != light]
+        self.registry.remove(light)
         light.turn_off()
         del light
 
+    def set_rate(self, bridge, rate, burst, min_rate=2, max_rate=20):
+        """
+        Set the requests per second and burst allowed for a bridge
+        The rate starts at rate and is adjusted between min_rate and max_rate
+        to suit how busy the bridge is
+        """
+        #pylint: disable=R0913
+        self.bridge_rates[bridge] = (rate, burst, min_rate, max_rate)
+
     def update(self):
         """
         Called to request the object to update the lights
-        In our implementation we just record the time an update is requested
-        as the update_forever method is feeding the bridge as fast as it can
+        Records the time of the request and wakes the bridge workers
+        to send the new frame
         """
         self.last_synctime = time()
-        self.logger.debug('Update request received: %d', self.last_synctime)
+        for worker in self.workers:
+            worker.notify()
+        if self.logger.isEnabledFor(logging.DEBUG) and self.log_sampler.sample('update'):
+            self.logger.debug('Update request received: %d (%d skipped)',
+                              self.last_synctime, self.log_sampler.skipped('update'))
 
-    def initialise(self):
+    def log_summary(self, lights):
         """
-        Get the update loop to re-initialise the lights
+        Log a summary line per light every LogSampler.interval seconds
+        This replaces logging every color change and request in DEBUG mode
+        The mean latency of each span of the light's trace over the interval
+        is logged too, see HueLight.trace
+        The totals are kept for the current lights only, so the lights
+        replaced on a SIGHUP are not kept alive
         """
-        self.logger.info('Initialise: Auto Off: %dmins', self.auto_off_delay / 60)
+        now = time()
+        if now - self.summary_time < self.log_sampler.interval:
+            return
+        with self.summary_lock:
+            elapsed = now - self.summary_time
+            if elapsed < self.log_sampler.interval:
+                return  # Another bridge worker has just logged
+            self.summary_time = now
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        summary_stats, self.summary_stats = self.summary_stats, dict()
+        summary_trace, self.summary_trace = self.summary_trace, dict()
+        # Include the lights of every bridge in the one summary
         for light in self.lights:
-            if light.validate():
-                light.turn_on()
-            else:
-                self.logger.debug('Light(%s:%s) does not exist on bridge',
-                                  light.name, light.hue_id)
+            # Keep the totals even when not logging so the first summary
+            # after SIGUSR1 turns on DEBUG only covers its own interval
+            stats = Counter(light.stats)
+            previous = summary_stats.get(light, Counter())
+            self.summary_stats[light] = Counter(stats)
+            trace = {span: (hist.sum, hist.count) for span, hist in light.trace.items()}
+            previous_trace = summary_trace.get(light, dict())
+            self.summary_trace[light] = trace
+            if debug:
+                stats.subtract(previous)
+                self.logger.debug('Light(%s:%s) summary %.0fs: colors %d, puts %d, '
+                                  'failed %d, suppressed %d, xy %r',
+                                  light.name, light.hue_id, elapsed,
+                                  stats['colors'], stats['puts'], stats['failed'],
+                                  stats['suppressed'], light.xy_previous)
+                means = list()
+                for span in TRACE_SPANS:
+                    total, count = trace[span]
+                    old_total, old_count = previous_trace.get(span, (0.0, 0))
+                    if count > old_count:
+                        means.append('{} {:.1f}ms'.format(
+                            span, 1000 * (total - old_total) / (count - old_count)))
+                    else:
+                        means.append('{} -'.format(span))
+                self.logger.debug('Light(%s:%s) latency %.0fs: %s',
+                                  light.name, light.hue_id, elapsed, ', '.join(means))
+
+    def create_workers(self):
+        """ Create a worker for each bridge with the lights on it """
+        bridges = dict()
+        for light in self.lights:
+            bridges.setdefault(light.bridge, list()).append(light)
+        workers = list()
+        for bridge, lights in bridges.items():
+            rates = self.bridge_rates.get(bridge, (10, 1, 2, 20))
+            workers.append(BridgeWorker(self, bridge, lights, *rates))
+        return workers
 
     def shutdown(self):
         """ Turn off the light and disconnect from the bridge """
         self.logger.info('Shutdown called')
         self.exit_event.set()  # Tell the update forever loop to exit
+        for worker in self.workers:
+            worker.wake()
         for light in self.lights:
             self.remove(light)
 
     def update_forever(self):
         """
         Main loop for updating the lights
-        Handles connecting to the bridge, turning on the lights and
-        sending the colour updates
+        Starts a worker per bridge and waits for shutdown
         """
-        # TODO: We need to check all available bridges
-        while not self.lights[0].connect():
-            self.logger.error('Failed to connect to hue bridge. Retrying...')
-            if self.exit_event.wait(timeout=1):
-                self.exit_event.clear()
-                self.logger.debug('Exiting update_forever: 1')
-                return
-        self.logger.info('Connection established to hue bridge')
-
-        self.initialise()
-        self.logger.info('Lights have been turned on')
+        self.logger.info('Initialise: Auto Off: %dmins', self.auto_off_delay / 60)
+        workers = self.create_workers()
+        for worker in workers:
+            self.logger.info('Starting %r', worker)
+            worker.start()
+        self.workers = workers
 
-        """
-        The update loop timeout is governed by the number of lights we need
-        to update.
-        Philips recommend no more than 10 requests per second, so we
-        multiply 0.1s by the number of lights we have
-        We also adjust the transistion time to ensure a light has
-        completed its update before the next update arrives
-        """
-        lights_inuse = [light for light in self.lights if light.in_use]
-        # self.logger.info('Lights in_use = %d', len(lights_inuse))
-        update_period = 0.1 * len(lights_inuse)
-        self.logger.info('Update period: %.1fms', update_period * 1000)
-
-        # Main loop for continually updating the lights
-        while not self.exit_event.wait(timeout=update_period):
-            for light in lights_inuse:
-                if self.auto_off_delay \
-                        and (time() - self.last_synctime) > self.auto_off_delay:
-                    light.turn_off()
-                else:
-                    light.update()
+        self.exit_event.wait()
+        for worker in workers:
+            worker.wake()
+            worker.join()
+        self.workers = list()
         self.exit_event.clear()
 
-        self.logger.debug('Exiting update_forever: 2')
+        self.logger.debug('Exiting update_forever')
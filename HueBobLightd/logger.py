@@ -10,6 +10,8 @@ __copyright__ = "Copyright 2017, David Dix"
 import os
 import logging
 import logging.handlers
+from collections import Counter
+from time import monotonic
 
 
 def init_logger(filename, debug, backups=2):
@@ -48,3 +50,39 @@ def init_logger(filename, debug, backups=2):
     if need_roll:
         logger.debug('------------- Closing file and rotating --------------')
         fileh.doRollover()
+
+
+class LogSampler():
+    """
+    Rate limiter for debug messages logged from the hot path
+    Messages that would be logged for every frame are limited to one per
+    key every interval seconds, an interval of 0 allows every message.
+    The caller checks the log level once and asks sample() before building
+    the message, so a dropped message costs next to nothing e.g.
+
+        if debug and sampler.sample(light):
+            logger.debug('... (%d skipped)', ..., sampler.skipped(light))
+
+    The interval is a class attribute so the configuration file can
+    change it for every sampler.
+    """
+    interval = 10.0
+
+    def __init__(self, interval=None):
+        if interval is not None:
+            self.interval = interval
+        self.next_time = dict()
+        self.skipped_count = Counter()
+
+    def sample(self, key):
+        """ Return True if a message for this key should be logged now """
+        now = monotonic()
+        if now < self.next_time.get(key, 0.0):
+            self.skipped_count[key] += 1
+            return False
+        self.next_time[key] = now + self.interval
+        return True
+
+    def skipped(self, key):
+        """ Return and reset the number of messages skipped for this key """
+        return self.skipped_count.pop(key, 0)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Metrics
+This module contains an optional HTTP server that reports the daemon's
+counters in the Prometheus text format, see
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import logging
+from bisect import bisect_left
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Upper bounds in seconds of the histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+TICK_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+TRACE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# The parts of a frame's trip from the client to the bridge, see HueLight.trace
+TRACE_SPANS = ('sync', 'queue', 'conversion', 'http', 'total')
+
+# Error classes counted in the HueLight stats, see HueLight._put
+PUT_ERRORS = ('busy', 'rejected', 'timeout', 'stale', 'connection', 'http')
+
+
+class Histogram():
+    """
+    Counts of values in buckets with the sum of the values
+    The buckets are the upper bounds of each range, there is one more
+    range above the last bucket
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Add a value to the histogram """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """ Return the histogram lines in the Prometheus text format """
+        lines = list()
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            bucket = dict(labels, le='+Inf' if bound == float('inf') else repr(bound))
+            lines.append('{}_bucket{} {:d}'.format(name, format_labels(bucket), total))
+        lines.append('{}_sum{} {!r}'.format(name, format_labels(labels), self.sum))
+        lines.append('{}_count{} {:d}'.format(name, format_labels(labels), self.count))
+        return lines
+
+
+def format_labels(labels):
+    """ Return the labels as {name="value",...}, an empty string for none """
+    if not labels:
+        return ''
+    pairs = list()
+    for name, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+def light_labels(light):
+    """ Return the labels that identify a light """
+    return {'bridge': light.bridge.address, 'light': light.name, 'id': light.hue_id}
+
+
+class MetricsWriter():
+    """ Builds the metrics text a metric at a time """
+    def __init__(self):
+        self.lines = list()
+        self.declared = set()
+
+    def declare(self, name, kind, text):
+        """ Add the HELP and TYPE lines for a metric, once """
+        if name not in self.declared:
+            self.declared.add(name)
+            self.lines.append('# HELP {} {}'.format(name, text))
+            self.lines.append('# TYPE {} {}'.format(name, kind))
+
+    def sample(self, name, value, labels=None):
+        """ Add a sample line """
+        self.lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+    def histogram(self, name, histogram, labels, text):
+        """ Add a histogram """
+        self.declare(name, 'histogram', text)
+        self.lines.extend(histogram.render(name, labels))
+
+    def text(self):
+        """ Return the metrics text """
+        return '\n'.join(self.lines) + '\n'
+
+
+def render_metrics(updater, udp_server=None):
+    """
+    Return the metrics for the updater, its lights and bridge workers and
+    the clients' requests in the Prometheus text format
+    The light metrics are labelled with the bridge, so sum by bridge for
+    the bridge totals, and the light's name and id as two lights may share
+    a name
+    """
+    out = MetricsWriter()
+    counters = updater.counters
+
+    out.declare('hueboblightd_lines_total', 'counter', 'Request lines received from clients')
+    out.sample('hueboblightd_lines_total', counters['lines'])
+    out.declare('hueboblightd_commands_total', 'counter', 'Requests received by command')
+    for command in ('hello', 'ping', 'get', 'set', 'sync', 'unknown', 'malformed'):
+        out.sample('hueboblightd_commands_total', counters[command], {'command': command})
+    out.declare('hueboblightd_syncs_total', 'counter', 'Frames synced by clients')
+    out.sample('hueboblightd_syncs_total', counters['syncs'])
+    out.declare('hueboblightd_rgb_total', 'counter', 'Light rgb requests received')
+    out.sample('hueboblightd_rgb_total', counters['rgb'])
+    out.declare('hueboblightd_rgb_coalesced_total', 'counter',
+                'Light rgb requests replaced by a later one before the sync')
+    out.sample('hueboblightd_rgb_coalesced_total', counters['coalesced'])
+    out.declare('hueboblightd_clients', 'gauge', 'Connected clients, including UDP senders')
+    out.sample('hueboblightd_clients', len(updater.frames.layers))
+
+    if udp_server is not None:
+        out.declare('hueboblightd_udp_frames_total', 'counter', 'UDP frame datagrams by result')
+        for result in ('frames', 'dropped', 'invalid'):
+            out.sample('hueboblightd_udp_frames_total', udp_server.counters[result],
+                       {'result': result})
+
+    lights = list(updater.lights)
+    for name, text in (('colors', 'Colors set from the client frames'),
+                       ('puts', 'Requests sent to the bridge'),
+                       ('failed', 'Requests that failed and will be sent again'),
+                       ('suppressed', 'Color changes too small to send')):
+        metric = 'hueboblightd_light_{}_total'.format(name)
+        out.declare(metric, 'counter', text)
+        for light in lights:
+            out.sample(metric, light.stats[name], light_labels(light))
+    out.declare('hueboblightd_light_errors_total', 'counter', 'Request errors by class')
+    for light in lights:
+        for error in PUT_ERRORS:
+            out.sample('hueboblightd_light_errors_total', light.stats[error],
+                       dict(light_labels(light), error=error))
+    for light in lights:
+        for span in TRACE_SPANS:
+            out.histogram('hueboblightd_light_latency_seconds', light.trace[span],
+                          dict(light_labels(light), span=span),
+                          'Time a color took from the client to the bridge by span')
+
+    # Each metric's lines go together under its TYPE line, a family at a time
+    workers = list(updater.workers)
+    out.declare('hueboblightd_bridge_rate', 'gauge', 'Requests per second allowed')
+    for worker in workers:
+        out.sample('hueboblightd_bridge_rate', '{:.3f}'.format(worker.bucket.rate),
+                   {'bridge': worker.bridge.address})
+    for name, attribute, text in (
+            ('bridge_latency_seconds', 'latency', 'Time taken by the bridge to answer a request'),
+            ('tick_duration_seconds', 'tick_duration',
+             'Time taken to composite the frame and pick the next light'),
+            ('tick_lateness_seconds', 'tick_lateness',
+             'Time a send started after its token was available')):
+        for worker in workers:
+            out.histogram('hueboblightd_' + name, getattr(worker, attribute),
+                          {'bridge': worker.bridge.address}, text)
+    return out.text()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """ Answers GET /metrics """
+    logger = None
+
+    def __init__(self, *args, **kwargs):
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        """ Send the metrics """
+        #pylint: disable=C0103
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics(self.server.data, self.server.udp_server).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Log the requests to our logger rather than stderr """
+        #pylint: disable=W0622
+        self.logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server for the metrics, data is the LightsUpdater """
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class=MetricsRequestHandler):
+        self.data = None
+        self.udp_server = None
+        super().__init__(server_address, handler_class)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Profiler
+This module contains a sampling profiler that can be started and stopped
+while the daemon is running, see the SIGUSR2 handler in hueboblightd
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import os
+import sys
+import logging
+import selectors
+import socket
+import ssl
+import threading
+import time
+from collections import Counter
+from time import strftime, monotonic
+
+# Samples stopped in these modules are threads waiting for work, or for a
+# socket e.g. the answer from a bridge
+IDLE_FILES = tuple(os.path.splitext(module.__file__)[0]
+                   for module in (threading, selectors, socket, ssl))
+
+
+def thread_cpu(ident):
+    """ Return the CPU seconds used by a thread, None where this is not available """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+
+class ThreadProfile():
+    """
+    The samples taken from one thread
+    Functions are keyed by (filename, first line, name)
+    The samples are wall-clock, a thread blocked in a call that does not
+    go through one of the IDLE_FILES e.g. a recv in a request handler
+    looks busy. The CPU time the thread used is kept as well where the
+    platform has per thread clocks.
+    Attributes:
+        samples: number of samples taken
+        idle: samples where the thread was waiting for work
+        own: samples with the function at the top of the stack
+        total: samples with the function anywhere in the stack
+        cpu_start: CPU seconds the thread had used at its first sample
+        cpu: CPU seconds the thread has used since its first sample
+    """
+    def __init__(self):
+        self.samples = 0
+        self.idle = 0
+        self.own = Counter()
+        self.total = Counter()
+        self.cpu_start = None
+        self.cpu = None
+
+    def add_cpu(self, seconds):
+        """ Record the CPU seconds the thread has used, None if unknown """
+        if seconds is None:
+            return
+        if self.cpu_start is None:
+            self.cpu_start = seconds
+        self.cpu = seconds - self.cpu_start
+
+    def add(self, frame):
+        """ Count the functions in the stack of a frame """
+        self.samples += 1
+        code = frame.f_code
+        if code.co_filename.startswith(IDLE_FILES):
+            self.idle += 1
+            return
+        self.own[(code.co_filename, code.co_firstlineno, code.co_name)] += 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if key not in seen:
+                seen.add(key)
+                self.total[key] += 1
+            frame = frame.f_back
+
+
+def describe(key):
+    """ Return a function key as name (file:line) """
+    filename, line, name = key
+    return '{} ({}:{:d})'.format(name, os.path.basename(filename), line)
+
+
+class SamplingProfiler():
+    """
+    Statistical profiler for all the daemon's threads
+    A background thread takes the stack of every other thread each interval
+    seconds. It adds little overhead so it can be left running during real
+    playback. When stopped the per thread stats are written to a file in
+    directory and the busiest functions are logged.
+    """
+    logger = None
+
+    def __init__(self, directory, interval=0.005, top=10):
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.directory = directory
+        self.interval = interval
+        self.top = top
+        self.threads = dict()
+        self.started = 0.0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        """ True while the profiler is sampling """
+        return self.thread is not None
+
+    def toggle(self):
+        """ Start the profiler, or stop it if it is running """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        """ Start sampling the threads """
+        if self.running:
+            return
+        self.logger.info('Profiler started: sampling every %.1fms', self.interval * 1000)
+        self.threads = dict()
+        self.started = monotonic()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='Profiler')
+        self.thread.setDaemon(True)  # don't hang on exit
+        self.thread.start()
+
+    def stop(self):
+        """ Stop sampling, write the stats and return the filename """
+        if not self.running:
+            return None
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        elapsed = monotonic() - self.started
+        filename = os.path.join(self.directory,
+                                'hueboblightd-profile-{}.txt'.format(strftime('%Y%m%d-%H%M%S')))
+        with open(filename, 'w') as output:
+            output.write(self.report(elapsed))
+        self.log_summary(elapsed)
+        self.logger.info('Profiler stopped: stats written to %s', filename)
+        return filename
+
+    def _run(self):
+        """ Sample the threads until stopped """
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """ Take a sample of every thread but our own """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        #pylint: disable=W0212
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            name = names.get(ident, str(ident))
+            profile = self.threads.get(name)
+            if profile is None:
+                profile = self.threads[name] = ThreadProfile()
+            profile.add(frame)
+            profile.add_cpu(thread_cpu(ident))
+
+    def report(self, elapsed):
+        """ Return the per thread stats as text """
+        lines = ['Profile of {:.1f}s sampled every {:.1f}ms'.format(elapsed, self.interval * 1000)]
+        for name, profile in sorted(self.threads.items()):
+            busy = profile.samples - profile.idle
+            lines.append('')
+            line = 'Thread {}: {:d} samples, {:d} busy (wall-clock)'.format(
+                name, profile.samples, busy)
+            if profile.cpu is not None:
+                line += ', cpu {:.3f}s'.format(profile.cpu)
+            lines.append(line)
+            if not busy:
+                continue
+            lines.append('{:>7} {:>7}  function'.format('own', 'total'))
+            for key, total in profile.total.most_common(30):
+                lines.append('{:>7d} {:>7d}  {}'.format(profile.own[key], total, describe(key)))
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self, elapsed):
+        """ Log the busiest threads and functions """
+        own = Counter()
+        for name, profile in sorted(self.threads.items()):
+            busy = profile.samples - profile.idle
+            if busy:
+                if profile.cpu is None:
+                    self.logger.info('Profile thread %s: %.0f%% busy (wall-clock)', name,
+                                     100.0 * busy / profile.samples)
+                else:
+                    self.logger.info('Profile thread %s: %.0f%% busy (wall-clock), %.0f%% cpu',
+                                     name, 100.0 * busy / profile.samples,
+                                     100.0 * profile.cpu / elapsed)
+            own.update(profile.own)
+        samples = sum(own.values())
+        self.logger.info('Profile of %.1fs: %d busy samples (wall-clock)', elapsed, samples)
+        for key, count in own.most_common(self.top):
+            self.logger.info('Profile %5.1f%% %s', 100.0 * count / samples, describe(key))
+        if not samples:
+            self.logger.info('Profile: all threads were idle')
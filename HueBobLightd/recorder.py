@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Session Recorder
+This module contains the classes to record the requests received from the
+clients to a file, and to read them back for replaying.
+
+File format, all values are unsigned and in network byte order:
+    header: b'HBREC1\\n'
+    records: time since the previous record in microseconds (32 bits),
+             connection number (16 bits), length (16 bits), then the
+             request line without its line terminator.
+             A record with a length of 0 marks the connection closing.
+Files with names ending in .gz are compressed.
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import gzip
+import logging
+import struct
+from threading import Lock
+from time import monotonic
+
+MAGIC = b'HBREC1\n'
+RECORD = struct.Struct('!IHH')
+
+
+def _open(filename, mode):
+    """ Open the file, compressed if the name ends in .gz """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+class SessionRecorder():
+    """
+    Records the request lines of every client connection to a file
+    Safe to use from multiple server threads
+    """
+    logger = None
+
+    def __init__(self, filename):
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.filename = filename
+        self.lock = Lock()
+        self.connections = 0
+        self.records = 0
+        self.last_time = monotonic()
+        self.file = _open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.logger.info('Recording sessions to %s', filename)
+
+    def new_connection(self):
+        """ Return the number used to record a new connection """
+        with self.lock:
+            self.connections = (self.connections + 1) & 0xFFFF
+            return self.connections
+
+    def _write(self, connection, lines):
+        """ Write the lines, the caller must hold the lock """
+        if self.file is None:
+            return
+        now = monotonic()
+        delta = min(int((now - self.last_time) * 1000000), 0xFFFFFFFF)
+        self.last_time = now
+        data = list()
+        for line in lines:
+            data.append(RECORD.pack(delta, connection, len(line)))
+            data.append(line)
+            # All the lines of a block are received at the same time
+            delta = 0
+        self.file.write(b''.join(data))
+
+    def record(self, connection, lines):
+        """ Record a block of request lines received at the same time """
+        lines = [line.strip()[:0xFFFF] for line in lines]
+        lines = [line for line in lines if line]
+        if lines:
+            with self.lock:
+                self._write(connection, lines)
+                self.records += len(lines)
+
+    def connection_closed(self, connection):
+        """ Record the connection closing """
+        with self.lock:
+            self._write(connection, [b''])
+
+    def close(self):
+        """ Close the recording file """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.logger.info('Recorded %d requests from %d connections to %s',
+                                 self.records, self.connections, self.filename)
+
+
+def read_session(filename):
+    """
+    Read a recording, yields a tuple(time, connection, line) for each record
+    The time is in seconds from the start of the recording and the line is
+    empty when the connection closed
+    Raises ValueError if the file is not a recording
+    """
+    with _open(filename, 'rb') as recording:
+        if recording.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a session recording'.format(filename))
+        timestamp = 0
+        while True:
+            header = recording.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            delta, connection, length = RECORD.unpack(header)
+            timestamp += delta
+            yield timestamp / 1000000, connection, recording.read(length)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+replay
+This module contains the client for replaying recorded sessions to a
+running hueboblightd server and reporting how the server coped with them.
+
+Record a session with: hueboblightd --record movie.rec.gz
+Replay it with: huebobreplay --speed 4 movie.rec.gz
+
+Each recorded connection is replayed on its own connection, so replaying
+a recording of several clients needs the server in asyncio mode.
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import logging
+import argparse
+import select
+import socket
+from collections import Counter
+from time import perf_counter, process_time, sleep
+from HueBobLightd.logger import init_logger
+from HueBobLightd.recorder import read_session
+from pkg_resources import get_distribution, DistributionNotFound
+
+try:
+    __version__ = get_distribution(__name__.split('.')[0]).version
+except DistributionNotFound:
+    # package is not installed
+    __version__ = 'dev'
+
+
+def get_stats(address):
+    """ Return the server statistics as a dictionary using a get stats request """
+    with socket.create_connection(address, timeout=10) as stats:
+        stats.sendall(b'get stats\n')
+        response = b''
+        while not response.endswith(b'\n'):
+            data = stats.recv(1000)
+            if not data:
+                break
+            response += data
+    parts = response.split()
+    if not parts or parts[0] != b'stats':
+        raise ValueError('Unexpected stats response: {!r}'.format(response))
+    return {parts[i].decode(): float(parts[i + 1]) for i in range(1, len(parts) - 1, 2)}
+
+
+def drain(connections):
+    """ Read and throw away any responses so the server never blocks on us """
+    readable, _, _ = select.select(list(connections.values()), [], [], 0)
+    for conn in readable:
+        conn.recv(65536)
+
+
+def replay(address, filename, speed):
+    """
+    Send the recorded requests to the server
+    A speed of 0 sends them as fast as possible, otherwise the recorded
+    timing is divided by the speed
+    Returns a Counter of what was sent and the wall clock time taken
+    """
+    logger = logging.getLogger('Replay')
+    sent = Counter()
+    connections = dict()
+    block = list()
+    block_key = None
+    start = perf_counter()
+
+    def send_block():
+        """ Send the lines received together in one write """
+        conn_id = block_key[1]
+        if conn_id not in connections:
+            connections[conn_id] = socket.create_connection(address)
+            sent['connections'] += 1
+        connections[conn_id].sendall(b''.join(block))
+        sent['lines'] += len(block)
+        sent['blocks'] += 1
+
+    for timestamp, conn_id, line in read_session(filename):
+        if block and (timestamp, conn_id) != block_key:
+            send_block()
+            block.clear()
+            drain(connections)
+        if speed:
+            delay = start + timestamp / speed - perf_counter()
+            if delay > 0:
+                sleep(delay)
+        if line:
+            block_key = (timestamp, conn_id)
+            block.append(line + b'\n')
+        elif conn_id in connections:
+            # The recorded connection closed
+            if block:
+                send_block()
+                block.clear()
+            connections.pop(conn_id).close()
+    if block:
+        send_block()
+    for conn in connections.values():
+        conn.close()
+    elapsed = perf_counter() - start
+    logger.debug('Replayed %d lines', sent['lines'])
+    return sent, elapsed
+
+
+def main():
+    """
+    Replay a recorded session and report the client and server statistics
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording', type=str,
+                        help='session recording made with hueboblightd --record')
+    parser.add_argument('--server', type=str, default=socket.gethostname(),
+                        help='IPv4 address of boblightd server')
+    parser.add_argument('--port', type=int, default=19333,
+                        help='port of boblightd server')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, 1 is real time, 0 is as fast as possible')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds to wait for the server to finish before the stats')
+    parser.add_argument('--debug', default=False,
+                        action='store_true',
+                        help='turn on debug logging information')
+    parser.add_argument('--version', action='version',
+                        version=__version__)
+    args = parser.parse_args()
+
+    # Initialise the logger
+    init_logger('huebobreplay.log', args.debug)
+    logger = logging.getLogger('Replay')
+
+    address = (args.server, args.port)
+    logger.info('Replaying %s to %r at speed %s', args.recording, address,
+                args.speed or 'max')
+    before = get_stats(address)
+    cpu_start = process_time()
+    sent, elapsed = replay(address, args.recording, args.speed)
+    cpu = process_time() - cpu_start
+    sleep(args.settle)
+    after = get_stats(address)
+    server = {name: after[name] - before.get(name, 0) for name in after}
+
+    logger.info('Client: %d lines in %d blocks on %d connections in %.3fs: '
+                '%.0f lines/sec, cpu %.3fs', sent['lines'], sent['blocks'],
+                sent['connections'], elapsed, sent['lines'] / elapsed, cpu)
+    logger.info('Server: %d lines, %d rgb, %d coalesced, %d syncs',
+                server['lines'], server['rgb'], server['coalesced'], server['syncs'])
+    logger.info('Server: %d light updates sent, %d failed, %d suppressed',
+                server['puts'], server['failed'], server.get('suppressed', 0))
+    if server['cpu'] > 0:
+        logger.info('Server: cpu %.3fs, %.0f lines per cpu second',
+                    server['cpu'], server['lines'] / server['cpu'])
+    else:
+        logger.info('Server: cpu %.3fs', server['cpu'])
+
+    return
+
+
+# When running as a script we should call main
+if __name__ == '__main__':
+    main()
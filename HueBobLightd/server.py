@@ -7,14 +7,412 @@ This module contains main daemon for the bobhuelightd server
 __author__ = "David Dix"
 __copyright__ = "Copyright 2017, David Dix"
 
+import asyncio
 import logging
 import socketserver
+from collections import Counter
+from threading import Event
+from time import process_time, monotonic
+from HueBobLightd.logger import LogSampler
+from HueBobLightd.frames import FrameLayer
 
-class BobHueRequestHandler(socketserver.StreamRequestHandler):
+
+class BoblightProtocol():
+    """
+    Boblight protocol command processing
+    Shared by the socketserver request handler and the asyncio connection
+    so that both server modes have the same command semantics.
+    The subclass must provide logger, server and client_address members
+
+    Requests are processed as bytes, they are split once and dispatched
+    through the command tables at the end of the class.
+    Light lookups are cached per connection until the updater's light
+    registry changes e.g. the lights are rebuilt on a SIGHUP.
+    The DEBUG level is checked once per block of requests and the messages
+    logged for every frame are rate limited by a LogSampler.
+    Each connection writes its colors to its own FrameLayer, the updater's
+    FrameCompositor decides which client's colors each light shows.
+    Requests are counted per block, then added to the connection's counters
+    and to the updater's counters for the whole server. If the server has a
+    SessionRecorder every request line is recorded.
+    """
+    # Maximum number of bytes read from the socket in one go
+    read_size = 65536
+
+    def init_protocol(self):
+        """ Initialise the per connection state, called before handling starts """
+        self.light_cache = dict()
+        self.light_cache_generation = None
+        self.rx_buffer = b''
+        self.received = 0.0
+        self.pending_rgb = dict()
+        self.counters = Counter()
+        self.block_counters = Counter()
+        self.debug = False
+        self.log_sampler = LogSampler()
+        self.layer = None
+        self.recorder = None
+        self.record_id = None
+
+    def connection_made(self):
+        """ Add the client's frame layer to the updater """
+        self.layer = FrameLayer('{}:{}'.format(*self.client_address[:2]))
+        self.server.data.frames.add_layer(self.layer)
+        self.recorder = getattr(self.server, 'recorder', None)
+        if self.recorder is not None:
+            self.record_id = self.recorder.new_connection()
+
+    def connection_lost(self):
+        """ Remove the client's frame layer, another client takes over its lights """
+        if self.layer is not None:
+            self.server.data.frames.remove_layer(self.layer)
+        if self.recorder is not None:
+            self.recorder.connection_closed(self.record_id)
+
+    def process_data(self, data):
+        """
+        Process a block of bytes read from the socket
+        The block is split into requests and any incomplete request is kept
+        for the next block. rgb requests are coalesced, only the last rgb
+        received for each light is applied, once per sync and once at the
+        end of the block. The colors are stamped with the time the block
+        was received, for tracing their latency to the bridge.
+        Returns the responses as bytes, or None if there are none
+        """
+        self.debug = self.logger.isEnabledFor(logging.DEBUG)
+        self.received = monotonic()
+        if data:
+            lines = (self.rx_buffer + data).split(b'\n')
+            self.rx_buffer = lines.pop()
+        else:
+            # The socket has closed, process any unterminated request
+            lines = [self.rx_buffer] if self.rx_buffer else []
+            self.rx_buffer = b''
+        if self.recorder is not None:
+            self.recorder.record(self.record_id, lines)
+        responses = list()
+        for request in lines:
+            response = self.process_request(request)
+            if response:
+                responses.append(response)
+        self._apply_rgb()
+        counters = self.block_counters
+        counters['lines'] += len(lines)
+        self.counters.update(counters)
+        self.server.data.counters.update(counters)
+        counters.clear()
+        return b''.join(responses) if responses else None
+
+    def process_request(self, request):
+        """
+        Process the incoming request, a single line of bytes
+        Returns the response as bytes or None if there is no response
+        """
+        message_parts = request.split()
+        if not message_parts:
+            return None
+        handler = self.commands.get(message_parts[0])
+        if handler is None:
+            # If we get here then we do not recognise the command
+            self.logger.info('Unrecognised command: %r', message_parts)
+            self.block_counters['unknown'] += 1
+            return None
+        self.block_counters[self.command_names[message_parts[0]]] += 1
+        try:
+            return handler(self, message_parts)
+        except (IndexError, ValueError):
+            self.logger.info('Malformed command: %r', message_parts)
+            self.block_counters['malformed'] += 1
+            return None
+
+    def _dispatch(self, table, subcmd, message_parts):
+        """ Call the handler for a sub-command from one of the command tables """
+        handler = table.get(subcmd)
+        if handler is None:
+            self.logger.info('Unrecognised command: %r', message_parts)
+            return None
+        return handler(self, message_parts)
+
+    def _find_slot(self, lightid):
+        """ Return the frame slot for a boblight light id (b'name:id') or None """
+        registry = self.server.data.registry
+        # Read the generation before the lookup so a light removed while we
+        # look it up is only cached against the old generation
+        generation = registry.generation
+        if generation != self.light_cache_generation:
+            self.light_cache = dict()
+            self.light_cache_generation = generation
+            self.pending_rgb.clear()
+            self.layer.clear()
+        try:
+            return self.light_cache[lightid]
+        except KeyError:
+            slot = self.light_cache[lightid] = registry.slot(lightid)
+            return slot
+
+    def _find_light(self, lightid):
+        """ Return the light for a boblight light id (b'name:id') or None """
+        return self.server.data.registry.get(lightid)
+
+    def _hello(self, message_parts):
+        """
+        This is the connection command.
+        Hello command should return 'hello' from the server
+        """
+        #pylint: disable=W0613
+        self.logger.info('hello')
+        return b'hello\n'
+
+    def _ping(self, message_parts):
+        """
+        This command checks if this client is currently using
+        any of the lights.
+        Return the number of lights in use by this client
+        """
+        #pylint: disable=W0613
+        data = self.server.data
+        usage = data.frames.usage(self.layer, data.registry.slots)
+        self.logger.info('ping: %d', usage)
+        return 'ping {:d}\n'.format(usage).encode()
+
+    def _get(self, message_parts):
+        """
+        This command is used to get information about the server protocol
+        and it's configured lights
+        """
+        return self._dispatch(self.get_commands, message_parts[1], message_parts)
+
+    def _get_version(self, message_parts):
+        """
+        Returns the protocol version used by the server,
+        current version is 5.
+        """
+        #pylint: disable=W0613
+        self.logger.info('version')
+        return b'version 5\n'
+
+    def _get_lights(self, message_parts):
+        """
+        Returns the lights declared in server configuration.
+        First line is the number of lights, then each line
+        corresponds to one light and its scanning parameters.
+        To ope with multiple bridges we combine the name & hue_id
+        to have a unique ame for MrMC e.g.
+
+        lights 1
+        light name:id scan top, bottom, left, right
+        """
+        #pylint: disable=W0613
+        self.logger.info('lights')
+        lights = self.server.data.lights
+        response = ['lights {:d}'.format(len(lights))]
+        for light in lights:
+            lightdata = (
+                'light {}:{} '
+                'scan {:d} {:d} {:d} {:d}'.format(light.name,
+                                                  light.hue_id,
+                                                  *light.scanarea)
+            )
+            response.append(lightdata)
+            self.logger.debug('Response: %s', lightdata)
+        # Join all the responses into a single string seperated by
+        # carriage returs and terminated in a carriage return
+        return ('\n'.join(response) + '\n').encode()
+
+    def _get_stats(self, message_parts):
+        """
+        Returns the server statistics on a single line, this command
+        is not part of the boblight protocol e.g.
+        stats lines 2200 rgb 2000 coalesced 10 syncs 200 puts 150 failed 0
+            suppressed 40 cpu 1.234
+        """
+        #pylint: disable=W0613
+        data = self.server.data
+        counters = Counter(data.counters)
+        for light in data.lights:
+            counters['puts'] += light.stats['puts']
+            counters['failed'] += light.stats['failed']
+            counters['suppressed'] += light.stats['suppressed']
+        stats = ['stats']
+        for name in ('lines', 'rgb', 'coalesced', 'syncs', 'puts', 'failed', 'suppressed'):
+            stats.append('{} {:d}'.format(name, counters[name]))
+        stats.append('cpu {:.3f}'.format(process_time()))
+        return (' '.join(stats) + '\n').encode()
+
+    def _set(self, message_parts):
+        """
+        This command is used to change lights and client parameters.
+        None of them return any information
+        """
+        return self._dispatch(self.set_commands, message_parts[1], message_parts)
+
+    def _set_priority(self, message_parts):
+        """
+        Change the client priority, from 0 to 255, default is 128.
+        The highest priority is the lowest number
+        """
+        priority = min(max(int(message_parts[2]), 0), 255)
+        self.logger.info('priority: %d', priority)
+        self.layer.priority = priority
+
+    def _set_light(self, message_parts):
+        """
+        Commands to control what to do with the lights
+        """
+        return self._dispatch(self.light_commands, message_parts[3], message_parts)
+
+    def _light_rgb(self, message_parts):
+        """
+        Change the color of a light to the given rgb value.
+        Values are floats: R, G, B  e.g.
+        set light right rgb 0.000000 0.000000 0.000000
+        Each value is only parsed once, straight from the bytes
+        """
+        if len(message_parts) == 7:
+            slot = self._find_slot(message_parts[2])
+            if slot is not None and slot not in self.layer.unused:
+                # Keep only the last rgb for each light until the
+                # frame is applied, the values are parsed then
+                if slot in self.pending_rgb:
+                    self.block_counters['coalesced'] += 1
+                self.pending_rgb[slot] = message_parts
+                self.block_counters['rgb'] += 1
+
+    def _apply_rgb(self):
+        """
+        Set the color of every light with a pending rgb request in the
+        client's frame layer, the frame is published by the next sync
+        Each rgb value is only parsed once, straight from the bytes
+        """
+        if not self.pending_rgb:
+            return
+        layer = self.layer
+        received = self.received
+        for slot, message_parts in self.pending_rgb.items():
+            try:
+                red = float(message_parts[4])
+                green = float(message_parts[5])
+                blue = float(message_parts[6])
+            except ValueError:
+                self.logger.info('Malformed command: %r', message_parts)
+                continue
+            if self.debug and self.log_sampler.sample(slot):
+                self.logger.debug('light %s rgb: %f, %f, %f (%d skipped)',
+                                  message_parts[2], red, green, blue,
+                                  self.log_sampler.skipped(slot))
+            layer.set_color(slot, red, green, blue, received)
+        self.pending_rgb.clear()
+
+    def _light_speed(self, message_parts):
+        """
+        Change the transition speed of one light.
+        Value is between 0.0 and 100.0.
+        100 means immediate changes.
+        NOTE: Hue lights are not fast, but I like the idea of
+              this feature so:
+                100 = 100ms (transitiontime = 1)
+                50 = 500ms
+                1 = 1s (transitiontime = 10)
+        """
+        speed = int(float(message_parts[4]))
+        t_time = 10 - int((speed - 1) / 10)
+        self.logger.info('light %s speed: %d (%3dms)',
+                         message_parts[2], speed, t_time * 100)
+        light = self._find_light(message_parts[2])
+        if light:
+            light.transition = t_time
+
+    def _light_interpolation(self, message_parts):
+        """
+        Enable or disable color interpolation between 2 steps.
+        Value is a boolean ("0"/"1" or "true"/"false")
+
+        NOTE: Hue lights always interpolate between the colors they are
+              sent, so this turns on the light's color filter which
+              smooths out the small changes between steps
+        """
+        interpolate = message_parts[4].lower() in (b'1', b'true')
+        self.logger.info('light %s interpolation: %r', message_parts[2], interpolate)
+        light = self._find_light(message_parts[2])
+        if light:
+            light.filter.set_interpolation(interpolate, light.smoothing)
+
+    def _light_use(self, message_parts):
+        """
+        Declare whether a light is used.
+        By default all lights are used.
+        Any color change request for an unused light
+        will be ignored.
+        """
+        use = message_parts[4].lower() in (b'1', b'true')
+        self.logger.info('light %s use: %r', message_parts[2], use)
+        slot = self._find_slot(message_parts[2])
+        if slot is not None:
+            self.pending_rgb.pop(slot, None)
+            self.layer.set_use(slot, use)
+
+    def _light_singlechange(self, message_parts):
+        """
+        The next color is shown without interpolation
+        NOTE: Hue lights will always transition over time, so this only
+              skips the color filter
+        """
+        self.logger.info('light %s singlechange', message_parts[2])
+        light = self._find_light(message_parts[2])
+        if light:
+            light.filter.single_change = True
+
+    def _sync(self, message_parts):
+        """
+        Sent to indicate that the lights should now be updated
+        In my implementation I just tell the LightUpdater object
+        to perform an update an leave it up to that object to figure
+        out how.
+        The frame is published as a whole so the lights never get half of
+        one frame and half of the next.
+        """
+        #pylint: disable=W0613
+        if self.debug and self.log_sampler.sample('sync'):
+            self.logger.debug('sync (%d skipped)', self.log_sampler.skipped('sync'))
+        self._apply_rgb()
+        self.layer.publish()
+        self.block_counters['syncs'] += 1
+        self.server.data.update()
+
+    # Command tables, built once when the class is created
+    commands = {
+        b'hello' : _hello,
+        b'ping' : _ping,
+        b'get' : _get,
+        b'set' : _set,
+        b'sync' : _sync,
+    }
+    # The names the commands are counted under
+    command_names = {command: command.decode() for command in commands}
+    get_commands = {
+        b'version' : _get_version,
+        b'lights' : _get_lights,
+        b'stats' : _get_stats,
+    }
+    set_commands = {
+        b'priority' : _set_priority,
+        b'light' : _set_light,
+    }
+    light_commands = {
+        b'rgb' : _light_rgb,
+        b'speed' : _light_speed,
+        b'interpolation' : _light_interpolation,
+        b'use' : _light_use,
+        b'singlechange' : _light_singlechange,
+    }
+
+
+class BobHueRequestHandler(BoblightProtocol, socketserver.StreamRequestHandler):
     """ My socket request handler """
     def __init__(self, request, client_address, server):
         self.logger = logging.getLogger(type(self).__name__)
         # self.logger.debug('__init__')
+        self.init_protocol()
         super().__init__(request, client_address, server)
         return
 
@@ -24,190 +422,88 @@ class BobHueRequestHandler(socketserver.StreamRequestHandler):
 
     def handle(self):
         self.logger.debug('handle')
+        self.connection_made()
         try:
             # Keep reading requests until the client closes the socket
             while True:
-                request = self.rfile.readline()
-                if not request:
-                    break
-                # Decode the request into a string and strip unwanted whitespace
-                request = request.decode().strip()
-                self.logger.debug('RX [%s]: %s', self.client_address[0], request)
-                # Process the request
-                response = self.process_request(request)
+                # Take everything the client has sent so far in one go
+                data = self.request.recv(self.read_size)
+                # Process the requests
+                response = self.process_data(data)
+                if self.debug and self.log_sampler.sample('rx'):
+                    self.logger.debug('RX [%s]: %r (%d skipped)', self.client_address[0],
+                                      data, self.log_sampler.skipped('rx'))
 
                 if response:
                     # Send the response
-                    self.logger.debug('TX [%s]: %s', self.client_address[0], response)
-                    self.wfile.write(response.encode())
+                    self.logger.debug('TX [%s]: %r', self.client_address[0], response)
+                    self.wfile.write(response)
+                if not data:
+                    break
         except Exception as exc:
             self.logger.error('ER [%s]: %r', self.client_address[0], exc)
             raise
-        self.logger.debug('DC [%s]: disconnected', self.client_address[0])
-
-    def process_request(self, request):
-        """ Process the incoming request """
-        #pylint: disable=R0912
-        response = list()
-        lights = self.server.data.lights
-
-        # First we check the message format
-        message_parts = request.split()
-        cmd = message_parts[0]
-        if cmd == 'hello':
-            """
-            This is the connection command.
-            Hello command should return 'hello' from the server
-            """
-            self.logger.info('hello')
-            response.append('hello')
-        elif cmd == 'ping':
-            """
-            This command checks if this client is currently using
-            any of the lights.
-            Return the number of lights in use by this client
-            """
-            self.logger.info('ping')
-            response.append('ping 1')
-        elif cmd == 'get':
-            """
-            This command is used to get information about the server protocol
-            and it's configured lights
-            """
-            subcmd = message_parts[1]
-            if subcmd == 'version':
-                """
-                Returns the protocol version used by the server,
-                current version is 5.
-                """
-                self.logger.info('version')
-                response.append('version 5')
-            elif subcmd == 'lights':
-                """
-                Returns the lights declared in server configuration.
-                First line is the number of lights, then each line
-                corresponds to one light and its scanning parameters.
-                To ope with multiple bridges we combine the name & hue_id
-                to have a unique ame for MrMC e.g.
-
-                lights 1
-                light name:id scan top, bottom, left, right
-                """
-                self.logger.info('lights')
-                response.append('lights {:d}'.format(len(lights)))
-                for light in lights:
-                    lightdata = (
-                        'light {}:{} '
-                        'scan {:d} {:d} {:d} {:d}'.format(light.name,
-                                                          light.hue_id,
-                                                          *light.scanarea)
-                    )
-                    response.append(lightdata)
-                    self.logger.debug('Response: %s', lightdata)
-        elif cmd == 'set':
-            """
-            This command is used to change lights and client parameters.
-            None of them return any information
-            """
-            subcmd = message_parts[1]
-            if subcmd == 'priority':
-                """
-                Change the client priority, from 0 to 255, default is 128.
-                The highest priority is the lowest number
-                """
-                self.logger.info('priority: %d', int(message_parts[2]))
-            if subcmd == 'light':
-                """
-                Commands to control what to do with the lights
-                """
-                lightid = tuple(message_parts[2].split(':'))
-                lightcmd = message_parts[3]
-                if lightcmd == 'rgb':
-                    """
-                    Change the color of a light to the given rgb value.
-                    Values are floats: R, G, B  e.g.
-                    set light right rgb 0.000000 0.000000 0.000000
-                    """
-                    self.logger.debug('light %s rgb: %f, %f, %f', lightid,
-                                      float(message_parts[4]),
-                                      float(message_parts[5]),
-                                      float(message_parts[6]))
-                    if len(message_parts) == 7:
-                        light = next((x for x in lights if x.hue_id == lightid[1] and x.name == lightid[0]), None)
-                        if light:
-                            light.set_color(float(message_parts[4]),  # red
-                                            float(message_parts[5]),  # green
-                                            float(message_parts[6]))  # blue
-                elif lightcmd == 'speed':
-                    """
-                    Change the transition speed of one light.
-                    Value is between 0.0 and 100.0.
-                    100 means immediate changes.
-                    NOTE: Hue lights are not fast, but I like the idea of
-                          this feature so:
-                            100 = 100ms (transitiontime = 1)
-                            50 = 500ms
-                            1 = 1s (transitiontime = 10)
-                    """
-                    speed = int(float(message_parts[4]))
-                    t_time = 10 - int((speed - 1) / 10)
-                    self.logger.info('light %s speed: %d (%3dms)', lightid, speed, t_time * 100)
-                    light = next((x for x in lights if x.hue_id == lightid[1] and x.name == lightid[0]), None)
-                    if light:
-                        light.transition = t_time
-
-
-                elif lightcmd == 'interpolation':
-                    """
-                    Enable or disable color interpolation between 2 steps.
-                    Value is a boolean ("0"/"1" or "true"/"false")
-
-                    NOTE: I ignore this command as Hue lights will always
-                          interpolate
-                    """
-                    self.logger.info('light %s interpolation: %d', lightid,
-                                     int(message_parts[4]))
-                elif lightcmd == 'use':
-                    """
-                    Declare whether a light is used.
-                    By default all lights are used.
-                    Any color change request for an unused light
-                    will be ignored.
-                    NOTE: I never get one of these from MrMC so not implemented
-                    """
-                    self.logger.info('light %s use: %d', lightid,
-                                     int(message_parts[4]))
-                elif lightcmd == 'singlechange':
-                    """
-                    NOTE: I ignore this command as Hue lights will always
-                          transition over time
-                    """
-                    self.logger.info('light %s singlechange', lightid)
-        elif cmd == 'sync':
-            """
-            Sent to indicate that the lights should now be updated
-            In my implementation I just tell the LightUpdater object
-            to perform an update an leave it up to that object to figure
-            out how.
-            """
-            self.logger.debug('sync')
-            self.server.data.update()
-        else:
-            # If we get here then we do not recognise the command
-            self.logger.info('Unrecognised command: %r', message_parts)
-
-        # Join all the responses into a single string seperated by
-        # carriage returs and terminated in a carriage return
-        return '\n'.join(response) + '\n' if response else None
+        finally:
+            self.connection_lost()
+        self.logger.debug('DC [%s]: disconnected %r', self.client_address[0],
+                          dict(self.counters))
 
     # def finish(self):
     #     self.logger.debug('finish')
     #     return super()
 
 
+class BobHueAsyncConnection(BoblightProtocol):
+    """
+    A single client connection of the asyncio server
+    Holds the per connection state and runs the same command processing
+    as the socketserver request handler
+    """
+    def __init__(self, reader, writer, server):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.client_address = writer.get_extra_info('peername')
+        self.init_protocol()
+
+    async def handle(self):
+        """ Keep reading requests until the client closes the socket """
+        self.logger.debug('handle')
+        self.connection_made()
+        try:
+            while True:
+                # Take everything the client has sent so far in one go
+                data = await self.reader.read(self.read_size)
+                # Process the requests
+                response = self.process_data(data)
+                if self.debug and self.log_sampler.sample('rx'):
+                    self.logger.debug('RX [%s]: %r (%d skipped)', self.client_address[0],
+                                      data, self.log_sampler.skipped('rx'))
+
+                if response:
+                    # Send the response, a client that is not reading only
+                    # stalls its own coroutine
+                    self.logger.debug('TX [%s]: %r', self.client_address[0], response)
+                    self.writer.write(response)
+                    await self.writer.drain()
+                if not data:
+                    break
+        except asyncio.CancelledError:
+            self.logger.debug('CN [%s]: cancelled', self.client_address[0])
+        except Exception as exc:
+            self.logger.error('ER [%s]: %r', self.client_address[0], exc)
+        finally:
+            self.connection_lost()
+            self.writer.close()
+        self.logger.debug('DC [%s]: disconnected %r', self.client_address[0],
+                          dict(self.counters))
+
+
 class BobHueServer(socketserver.TCPServer):
     """ Server listening for LightEffects clients """
-    pass
+    data = None
+    recorder = None
     # def __init__(self, server_address, handler_class):
     #     self.logger = logging.getLogger('BobHueServer')
     #     self.logger.debug('__init__')
@@ -264,3 +560,61 @@ class BobHueServer(socketserver.TCPServer):
     # def shutdown(self):
     #     self.logger.debug('shutdown()')
     #     return socketserver.TCPServer.shutdown(self)
+
+
+class BobHueAsyncServer():
+    """
+    Server listening for LightEffects clients on an asyncio event loop
+    Every client is served by its own coroutine, so any number of clients
+    can be connected at once and a stalled client does not block the others.
+    Provides the serve_forever, shutdown & server_close methods of
+    BobHueServer so the daemon can run either server.
+    """
+    def __init__(self, server_address, connection_class=BobHueAsyncConnection):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.server_address = server_address
+        self.connection_class = connection_class
+        self.data = None
+        self.recorder = None
+        self.connections = dict()
+        self.stopped = Event()
+        self.stopped.set()
+        self.loop = asyncio.new_event_loop()
+        # Bind the socket now, the same as TCPServer does
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._client_connected, *server_address))
+        self.server_address = self.server.sockets[0].getsockname()[:2]
+
+    def _client_connected(self, reader, writer):
+        """ Start a coroutine to serve the new client connection """
+        connection = self.connection_class(reader, writer, self)
+        task = self.loop.create_task(connection.handle())
+        self.connections[connection] = task
+        task.add_done_callback(lambda _: self.connections.pop(connection, None))
+        self.logger.debug('Clients connected: %d', len(self.connections))
+
+    def serve_forever(self):
+        """ Run the event loop until shutdown is called """
+        asyncio.set_event_loop(self.loop)
+        self.stopped.clear()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        """ Stop the event loop and wait for serve_forever to exit """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.stopped.wait()
+
+    def server_close(self):
+        """ Close the listening socket and all the client connections """
+        self.server.close()
+        tasks = list(self.connections.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+simulator
+This module contains a simulated hue bridge for testing and benchmarking
+hueboblightd without real lights. It answers the Hue v1 API requests the
+daemon uses, for lights and groups, over keep-alive HTTP/1.1 and records
+every state change it is sent.
+
+The bridge can be made slow, busy or unreliable:
+    latency: seconds taken to answer each request
+    rate: requests per second handled, the requests over the rate are
+        answered with the 901 busy error like a real bridge
+    error rate: share of the state changes answered with one of the errors
+
+Run a bridge with 3 lights on port 8080:
+    huebobsim --port 8080 --lights 3 --latency 0.05 --rate 10
+
+then set the bridge "address" to "<host>:8080" in hueboblightd.conf
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import re
+import copy
+import json
+import logging
+import argparse
+from collections import namedtuple
+from random import Random
+from threading import Lock
+from time import sleep, monotonic
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from HueBobLightd.logger import init_logger
+from HueBobLightd.lightupdate import TokenBucket
+from pkg_resources import get_distribution, DistributionNotFound
+
+try:
+    __version__ = get_distribution(__name__.split('.')[0]).version
+except DistributionNotFound:
+    # package is not installed
+    __version__ = 'dev'
+
+# A state change the bridge accepted, time is monotonic
+StateChange = namedtuple('StateChange', 'time, address, state')
+
+# Descriptions of the errors the bridge can be made to answer with
+ERROR_DESCRIPTIONS = {
+    1 : 'unauthorized user',
+    2 : 'body contains invalid json',
+    3 : 'resource, {}, not available',
+    4 : 'method, {}, not available for resource, {}',
+    6 : 'parameter, {}, not available',
+    201 : 'parameter, {}, is not modifiable. Device is set to off.',
+    901 : 'Internal error, 404'
+}
+
+# Light state fields that can be changed
+STATE_FIELDS = ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect', 'transitiontime')
+
+# /api/<username>/<resource...>
+API_PATH = re.compile(r'^/api/(?P<username>[^/]+)(?P<resource>(/[^/]+)*)/?$')
+
+
+def hue_error(error_type, address, *args):
+    """ Return a hue error result """
+    description = ERROR_DESCRIPTIONS.get(error_type, 'error')
+    return {'error': {'type': error_type, 'address': address,
+                      'description': description.format(*args)}}
+
+
+def new_light(light_id):
+    """ Return the attributes of an extended color light that is off """
+    return {
+        'state': {
+            'on': False, 'bri': 254, 'hue': 8418, 'sat': 140, 'effect': 'none',
+            'xy': [0.4573, 0.41], 'ct': 366, 'alert': 'none', 'colormode': 'xy',
+            'reachable': True
+        },
+        'type': 'Extended color light',
+        'name': 'Hue color lamp {}'.format(light_id),
+        'modelid': 'LCT007',
+        'manufacturername': 'Philips',
+        'uniqueid': '00:17:88:01:00:00:00:{:02x}-0b'.format(int(light_id)),
+        'swversion': '5.105.0.21169'
+    }
+
+
+class BridgeSimulator(ThreadingMixIn, HTTPServer):
+    """
+    A simulated hue bridge
+    Each connection is answered by its own thread, the lights and the
+    record of changes are guarded by a lock
+    Attributes:
+        username: the only user the bridge authorises
+        lights: the light attributes by id
+        groups: the group attributes by id, group 0 is all the lights
+        latency: seconds taken to answer each request
+        error_rate: share of the state changes answered with an error
+        errors: hue error types picked from for the injected errors
+        changes: StateChange for every state change accepted
+        counters: requests by result
+    """
+    daemon_threads = True
+    logger = None
+
+    def __init__(self, server_address, username='newdeveloper', lights=3, latency=0.0,
+                 rate=0.0, error_rate=0.0, errors=(901,), seed=None,
+                 handler_class=None):
+        #pylint: disable=R0913
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.username = username
+        self.lights = {str(light_id): new_light(light_id) for light_id in range(1, lights + 1)}
+        self.groups = {
+            '1': {'name': 'All lights', 'type': 'LightGroup', 'lights': sorted(self.lights),
+                  'action': dict(new_light(1)['state'])}
+        }
+        self.latency = latency
+        self.bucket = TokenBucket(rate, max(1, int(rate))) if rate else None
+        self.error_rate = error_rate
+        self.errors = tuple(errors)
+        self.random = Random(seed)
+        self.changes = list()
+        self.counters = dict()
+        self.lock = Lock()
+        self.record_file = None
+        super().__init__(server_address, handler_class or BridgeRequestHandler)
+
+    def record_to(self, filename):
+        """ Also write every state change to a file as a line of JSON """
+        self.record_file = open(filename, 'w')
+
+    def server_close(self):
+        """ Close the socket and the record file """
+        super().server_close()
+        if self.record_file is not None:
+            self.record_file.close()
+            self.record_file = None
+
+    def count(self, result):
+        """ Count a request's result, called with the lock held """
+        self.counters[result] = self.counters.get(result, 0) + 1
+
+    def handle_api(self, method, path, body):
+        """
+        Answer a request, returns the response as decoded JSON
+        The latency is taken before the state is changed, as the bridge
+        changes the light when it answers
+        """
+        if self.latency:
+            sleep(self.latency)
+        match = API_PATH.match(path.split('?')[0])
+        with self.lock:
+            if match is None:
+                self.count('unknown')
+                return [hue_error(4, path, method, path)]
+            if match.group('username') != self.username:
+                self.count('unauthorized')
+                return [hue_error(1, '/')]
+            if self.bucket is not None:
+                if self.bucket.delay():
+                    self.count('busy')
+                    return [hue_error(901, match.group('resource') or '/')]
+                self.bucket.consume()
+            parts = [part for part in match.group('resource').split('/') if part]
+            if method == 'GET':
+                return self.get(parts)
+            if method == 'PUT':
+                try:
+                    state = json.loads(body.decode() if body else '')
+                except ValueError:
+                    state = None
+                if not isinstance(state, dict):
+                    self.count('invalid')
+                    return [hue_error(2, '/' + '/'.join(parts))]
+                return self.put(parts, state)
+            self.count('unknown')
+            return [hue_error(4, path, method, path)]
+
+    def get(self, parts):
+        """ Answer a GET for the whole bridge, a collection or one item """
+        self.count('get')
+        everything = {
+            'lights': self.lights,
+            'groups': self.groups,
+            'config': {'name': 'Simulated bridge', 'apiversion': '1.16.0',
+                       'swversion': '1709131301', 'modelid': 'BSB002'}
+        }
+        result = everything
+        for index, part in enumerate(parts):
+            if index == 1 and parts[0] == 'groups' and part == '0':
+                # Like a real bridge group 0 is not listed with the groups
+                result = self.group_zero()
+                continue
+            if not isinstance(result, dict) or part not in result:
+                return [hue_error(3, '/' + '/'.join(parts), '/' + '/'.join(parts))]
+            result = result[part]
+        # A copy, as the answer is sent after the lock is released
+        return copy.deepcopy(result)
+
+    def group_zero(self):
+        """ Return the attributes of group 0, all the lights on the bridge """
+        lights = sorted(self.lights, key=int)
+        states = [self.lights[light]['state'] for light in lights]
+        action = {key: value for key, value in states[0].items() if key != 'reachable'} \
+            if states else dict()
+        return {
+            'name': 'Group 0',
+            'type': 'LightGroup',
+            'lights': lights,
+            'state': {'all_on': all(state['on'] for state in states),
+                      'any_on': any(state['on'] for state in states)},
+            'action': action
+        }
+
+    def put(self, parts, state):
+        """ Change the state of a light, or of all the lights in a group """
+        if len(parts) == 3 and parts[0] == 'lights' and parts[2] == 'state':
+            lights = [parts[1]] if parts[1] in self.lights else None
+        elif len(parts) == 3 and parts[0] == 'groups' and parts[2] == 'action':
+            if parts[1] == '0':
+                lights = sorted(self.lights)
+            else:
+                group = self.groups.get(parts[1])
+                lights = group['lights'] if group else None
+        else:
+            lights = None
+        address = '/' + '/'.join(parts)
+        if lights is None:
+            self.count('unknown')
+            return [hue_error(3, address, address)]
+        if self.error_rate and self.random.random() < self.error_rate:
+            error = self.random.choice(self.errors)
+            self.count('injected')
+            return [hue_error(error, address, next(iter(state), 'state'))]
+        self.count('put')
+        return self.change(lights, address, state)
+
+    def change(self, lights, address, state):
+        """
+        Apply the state to the lights and record it
+        Like a real bridge only on, alert and transitiontime can be sent to
+        a light that is off
+        """
+        results = list()
+        applied = dict()
+        turning_on = state.get('on')
+        for key, value in state.items():
+            field_address = '{}/{}'.format(address, key)
+            if key not in STATE_FIELDS:
+                results.append(hue_error(6, field_address, key))
+                continue
+            if key not in ('on', 'alert', 'transitiontime') and turning_on is not True \
+                    and not all(self.lights[light]['state']['on'] for light in lights):
+                results.append(hue_error(201, field_address, key))
+                continue
+            applied[key] = value
+            results.append({'success': {field_address: value}})
+        for light in lights:
+            light_state = self.lights[light]['state']
+            light_state.update({key: value for key, value in applied.items()
+                                if key != 'transitiontime'})
+            if 'xy' in applied:
+                light_state['colormode'] = 'xy'
+        if applied:
+            change = StateChange(monotonic(), address, applied)
+            self.changes.append(change)
+            if self.record_file is not None:
+                self.record_file.write(json.dumps({'time': change.time, 'address': address,
+                                                   'state': applied}) + '\n')
+        return results
+
+
+class BridgeRequestHandler(BaseHTTPRequestHandler):
+    """ Answers the requests to the BridgeSimulator with keep-alive """
+    protocol_version = 'HTTP/1.1'
+
+    def _answer(self, method):
+        """ Read the body, get the answer from the simulator and send it """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        response = json.dumps(self.server.handle_api(method, self.path, body)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        """ Answer a GET """
+        #pylint: disable=C0103
+        self._answer('GET')
+
+    def do_PUT(self):
+        """ Answer a PUT """
+        #pylint: disable=C0103
+        self._answer('PUT')
+
+    def do_POST(self):
+        """ Answer a POST with the bridge's method not available error """
+        #pylint: disable=C0103
+        self._answer('POST')
+
+    def do_DELETE(self):
+        """ Answer a DELETE with the bridge's method not available error """
+        #pylint: disable=C0103
+        self._answer('DELETE')
+
+    def log_message(self, format, *args):
+        """ Log the requests to the simulator's logger rather than stderr """
+        #pylint: disable=W0622
+        self.server.logger.debug(format, *args)
+
+
+def main():
+    """
+    Run a simulated hue bridge until interrupted
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', type=str, default='',
+                        help='IPv4 address to listen on, default all')
+    parser.add_argument('--port', type=int, default=80,
+                        help='port to listen on')
+    parser.add_argument('--username', type=str, default='newdeveloper',
+                        help='user name the bridge accepts')
+    parser.add_argument('--lights', type=int, default=3,
+                        help='number of lights on the bridge')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds taken to answer each request')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='requests per second handled before answering busy, 0 is no limit')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of the state changes answered with an error, 0 to 1')
+    parser.add_argument('--errors', type=int, nargs='+', default=[901],
+                        help='hue error types picked from for the errors')
+    parser.add_argument('--record', type=str, default=None,
+                        help='write every state change to this file as JSON lines')
+    parser.add_argument('--debug', default=False,
+                        action='store_true',
+                        help='turn on debug logging information')
+    parser.add_argument('--version', action='version',
+                        version=__version__)
+    args = parser.parse_args()
+
+    # Initialise the logger
+    init_logger('huebobsim.log', args.debug)
+    logger = logging.getLogger('Simulator')
+
+    bridge = BridgeSimulator((args.address, args.port), args.username, args.lights,
+                             args.latency, args.rate, args.error_rate, args.errors)
+    if args.record:
+        bridge.record_to(args.record)
+    logger.info('Simulated bridge with %d lights on port %d: latency %.3fs, rate %s, '
+                'errors %.0f%% of %r', args.lights, bridge.server_address[1], args.latency,
+                args.rate or 'unlimited', args.error_rate * 100, args.errors)
+    try:
+        bridge.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bridge.server_close()
+    logger.info('Requests: %r, state changes: %d', bridge.counters, len(bridge.changes))
+
+    return
+
+
+# When running as a script we should call main
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Transport
+This module contains an optional HTTP/1.1 client for the hue bridges built
+on asyncio streams. One event loop thread drives the connections to all
+the bridges and the requests to each bridge are pipelined on a couple of
+keep-alive connections. The bridge workers submit the light state PUTs
+without waiting for the answers, see HueLight.start_update
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import asyncio
+import logging
+import concurrent.futures
+from collections import deque
+from threading import Thread, Lock
+from time import monotonic
+
+
+class TransportError(Exception):
+    """ The connection to the bridge failed or was closed """
+
+
+class TransportTimeout(TransportError):
+    """ The bridge did not answer before the request's deadline """
+
+
+class StaleRequest(TransportTimeout):
+    """ The deadline passed before the request could be sent, so it was dropped """
+
+
+async def read_response(reader):
+    """
+    Read one HTTP/1.1 response from a stream
+    Returns (status, body, close), close is True when the bridge will not
+    answer any more requests on the connection
+    """
+    line = await reader.readline()
+    if not line:
+        raise EOFError('Connection closed by the bridge')
+    version, status = line.split(None, 2)[:2]
+    status = int(status)
+    close = version == b'HTTP/1.0'
+    length = None
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise EOFError('Connection closed in the response headers')
+        if line in (b'\r\n', b'\n'):
+            break
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'transfer-encoding':
+            chunked = value == b'chunked'
+        elif name == b'connection':
+            close = value == b'close'
+    if chunked:
+        chunks = list()
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                # Skip any trailers up to the blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif length is not None:
+        body = await reader.readexactly(length)
+    else:
+        # The body runs until the bridge closes the connection
+        body = await reader.read()
+        close = True
+    return status, body, close
+
+
+class BridgeConnection():
+    """
+    One keep-alive HTTP/1.1 connection to a bridge
+    Each request is written as soon as it is given, without waiting for
+    the answers to the earlier ones, and the reader task hands the answers
+    back in order. A request that times out closes the connection as the
+    answers behind it would be just as late.
+    Only used from the event loop thread.
+    """
+    logger = None
+
+    def __init__(self, host, port):
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.waiting = deque()  # Futures for the answers, in request order
+        self.queued = 0  # Requests given to the connection but not yet sent
+        self.opening = asyncio.Lock()
+
+    @property
+    def depth(self):
+        """ Number of requests waiting to be sent or for an answer """
+        return len(self.waiting) + self.queued
+
+    async def open(self, timeout):
+        """ Connect to the bridge if not already connected """
+        async with self.opening:
+            if self.writer is not None:
+                return
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), timeout)
+            except asyncio.TimeoutError:
+                raise TransportTimeout('Timed out connecting to {}'.format(self.host))
+            except OSError as exc:
+                raise TransportError('Failed to connect to {}: {}'.format(self.host, exc))
+            self.reader_task = asyncio.ensure_future(self.read_answers(self.reader))
+            self.logger.debug('Connected to %s:%d', self.host, self.port)
+
+    async def send(self, data, deadline):
+        """ Send a request and return (status, body) """
+        try:
+            await self.open(deadline - monotonic())
+        finally:
+            self.queued -= 1
+        future = asyncio.Future()
+        self.waiting.append(future)
+        self.writer.write(data)
+        try:
+            # The future stays queued for its answer if the wait times out
+            answer = await asyncio.wait_for(asyncio.shield(future), deadline - monotonic())
+        except asyncio.TimeoutError:
+            self.close('request timed out')
+            raise TransportTimeout('No answer from {}'.format(self.host))
+        if answer is None:
+            raise TransportError('Connection to {} closed'.format(self.host))
+        return answer
+
+    async def read_answers(self, reader):
+        """ Hand the answers to the waiting requests until the connection closes """
+        reason = 'closed by the bridge'
+        try:
+            while True:
+                status, body, close = await read_response(reader)
+                future = self.waiting.popleft()
+                if not future.done():
+                    future.set_result((status, body))
+                if close:
+                    break
+        except (OSError, EOFError, ValueError, IndexError, asyncio.IncompleteReadError) as exc:
+            reason = str(exc) or type(exc).__name__
+        if self.reader is reader:
+            self.reader_task = None
+            self.close(reason)
+
+    def close(self, reason='closed'):
+        """ Close the connection, the requests waiting on it fail """
+        if self.writer is not None:
+            self.logger.debug('Closing connection to %s:%d: %s', self.host, self.port, reason)
+            self.writer.close()
+        self.reader = self.writer = None
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            self.reader_task = None
+        waiting, self.waiting = self.waiting, deque()
+        for future in waiting:
+            if not future.done():
+                future.set_result(None)
+
+
+class BridgeTransport():
+    """
+    The connections to one bridge
+    A request goes on the connection with the fewest requests waiting.
+    When every connection already has depth requests waiting the request
+    waits for a space, and is dropped if its deadline passes first as the
+    color would be out of date by the time it was shown.
+    Only used from the event loop thread.
+    """
+    def __init__(self, address, connections, depth):
+        host, _, port = address.partition(':')
+        self.connections = [BridgeConnection(host, int(port or 80)) for _ in range(connections)]
+        self.depth = depth
+        self.space = asyncio.Condition()
+        self.headers = 'Host: {}\r\nContent-Type: application/json\r\n'.format(address).encode()
+
+    async def request(self, method, path, body, deadline):
+        """ Send a request and return (status, body) """
+        data = b'%s %s HTTP/1.1\r\n%sContent-Length: %d\r\n\r\n%s' % (
+            method, path, self.headers, len(body), body)
+        async with self.space:
+            while True:
+                connection = min(self.connections, key=lambda conn: conn.depth)
+                if connection.depth < self.depth:
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise StaleRequest('Dropped request for {}'.format(path.decode()))
+                try:
+                    await asyncio.wait_for(self.space.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            connection.queued += 1
+        try:
+            return await connection.send(data, deadline)
+        finally:
+            async with self.space:
+                self.space.notify()
+
+    def close(self):
+        """ Close all the connections """
+        for connection in self.connections:
+            connection.close()
+
+
+class PipelinedTransport():
+    """
+    HTTP/1.1 client for all the hue bridges on one event loop thread
+    submit() may be called from any thread, it returns a Future for the
+    answer straight away so a thread can have several requests in flight.
+    request() blocks until the answer arrives or the timeout passes.
+    Attributes:
+        connections: keep-alive connections to each bridge
+        depth: requests that may wait for an answer on each connection
+    """
+    logger = None
+    connections = 2
+    depth = 4
+
+    def __init__(self):
+        if type(self).logger is None:
+            type(self).logger = logging.getLogger(type(self).__name__)
+        self.loop = asyncio.new_event_loop()
+        self.bridges = dict()
+        self.thread = Thread(target=self._run, name='Transport')
+        self.thread.setDaemon(True)  # don't hang on exit
+        self.thread.start()
+
+    def _run(self):
+        """ Run the event loop until closed """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    @property
+    def capacity(self):
+        """ Number of requests that may be in flight to each bridge """
+        return self.connections * self.depth
+
+    def submit(self, address, method, path, body=b'', timeout=1.0):
+        """
+        Send a request to a bridge without waiting for the answer
+        method and path are bytes, body is the JSON bytes
+        Returns a concurrent.futures.Future of (status, body, answered),
+        answered is the monotonic time the answer arrived. The Future
+        raises TransportTimeout if there is no answer within timeout
+        seconds, StaleRequest if it could not be sent in that time and
+        TransportError if the connection fails
+        """
+        #pylint: disable=R0913
+        deadline = monotonic() + timeout
+        return asyncio.run_coroutine_threadsafe(
+            self._request(address, method, path, body, deadline), self.loop)
+
+    def request(self, address, method, path, body=b'', timeout=1.0):
+        """
+        Send a request to a bridge and return (status, body)
+        Raises the same exceptions as the Future from submit
+        """
+        #pylint: disable=R0913
+        future = self.submit(address, method, path, body, timeout)
+        try:
+            # The deadline is kept by the event loop, this is a backstop
+            return future.result(timeout + 1)[:2]
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TransportTimeout('No answer from {}'.format(address))
+
+    async def _request(self, address, method, path, body, deadline):
+        """ Send a request on the bridge's connections """
+        #pylint: disable=R0913
+        bridge = self.bridges.get(address)
+        if bridge is None:
+            bridge = self.bridges[address] = BridgeTransport(address, self.connections, self.depth)
+        status, body = await bridge.request(method, path, body, deadline)
+        return status, body, monotonic()
+
+    def close(self):
+        """ Close the connections and stop the event loop thread """
+        def stop():
+            """ Called in the event loop """
+            for bridge in self.bridges.values():
+                bridge.close()
+            # Stop after the cancelled reader tasks have finished
+            self.loop.call_soon(self.loop.stop)
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(stop)
+            self.thread.join()
+
+
+_transport = None
+_transport_lock = Lock()
+
+
+def shared_transport():
+    """ Return the PipelinedTransport shared by all the bridges """
+    global _transport  #pylint: disable=W0603
+    with _transport_lock:
+        if _transport is None:
+            _transport = PipelinedTransport()
+        return _transport
+
+
+def close_transport():
+    """ Close the shared transport if it was used """
+    global _transport  #pylint: disable=W0603
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+            _transport = None
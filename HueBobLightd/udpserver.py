@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+UDP Server
+This module contains the server for clients that send whole frames of
+light colors in a single binary datagram, alongside the text protocol.
+
+Datagram format, all values are unsigned and in network byte order:
+    header: magic b'HB', version (1), flags, sequence (32 bits),
+            number of colors (16 bits)
+    colors: light slot (16 bits) then red, green & blue as 8 bit values,
+            or as 16 bit values if bit 0 of the flags is set
+The light slots are the order of the lights in the "get lights" response.
+Datagrams with a sequence number that is not newer than the last one
+received from the same address are dropped as late or out of order.
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import logging
+import socketserver
+import struct
+from collections import Counter
+from time import time, monotonic
+from HueBobLightd.frames import FrameLayer
+
+MAGIC = b'HB'
+VERSION = 1
+FLAG_16BIT = 0x01
+
+HEADER = struct.Struct('!2sBBIH')
+COLORS_8BIT = struct.Struct('!HBBB')
+COLORS_16BIT = struct.Struct('!HHHH')
+
+
+def encode_frame(sequence, colors, wide=False):
+    """
+    Build a datagram from a list of (slot, red, green, blue) tuples
+    The colors are floats from 0.0 to 1.0, sent as 8 bit values or as
+    16 bit values if wide is True
+    """
+    entry, scale = (COLORS_16BIT, 65535) if wide else (COLORS_8BIT, 255)
+    data = [HEADER.pack(MAGIC, VERSION, FLAG_16BIT if wide else 0,
+                        sequence & 0xFFFFFFFF, len(colors))]
+    for slot, red, green, blue in colors:
+        data.append(entry.pack(slot, round(red * scale),
+                               round(green * scale), round(blue * scale)))
+    return b''.join(data)
+
+
+def decode_frame(data):
+    """
+    Return the sequence number and the list of (slot, red, green, blue)
+    tuples from a datagram, the colors are floats from 0.0 to 1.0
+    Raises ValueError if the datagram is not a valid frame
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('Datagram too short')
+    magic, version, flags, sequence, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a frame datagram')
+    entry, scale = (COLORS_16BIT, 1 / 65535) if flags & FLAG_16BIT \
+        else (COLORS_8BIT, 1 / 255)
+    if len(data) != HEADER.size + count * entry.size:
+        raise ValueError('Datagram length does not match color count')
+    colors = [(slot, red * scale, green * scale, blue * scale)
+              for slot, red, green, blue in entry.iter_unpack(data[HEADER.size:])]
+    return sequence, colors
+
+
+def is_newer(sequence, last):
+    """ Compare 32 bit sequence numbers allowing for wrap around """
+    return last is None or 0 < ((sequence - last) & 0xFFFFFFFF) < 0x80000000
+
+
+class UdpClient():
+    """ The frame layer and last sequence number for a sending address """
+    def __init__(self, layer):
+        self.layer = layer
+        self.sequence = None
+        self.generation = None
+
+
+class BobHueDatagramHandler(socketserver.BaseRequestHandler):
+    """ Handles a single frame datagram """
+
+    def handle(self):
+        received = monotonic()
+        server = self.server
+        try:
+            sequence, colors = decode_frame(self.request[0])
+        except ValueError as exc:
+            server.counters['invalid'] += 1
+            server.logger.debug('Invalid datagram from %r: %s', self.client_address, exc)
+            return
+        client = server.get_client(self.client_address)
+        if not is_newer(sequence, client.sequence):
+            server.counters['dropped'] += 1
+            return
+        client.sequence = sequence
+
+        updater = server.data
+        registry = updater.registry
+        if client.generation != registry.generation:
+            # The lights have been rebuilt so forget the old colors
+            client.layer.clear()
+            client.generation = registry.generation
+        count = len(registry)
+        layer = client.layer
+        for slot, red, green, blue in colors:
+            if slot < count:
+                layer.set_color(slot, red, green, blue, received)
+        layer.publish()
+        server.counters['frames'] += 1
+        updater.update()
+
+
+class BobHueUdpServer(socketserver.UDPServer):
+    """
+    Server listening for frame datagrams
+    Each sending address gets its own FrameLayer, at the configured
+    priority, in the updater's FrameCompositor.
+    """
+    def __init__(self, server_address, priority=128,
+                 handler_class=BobHueDatagramHandler):
+        self.logger = logging.getLogger(type(self).__name__)
+        self.data = None
+        self.priority = priority
+        self.clients = dict()
+        self.counters = Counter()
+        super().__init__(server_address, handler_class)
+
+    def get_client(self, address):
+        """ Return the client for the address, creating it if required """
+        client = self.clients.get(address)
+        if client is None:
+            self._expire_clients()
+            layer = FrameLayer('udp:{}:{}'.format(*address[:2]), self.priority)
+            client = self.clients[address] = UdpClient(layer)
+            self.data.frames.add_layer(layer)
+            self.logger.info('New UDP client: %r', address)
+        elif not client.layer.is_active(time(), self.data.frames.timeout):
+            # The client has been quiet so it may have restarted its sequence
+            client.sequence = None
+        return client
+
+    def _expire_clients(self):
+        """ Remove the clients that have stopped sending """
+        now = time()
+        frames = self.data.frames
+        for address, client in list(self.clients.items()):
+            if not client.layer.is_active(now, frames.timeout):
+                frames.remove_layer(client.layer)
+                del self.clients[address]
+
+    def server_close(self):
+        """ Remove the client's layers and close the socket """
+        if self.data is not None:
+            for client in self.clients.values():
+                self.data.frames.remove_layer(client.layer)
+        self.clients.clear()
+        self.logger.info('UDP frames: %r', dict(self.counters))
+        super().server_close()
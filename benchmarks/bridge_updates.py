@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+bridge_updates
+Benchmark the updater against a simulated hue bridge. Frames of changing
+colors are synced at a fixed rate for a number of seconds, then the
+requests sent, the state changes the bridge accepted and the time each
+color took from the client to the bridge are reported for each transport.
+
+    python3 benchmarks/bridge_updates.py --lights 6 --latency 0.05 --rate 20
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import os
+import sys
+import argparse
+import logging
+from threading import Thread
+from time import monotonic, sleep
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+#pylint: disable=C0413
+from HueBobLightd.simulator import BridgeSimulator
+from HueBobLightd.huelights import HueLight, BridgeAddress, close_sessions
+from HueBobLightd.transport import close_transport
+from HueBobLightd.lightupdate import LightsUpdater
+from HueBobLightd.frames import FrameLayer
+
+
+def run(args, transport):
+    """ Send the frames through an updater to a fresh bridge, return the results """
+    bridge = BridgeSimulator(('127.0.0.1', 0), 'user', args.lights, args.latency,
+                             args.rate, args.errors)
+    Thread(target=bridge.serve_forever, daemon=True).start()
+    address = BridgeAddress('127.0.0.1:{}'.format(bridge.server_address[1]), 'user')
+    lights = [HueLight(address=address, name='Light{}'.format(light_id), hue_id=str(light_id),
+                       transport=transport)
+              for light_id in range(1, args.lights + 1)]
+    updater = LightsUpdater()
+    updater.set_rate(address, args.rate or 10, 1, 2, max(args.rate, 20))
+    for light in lights:
+        updater.add(light)
+    layer = FrameLayer('benchmark')
+    updater.frames.add_layer(layer)
+    thread = Thread(target=updater.update_forever)
+    thread.start()
+    while not all(light.is_on for light in lights):
+        sleep(0.01)
+
+    slots = updater.registry.slots
+    period = 1.0 / args.fps
+    frames = int(args.seconds * args.fps)
+    start = monotonic()
+    for frame in range(frames):
+        now = monotonic()
+        for light in lights:
+            # Each light cycles through blue to red at its own speed
+            level = (frame * int(light.hue_id) % args.fps) / args.fps
+            layer.set_color(slots[light], level, 0.0, 1.0 - level, now)
+        layer.publish()
+        updater.update()
+        sleep(max(0.0, start + (frame + 1) * period - monotonic()))
+    sleep(args.settle)
+
+    results = {
+        'puts': sum(light.stats['puts'] for light in lights),
+        'failed': sum(light.stats['failed'] for light in lights),
+        'changes': len(bridge.changes),
+        'busy': bridge.counters.get('busy', 0),
+        'traced': sum(light.trace['total'].count for light in lights),
+        'latency': sum(light.trace['total'].sum for light in lights),
+    }
+    updater.shutdown()
+    thread.join()
+    close_sessions()
+    close_transport()
+    bridge.shutdown()
+    bridge.server_close()
+    return results
+
+
+def main():
+    """ Run the benchmark and print the results """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lights', type=int, default=6,
+                        help='number of lights on the bridge')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the bridge takes to answer')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='requests per second the bridge handles, 0 is no limit')
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='share of the state changes the bridge fails')
+    parser.add_argument('--fps', type=int, default=30,
+                        help='frames synced per second')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='seconds of frames to send')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds to wait for the updater to finish')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    for transport in ('requests', 'pipelined'):
+        results = run(args, transport)
+        mean = results['latency'] / results['traced'] if results['traced'] else 0.0
+        print('{:>9}: {:5d} puts, {:4d} failed, {:4d} busy, {:5d} state changes, '
+              '{:.1f} puts/sec, mean latency {:.0f}ms'.format(
+                  transport, results['puts'], results['failed'], results['busy'],
+                  results['changes'], results['puts'] / args.seconds, mean * 1000))
+
+
+if __name__ == '__main__':
+    main()
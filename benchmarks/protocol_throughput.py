@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+protocol_throughput
+Benchmark the boblight request parsing in lines/sec.
+Compares the original line at a time, str based if/elif parsing ("before")
+with the bytes based, table driven BoblightProtocol reading a frame at a
+time ("after") on a stream of rgb frames followed by a sync, as a client
+would send at 60fps.
+
+    python3 benchmarks/protocol_throughput.py --lights 10 --frames 20000
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import os
+import sys
+import argparse
+import logging
+from collections import Counter
+import random
+from threading import Lock
+from time import perf_counter
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+#pylint: disable=C0413
+from HueBobLightd.server import BoblightProtocol
+from HueBobLightd.huelights import HueLight, BridgeAddress
+from HueBobLightd.lightupdate import LightRegistry
+from HueBobLightd.frames import FrameCompositor
+
+
+class FakeUpdater():
+    """ Stands in for the LightsUpdater, sync does nothing """
+    def __init__(self, lights):
+        self.registry = LightRegistry()
+        for light in lights:
+            self.registry.add(light)
+        self.frames = FrameCompositor()
+        self.counters = Counter()
+
+    @property
+    def lights(self):
+        """ The registered lights """
+        return self.registry.lights
+
+    def update(self):
+        """ Ignore the sync """
+        pass
+
+
+class FakeServer():
+    """ Holds the updater as the real servers do """
+    def __init__(self, updater):
+        self.data = updater
+
+
+class LegacyLight():
+    """
+    The original HueLight.set_color
+    Every color takes the light's lock and is logged at DEBUG level, the
+    current set_color is lock free and only counts the colors
+    """
+    logger = logging.getLogger('HueLight')
+
+    def __init__(self, light):
+        self.name = light.name
+        self.hue_id = light.hue_id
+        self.rgb = light.rgb
+        self.lock = Lock()
+
+    def set_color(self, red, green, blue):
+        """ Set the light color """
+        with self.lock:
+            self.rgb = (red, green, blue)
+        self.logger.debug('Set light(%s:%s) color: %r',
+                          self.name, self.hue_id, self.rgb)
+
+
+class LegacyProtocol():
+    """
+    The rgb & sync path of the original process_request
+    Requests are decoded, stripped, split and parsed through an if/elif chain
+    and applied to the lights with the original set_color
+    """
+    def __init__(self, server):
+        self.logger = logging.getLogger('LegacyProtocol')
+        self.server = server
+        self.lights = [LegacyLight(light) for light in server.data.lights]
+
+    def process_request(self, request):
+        """ Process the incoming request """
+        #pylint: disable=R0912
+        request = request.decode().strip()
+        response = list()
+        lights = self.lights
+        message_parts = request.split()
+        cmd = message_parts[0]
+        if cmd == 'hello':
+            response.append('hello')
+        elif cmd == 'ping':
+            response.append('ping 1')
+        elif cmd == 'get':
+            pass
+        elif cmd == 'set':
+            subcmd = message_parts[1]
+            if subcmd == 'priority':
+                pass
+            if subcmd == 'light':
+                lightid = tuple(message_parts[2].split(':'))
+                lightcmd = message_parts[3]
+                if lightcmd == 'rgb':
+                    self.logger.debug('light %s rgb: %f, %f, %f', lightid,
+                                      float(message_parts[4]),
+                                      float(message_parts[5]),
+                                      float(message_parts[6]))
+                    if len(message_parts) == 7:
+                        light = next((x for x in lights if x.hue_id == lightid[1] and x.name == lightid[0]), None)
+                        if light:
+                            light.set_color(float(message_parts[4]),  # red
+                                            float(message_parts[5]),  # green
+                                            float(message_parts[6]))  # blue
+        elif cmd == 'sync':
+            self.logger.debug('sync')
+            self.server.data.update()
+        else:
+            self.logger.info('Unrecognised command: %r', message_parts)
+        return '\n'.join(response) + '\n' if response else None
+
+
+class CurrentProtocol(BoblightProtocol):
+    """ The protocol as used by the servers """
+    def __init__(self, server):
+        self.logger = logging.getLogger('CurrentProtocol')
+        self.server = server
+        self.client_address = ('127.0.0.1', 0)
+        self.init_protocol()
+        self.connection_made()
+
+
+def make_lights(count):
+    """ Create a set of lights on a dummy bridge """
+    bridge = BridgeAddress('127.0.0.1', 'benchmark')
+    return [HueLight(address=bridge, name='Light{}'.format(i), hue_id=str(i))
+            for i in range(1, count + 1)]
+
+
+def make_stream(lights, frames):
+    """ Create the request lines for the frames, one rgb per light and a sync """
+    rand = random.Random(1)
+    stream = list()
+    for _ in range(frames):
+        for light in lights:
+            stream.append('set light {}:{} rgb {:f} {:f} {:f}\n'.format(
+                light.name, light.hue_id,
+                rand.random(), rand.random(), rand.random()).encode())
+        stream.append(b'sync\n')
+    return stream
+
+
+def run(process, blocks, lines):
+    """ Process the blocks of requests and return the lines per second """
+    start = perf_counter()
+    for block in blocks:
+        process(block)
+    return lines / (perf_counter() - start)
+
+
+def main():
+    """ Run the benchmark and print the results """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lights', type=int, default=10,
+                        help='number of lights in each frame')
+    parser.add_argument('--frames', type=int, default=20000,
+                        help='number of frames to process')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs, the best is reported')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    lights = make_lights(args.lights)
+    server = FakeServer(FakeUpdater(lights))
+    stream = make_stream(lights, args.frames)
+
+    # The original handler read one line at a time, the current one reads
+    # whatever is available on the socket, here a frame at a time
+    frame_size = args.lights + 1
+    frames = [b''.join(stream[i:i + frame_size])
+              for i in range(0, len(stream), frame_size)]
+    tests = (
+        ('before', LegacyProtocol(server).process_request, stream),
+        ('after', CurrentProtocol(server).process_data, frames),
+    )
+
+    results = dict()
+    for name, process, blocks in tests:
+        results[name] = max(run(process, blocks, len(stream))
+                            for _ in range(args.repeat))
+        print('{:>6}: {:12,.0f} lines/sec'.format(name, results[name]))
+    print('speedup: {:.2f}x'.format(results['after'] / results['before']))
+
+
+if __name__ == '__main__':
+    main()
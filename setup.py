@@ -83,6 +83,8 @@ setup(
         'console_scripts': [
             'hueboblightd=HueBobLightd.hueboblightd:main',
             'lighteffects=HueBobLightd.lighteffects:main',
+            'huebobreplay=HueBobLightd.replay:main',
+            'huebobsim=HueBobLightd.simulator:main',
         ],
     },
     zip_safe=True,
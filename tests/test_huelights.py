@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Test the HueLight class
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import json
+from time import monotonic
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from HueBobLightd.huelights import HueLight, BridgeAddress, classify_errors, close_sessions
+from HueBobLightd.huelights import encode_state
+from HueBobLightd.frames import ColorFilter
+
+
+class TestHueLight():
+    """ Test the HueLight color change detection """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create a light with grey already sent """
+        self.light = HueLight(address=BridgeAddress('192.168.1.1', 'user'),
+                              name='Left', hue_id='1')
+        self.light.set_color(0.5, 0.5, 0.5)
+        assert self.light.changed()
+        self.light.xy_previous = self.light.xy_new
+        self.light.pending = False
+
+    def test_bridge_precision(self):
+        """ The xy is rounded to the 4 decimals used by the bridge """
+        assert all(round(value, 4) == value for value in self.light.xy_new)
+
+    def test_suppressed(self):
+        """ A change too small to see is not sent, but is counted """
+        self.light.set_color(0.502, 0.5, 0.5)
+        assert not self.light.changed()
+        assert self.light.stats['suppressed'] == 1
+
+    def test_changed(self):
+        """ A visible change is sent """
+        self.light.set_color(0.0, 0.0, 1.0)
+        assert self.light.changed()
+        assert self.light.stats['suppressed'] == 0
+        assert self.light.difference() > self.light.threshold
+
+    def test_threshold(self):
+        """ With no threshold every change at bridge precision is sent """
+        self.light.threshold = 0
+        self.light.set_color(0.502, 0.5, 0.5)
+        assert self.light.changed()
+
+    def test_brightness_threshold(self):
+        """ The thresholds are set per light, brightness changes below it are suppressed """
+        light = HueLight(address=BridgeAddress('192.168.1.1', 'user'),
+                         name='Left', hue_id='1', brightness=200,
+                         dynamic_brightness=True, bri_threshold=10)
+        light.set_color(0.5, 0.5, 0.5)
+        assert light.changed()
+        light.xy_previous = light.xy_new
+        light.bri_previous = light.bri_new
+        light.pending = False
+        light.set_color(0.52, 0.52, 0.52)
+        assert not light.changed()
+        light.set_color(0.56, 0.56, 0.56)
+        assert light.changed()
+        assert self.light.bri_threshold == 3
+
+
+class TestLightState():
+    """ Test only the changed state fields are sent """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create a light that is on at its brightness """
+        self.light = HueLight(address=BridgeAddress('192.168.1.1', 'user'),
+                              name='Left', hue_id='1', brightness=200)
+        self.puts = list()
+        self.light._put = self.put
+        self.light.turn_on()
+
+    def put(self, state, timeout=1):
+        """ Record the state and succeed """
+        #pylint: disable=W0613
+        self.puts.append(state)
+        return True
+
+    def test_color(self):
+        """ After turning on only the color and transition are sent """
+        assert self.puts == [{'on': True, 'bri': 200}]
+        self.light.set_color(0.0, 0.0, 1.0)
+        assert self.light.update()
+        assert set(self.puts[1]) == {'xy', 'transitiontime'}
+        self.light.turn_on()
+        assert len(self.puts) == 2
+
+    def test_auto_off(self):
+        """ The light is turned on again with the color after an auto off """
+        self.light.turn_off()
+        assert self.puts[1] == {'on': False}
+        self.light.set_color(0.0, 0.0, 1.0)
+        self.light.update()
+        assert set(self.puts[2]) == {'on', 'xy', 'transitiontime'}
+
+    def test_dynamic_brightness(self):
+        """ The brightness follows the luminance of the color """
+        self.light.dynamic_brightness = True
+        self.light.transition = 4
+        self.light.set_color(1.0, 1.0, 1.0)
+        self.light.update()
+        assert self.puts[1] == {'xy': self.light.xy_new}
+        self.light.set_color(0.5, 0.5, 0.5)
+        self.light.update()
+        assert self.puts[2] == {'bri': 100}
+
+    def test_trace(self):
+        """ Each frame's latency is traced once, when the bridge acknowledges it """
+        light = self.light
+
+        def timed_put(state, timeout=1):
+            """ Answer the request after 20ms """
+            #pylint: disable=W0613
+            light.put_start = monotonic()
+            light.put_done = light.put_start + 0.02
+            return True
+
+        light._put = timed_put
+        light.received = monotonic() - 0.1
+        light.synced = light.received + 0.01
+        light.set_color(0.0, 0.0, 1.0)
+        assert light.update()
+        assert all(histogram.count == 1 for histogram in light.trace.values())
+        assert abs(light.trace['http'].sum - 0.02) < 1e-9
+        assert light.trace['total'].sum >= 0.12
+        light.set_color(1.0, 0.0, 0.0)
+        assert light.update()
+        assert light.trace['total'].count == 1
+
+
+def test_classify_errors():
+    """ The bridge errors returned with a 200 are classified """
+    success = {'success': {'/lights/1/state/on': True}}
+    assert classify_errors([success]) is None
+    assert classify_errors([success, {'error': {'type': 201, 'address': '/lights/1/state/xy',
+                                                'description': 'device is set to off'}}]) \
+        == 'rejected'
+    assert classify_errors([{'error': {'type': 901, 'address': '/lights/1/state',
+                                       'description': 'Internal error, 404'}}]) == 'busy'
+
+
+
+def test_encode_state():
+    """ The state is rendered as the JSON the json module would give """
+    state = {'on': True, 'xy': (0.31276, 0.329), 'bri': 150, 'transitiontime': 2}
+    body = encode_state(state)
+    assert body == b'{"on":true,"xy":[0.3128,0.3290],"bri":150,"transitiontime":2}'
+    assert json.loads(body.decode()) == dict(state, xy=[0.3128, 0.329])
+    assert encode_state({'on': False}) == b'{"on":false}'
+    assert json.loads(encode_state({'alert': 'select'}).decode()) == {'alert': 'select'}
+
+
+class BridgeHandler(BaseHTTPRequestHandler):
+    """ Answers every request with success, keeping the connection open """
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        """ Read the state and record the connection it came on """
+        #pylint: disable=C0103
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.clients.add(self.client_address)
+        body = b'[{"success": {}}]'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Keep the test output quiet """
+        #pylint: disable=W0622
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ A bridge that answers each connection in its own thread """
+    daemon_threads = True
+
+
+class TestBridgeSession():
+    """ Test the lights on a bridge share its keep-alive connections """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Start a bridge with two lights on it """
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BridgeHandler)
+        self.server.clients = set()
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        bridge = BridgeAddress('127.0.0.1:{}'.format(self.server.server_address[1]), 'user')
+        self.lights = [HueLight(address=bridge, name='Left', hue_id='1'),
+                       HueLight(address=bridge, name='Right', hue_id='2')]
+
+    def teardown_method(self):
+        """ Stop the bridge """
+        close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """ Every request goes over the same connection """
+        assert self.lights[0].session is self.lights[1].session
+        for _ in range(3):
+            for light in self.lights:
+                assert light._put({'on': True})
+        assert len(self.server.clients) == 1
+
+    def test_reconnect(self):
+        """ After a connection error the next request reconnects """
+        assert self.lights[0]._put({'on': True})
+        self.lights[0].reconnect()
+        assert self.lights[1]._put({'on': True})
+        assert len(self.server.clients) == 2
+
+    def test_bounded_pool(self):
+        """ Requests sent at once wait for the pool's connections, no extra ones are opened """
+        threads = [Thread(target=light._put, args=({'on': True},))
+                   for light in self.lights * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.lights[0].stats['puts'] == 4
+        assert len(self.server.clients) <= 2
+
+
+class TestColorFilter():
+    """ Test the ColorFilter smoothing """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create a filter that has reached grey """
+        self.filter = ColorFilter(time_constant=0.5)
+        self.filter.step((0.5, 0.5, 0.5))
+
+    def test_smoothing(self):
+        """ A small change is approached over time, not jumped to """
+        self.filter.stamp -= 0.5
+        red = self.filter.step((0.6, 0.5, 0.5))[0]
+        assert 0.55 < red < 0.57
+        self.filter.stamp -= 5
+        assert self.filter.step((0.6, 0.5, 0.5)) == (0.6, 0.5, 0.5)
+
+    def test_jump(self):
+        """ A big change goes straight through """
+        assert self.filter.step((0.0, 0.0, 1.0)) == (0.0, 0.0, 1.0)
+
+    def test_interpolation(self):
+        """ Without interpolation or after a single change nothing is smoothed """
+        self.filter.single_change = True
+        assert self.filter.step((0.6, 0.5, 0.5)) == (0.6, 0.5, 0.5)
+        self.filter.set_interpolation(False)
+        assert self.filter.step((0.5, 0.5, 0.5)) == (0.5, 0.5, 0.5)
+        self.filter.set_interpolation(True)
+        assert self.filter.time_constant == ColorFilter.default_time_constant
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Test the LightsUpdater class
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+from collections import Counter
+from threading import Thread, Event
+from time import time, monotonic, sleep
+from HueBobLightd.lightupdate import LightsUpdater, BridgeWorker, TokenBucket, RateController
+from HueBobLightd.huelights import HueLight, BridgeAddress, PendingUpdate
+from HueBobLightd.metrics import Histogram, TRACE_BUCKETS, TRACE_SPANS
+
+BRIDGE = BridgeAddress('192.168.1.1', 'user')
+
+
+class FakeLight():
+    """ Stands in for a HueLight on a bridge that always answers """
+    def __init__(self, name, hue_id, bridge=BRIDGE):
+        self.name = name
+        self.bridge = bridge
+        self.connected = True
+        self.transport = None
+        self.hue_id = hue_id
+        self.in_use = False
+        self.is_on = False
+        self.rgb = (0.0, 0.0, 0.0)
+        self.xy_previous = (0, 0)
+        self.sent = self.rgb
+        self.sent_time = monotonic()
+        self.latency = 0.01
+        self.error = None
+        self.stats = Counter()
+        self.trace = {span: Histogram(TRACE_BUCKETS) for span in TRACE_SPANS}
+        self.updates = list()
+        self.updated = Event()
+        self.failing = False
+        self.attempts = 0
+
+    def connect(self):
+        """ The bridge is there unless connected is cleared """
+        return self.connected
+
+    def validate(self):
+        """ The light is always on the bridge """
+        self.in_use = True
+        return True
+
+    def turn_on(self):
+        """ Turn the light on """
+        self.is_on = True
+
+    def turn_off(self):
+        """ Turn the light off """
+        self.is_on = False
+
+    def set_color(self, red, green, blue):
+        """ Set the light color """
+        self.rgb = (red, green, blue)
+
+    def changed(self):
+        """ The color has changed since the last update """
+        return self.rgb != self.sent
+
+    def settled(self):
+        """ There is no color filter """
+        return True
+
+    def difference(self):
+        """ The change in the sum of the colors """
+        return abs(sum(self.rgb) - sum(self.sent))
+
+    def start_update(self):
+        """ Record the time of the update, fails while failing is set """
+        self.attempts += 1
+        pending = PendingUpdate(monotonic(), dict(), dict(), self.rgb)
+        pending.result = not self.failing
+        if pending.result:
+            self.is_on = True
+            self.sent = self.rgb
+            self.sent_time = monotonic()
+            self.updates.append(time())
+            self.updated.set()
+        return pending
+
+    @staticmethod
+    def finish_update(pending):
+        """ The bridge answers straight away """
+        return pending.result
+
+
+class TestLightsUpdater():
+    """ Test the LightsUpdater update loop """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Start an updater with one light """
+        self.updater = LightsUpdater()
+        self.light = FakeLight('Left', '1')
+        self.updater.add(self.light)
+        self.start()
+
+    def start(self):
+        """ Start the updater and wait for its bridge workers """
+        self.thread = Thread(target=self.updater.update_forever)
+        self.thread.start()
+        while not self.updater.workers:
+            self.updater.exit_event.wait(0.01)
+
+    def teardown_method(self):
+        """ Stop the updater """
+        self.updater.shutdown()
+        self.thread.join()
+
+    def test_idle(self):
+        """ Without a sync the lights are not updated """
+        assert not self.light.updated.wait(0.3)
+
+    def test_sync(self):
+        """ A sync is sent straight away, the next waits for the update period """
+        start = time()
+        self.light.set_color(1.0, 0.0, 0.0)
+        self.updater.update()
+        assert self.light.updated.wait(1)
+        assert self.light.updates[0] - start < 0.05
+        self.light.updated.clear()
+        self.light.set_color(0.0, 1.0, 0.0)
+        self.updater.update()
+        assert self.light.updated.wait(1)
+        assert self.light.updates[1] - self.light.updates[0] >= 0.09
+
+    def test_auto_off(self):
+        """ The lights are turned off once there are no syncs for the auto off delay """
+        self.updater.auto_off_delay = 0.2
+        self.light.set_color(1.0, 0.0, 0.0)
+        self.updater.update()
+        assert self.light.updated.wait(1)
+        assert self.light.is_on
+        self.updater.exit_event.wait(0.4)
+        assert not self.light.is_on
+        assert len(self.light.updates) == 1
+
+    def test_bridges(self):
+        """ A missing bridge does not hold up the lights on another bridge """
+        self.updater.shutdown()
+        self.thread.join()
+        missing = FakeLight('Right', '2', BridgeAddress('192.168.1.2', 'user'))
+        missing.connected = False
+        self.light = FakeLight('Left', '1')
+        self.updater.add(self.light)
+        self.updater.add(missing)
+        self.start()
+        assert len(self.updater.workers) == 2
+        self.light.set_color(1.0, 0.0, 0.0)
+        missing.set_color(1.0, 0.0, 0.0)
+        self.updater.update()
+        assert self.light.updated.wait(1)
+        assert not missing.updates
+
+    def test_unchanged(self):
+        """ A sync without a color change is not sent """
+        self.updater.update()
+        assert not self.light.updated.wait(0.2)
+
+    def test_spread(self):
+        """ The lights are sent one per token, each with the latest frame """
+        self.updater.shutdown()
+        self.thread.join()
+        lights = [FakeLight('Left', '1'), FakeLight('Top', '2'), FakeLight('Right', '3')]
+        for light in lights:
+            light.set_color(1.0, 0.0, 0.0)
+            self.updater.add(light)
+        self.start()
+        self.updater.update()
+        assert lights[0].updated.wait(1)
+        # The last light changes again before its turn
+        lights[2].set_color(0.0, 0.0, 1.0)
+        assert lights[2].updated.wait(1)
+        assert lights[2].updates[0] - lights[0].updates[0] >= 0.18
+        assert lights[1].updates[0] - lights[0].updates[0] >= 0.09
+        assert lights[2].sent == (0.0, 0.0, 1.0)
+        assert len(lights[2].updates) == 1
+
+    def test_biggest_change(self):
+        """ The light with the biggest change is sent first """
+        self.updater.shutdown()
+        self.thread.join()
+        small = FakeLight('Left', '1')
+        big = FakeLight('Right', '2')
+        small.set_color(0.1, 0.0, 0.0)
+        big.set_color(1.0, 1.0, 1.0)
+        self.updater.add(small)
+        self.updater.add(big)
+        self.start()
+        self.updater.update()
+        assert small.updated.wait(1)
+        assert big.updates[0] < small.updates[0]
+
+    def test_failing_light(self):
+        """ A light that keeps failing is held back so the others are sent """
+        self.updater.shutdown()
+        self.thread.join()
+        small = FakeLight('Left', '1')
+        failing = FakeLight('Right', '2')
+        small.set_color(0.1, 0.0, 0.0)
+        failing.set_color(1.0, 1.0, 1.0)
+        failing.failing = True
+        self.updater.add(small)
+        self.updater.add(failing)
+        self.start()
+        self.updater.update()
+        assert small.updated.wait(1)
+        assert failing.attempts == 1
+        # Tried again once its retry time has passed, without another sync
+        failing.failing = False
+        assert failing.updated.wait(1)
+        assert failing.attempts == 2
+
+
+class TestSummary():
+    """ Test the LightsUpdater summary of the lights """
+    def test_replaced_lights(self):
+        """ The totals of lights that have been replaced are dropped """
+        updater = LightsUpdater()
+        old = FakeLight('Left', '1')
+        updater.add(old)
+        updater.summary_time -= updater.log_sampler.interval
+        updater.log_summary(updater.lights)
+        assert old in updater.summary_stats
+        updater.registry.remove(old)
+        new = FakeLight('Left', '1')
+        updater.add(new)
+        updater.summary_time -= updater.log_sampler.interval
+        updater.log_summary(updater.lights)
+        assert list(updater.summary_stats) == [new]
+        assert list(updater.summary_trace) == [new]
+
+
+class TestBridgeWorker():
+    """ Test a BridgeWorker sending the lights """
+    def test_nothing_sent(self):
+        """ An update without a request takes no token and is not observed """
+        light = FakeLight('Left', '1')
+        worker = BridgeWorker(LightsUpdater(), BRIDGE, [light])
+
+        def acked():
+            """ The bridge already has the new color, so no request is made """
+            light.sent = light.rgb
+        light.start_update = acked
+        light.set_color(1.0, 0.0, 0.0)
+        assert worker.send([light])
+        assert worker.bucket.tokens == 1
+        assert worker.latency.count == 0
+        del light.start_update
+        light.set_color(0.0, 1.0, 0.0)
+        assert worker.send([light])
+        assert worker.bucket.tokens < 1
+        assert worker.latency.count == 1
+
+    def test_tick_duration(self):
+        """ The tick does not include the request to the bridge """
+        light = FakeLight('Left', '1')
+        worker = BridgeWorker(LightsUpdater(), BRIDGE, [light])
+        start_update = light.start_update
+
+        def slow_update():
+            """ The bridge takes a while to answer """
+            sleep(0.2)
+            return start_update()
+        light.start_update = slow_update
+        light.set_color(1.0, 0.0, 0.0)
+        assert worker.send([light])
+        assert worker.tick_duration.count == 1
+        assert worker.tick_duration.sum < 0.1
+
+
+class TestSmoothing():
+    """ Test a smoothed light reaches its color without more frames """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Start an updater with a smoothed light on a bridge that always answers """
+        self.updater = LightsUpdater()
+        self.light = HueLight(address=BRIDGE, name='Left', hue_id='1', smoothing=0.2)
+        self.light.connect = lambda: True
+        self.light.validate = self.validate
+        self.puts = list()
+        self.light._put = self.put
+        self.updater.add(self.light)
+        self.thread = Thread(target=self.updater.update_forever)
+        self.thread.start()
+        while not self.updater.workers:
+            self.updater.exit_event.wait(0.01)
+
+    def teardown_method(self):
+        """ Stop the updater """
+        self.updater.shutdown()
+        self.thread.join()
+
+    def validate(self):
+        """ The light is on the bridge """
+        self.light.in_use = True
+        return True
+
+    def put(self, state, timeout=1):
+        """ Record the state and succeed """
+        #pylint: disable=W0613
+        self.puts.append(state)
+        return True
+
+    def test_settles(self):
+        """ The light ends up within the threshold of the client's color """
+        self.light.set_color(0.5, 0.5, 0.2)
+        self.updater.update()
+        self.updater.exit_event.wait(0.3)
+        self.light.set_color(0.7, 0.5, 0.2)
+        self.updater.update()
+        self.updater.exit_event.wait(2)
+        assert self.light.settled()
+        x, y = self.light.converter.rgb_to_xy(0.7, 0.5, 0.2)
+        assert self.light.xy_new == (round(x, 4), round(y, 4))
+        assert self.light.color_difference() < self.light.threshold
+        assert len(self.puts) > 3
+
+
+class TestTokenBucket():
+    """ Test the TokenBucket rate limiter """
+    def test_burst(self):
+        """ The burst is available straight away, then tokens arrive at rate """
+        bucket = TokenBucket(rate=10, burst=3)
+        assert all(bucket.consume() for _ in range(3))
+        assert not bucket.consume()
+        assert 0.05 < bucket.delay() <= 0.1
+        bucket.stamp -= 0.1
+        assert bucket.consume()
+        assert not bucket.consume()
+
+
+class TestRateController():
+    """ Test the RateController adjusting a bridge's rate """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create a controller for a bucket at 10 requests per second """
+        self.bucket = TokenBucket(rate=10, burst=1)
+        self.controller = RateController(self.bucket, min_rate=2, max_rate=20)
+
+    def test_increase(self):
+        """ The rate goes up while the bridge answers quickly """
+        for _ in range(10):
+            self.controller.observe(0.05, None)
+        assert 10.4 < self.bucket.rate < 10.6
+        self.controller.observe(0.05, 'rejected')
+        assert self.bucket.rate > 10.5
+
+    def test_decrease(self):
+        """ The rate is cut when the bridge is busy, then held while it recovers """
+        self.controller.observe(0.05, 'busy')
+        assert self.bucket.rate == 7
+        self.controller.observe(0.5, None)
+        self.controller.observe(0.05, None)
+        assert self.bucket.rate == 7
+        self.controller.decrease_time -= self.controller.holdoff
+        self.controller.observe(0.5, None)
+        assert abs(self.bucket.rate - 4.9) < 1e-9
+
+    def test_limits(self):
+        """ The rate stays between the minimum and maximum """
+        for _ in range(10):
+            self.controller.decrease_time = 0.0
+            self.controller.observe(1.0, 'timeout')
+        assert self.bucket.rate == 2
+        self.controller.decrease_time = 0.0
+        self.controller.max_rate = 2.1
+        for _ in range(10):
+            self.controller.observe(0.05, None)
+        assert self.bucket.rate == 2.1
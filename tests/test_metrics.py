@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Test the metrics HTTP server
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+from threading import Thread
+from urllib.request import urlopen
+from HueBobLightd.huelights import HueLight, BridgeAddress
+from HueBobLightd.lightupdate import LightsUpdater, BridgeWorker
+from HueBobLightd.metrics import Histogram, MetricsServer, render_metrics
+
+
+def families(text):
+    """
+    Return the samples of each metric family in the text, failing if a
+    family's lines are not all together under its TYPE line
+    """
+    samples = dict()
+    family = None
+    kind = None
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            family, kind = line.split()[2:]
+            assert family not in samples
+            samples[family] = list()
+        elif not line.startswith('#'):
+            name = line.split('{')[0].split()[0]
+            if kind == 'histogram':
+                for suffix in ('_bucket', '_sum', '_count'):
+                    if name.endswith(suffix):
+                        name = name[:-len(suffix)]
+                        break
+            assert name == family
+            samples[family].append(line)
+    return samples
+
+
+def test_histogram():
+    """ The buckets are cumulative and end with +Inf """
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.observe(value)
+    assert histogram.render('latency', {'bridge': 'a'}) == [
+        'latency_bucket{bridge="a",le="0.1"} 2',
+        'latency_bucket{bridge="a",le="1.0"} 3',
+        'latency_bucket{bridge="a",le="+Inf"} 4',
+        'latency_sum{bridge="a"} 5.65',
+        'latency_count{bridge="a"} 4',
+    ]
+
+
+class TestMetrics():
+    """ Test the metrics for an updater with one light """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create an updater with a light and its bridge worker """
+        self.updater = LightsUpdater()
+        bridge = BridgeAddress('192.168.1.1', 'user')
+        self.light = HueLight(address=bridge, name='Left "1"', hue_id='1')
+        self.updater.add(self.light)
+        self.updater.workers = [BridgeWorker(self.updater, bridge, [self.light])]
+
+    def test_render(self):
+        """ The counters are reported with their labels """
+        self.updater.counters.update({'lines': 12, 'set': 10, 'syncs': 2, 'coalesced': 3})
+        self.light.stats.update({'puts': 5, 'timeout': 1})
+        self.updater.workers[0].latency.observe(0.03)
+        text = render_metrics(self.updater)
+        lines = text.splitlines()
+        assert 'hueboblightd_lines_total 12' in lines
+        assert 'hueboblightd_commands_total{command="set"} 10' in lines
+        assert 'hueboblightd_rgb_coalesced_total 3' in lines
+        assert 'hueboblightd_light_puts_total{bridge="192.168.1.1",id="1",' \
+            'light="Left \\"1\\""} 5' in lines
+        assert 'hueboblightd_light_errors_total{bridge="192.168.1.1",error="timeout",id="1",' \
+            'light="Left \\"1\\""} 1' in lines
+        assert 'hueboblightd_bridge_latency_seconds_count{bridge="192.168.1.1"} 1' in lines
+        assert text.count('# TYPE hueboblightd_bridge_rate gauge') == 1
+        assert 'hueboblightd_light_latency_seconds_count{bridge="192.168.1.1",id="1",' \
+            'light="Left \\"1\\"",span="http"} 0' in lines
+
+    def test_server(self):
+        """ The metrics are served at /metrics """
+        server = MetricsServer(('127.0.0.1', 0))
+        server.data = self.updater
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            with urlopen(url, timeout=5) as resp:
+                assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+                assert b'hueboblightd_clients 0' in resp.read()
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    def test_bridges(self):
+        """ With two bridges each metric is still one family """
+        bridge = BridgeAddress('192.168.1.2', 'user')
+        light = HueLight(address=bridge, name='Right', hue_id='1')
+        self.updater.add(light)
+        self.updater.workers.append(BridgeWorker(self.updater, bridge, [light]))
+        samples = families(render_metrics(self.updater))
+        assert len(samples['hueboblightd_bridge_rate']) == 2
+        assert len(samples['hueboblightd_tick_duration_seconds']) == 2 * 11
+        assert len(samples['hueboblightd_light_puts_total']) == 2
+
+    def test_same_name(self):
+        """ Two lights with the same name on a bridge are told apart by their id """
+        light = HueLight(address=self.light.bridge, name=self.light.name, hue_id='2')
+        self.updater.add(light)
+        samples = families(render_metrics(self.updater))
+        puts = samples['hueboblightd_light_puts_total']
+        assert len(puts) == 2
+        assert len({line.split()[0] for line in puts}) == 2
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Test the sampling profiler
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import os
+import socket
+from time import sleep, monotonic
+from threading import Thread, Event
+from HueBobLightd.profiler import SamplingProfiler
+
+
+def busy_loop(stop):
+    """ Keep a thread busy until stopped """
+    total = 0
+    while not stop.is_set():
+        started = monotonic()
+        while monotonic() - started < 0.01:
+            total += 1
+    return total
+
+
+class TestProfiler():
+    """ Tests for SamplingProfiler """
+    def setup_method(self):
+        """ Start a busy thread and an idle one """
+        self.stop = Event()
+        self.busy = Thread(target=busy_loop, args=(self.stop,), name='Busy')
+        self.idle = Thread(target=self.stop.wait, name='Idle')
+        self.busy.start()
+        self.idle.start()
+
+    def teardown_method(self):
+        """ Stop the threads """
+        self.stop.set()
+        self.busy.join()
+        self.idle.join()
+
+    def test_toggle(self, tmpdir):
+        """ Stopping writes the per thread stats to the directory """
+        profiler = SamplingProfiler(str(tmpdir), interval=0.001)
+        profiler.toggle()
+        assert profiler.running
+        sleep(0.2)
+        profiler.toggle()
+        assert not profiler.running
+        files = os.listdir(str(tmpdir))
+        assert len(files) == 1
+        with open(os.path.join(str(tmpdir), files[0])) as report:
+            text = report.read()
+        assert 'Thread Busy:' in text
+        assert 'busy_loop (test_profiler.py:' in text
+
+    def test_idle_threads(self, tmpdir):
+        """ Threads waiting for work are counted as idle """
+        profiler = SamplingProfiler(str(tmpdir))
+        for _ in range(5):
+            profiler.sample()
+        assert profiler.threads['Idle'].samples == 5
+        assert profiler.threads['Idle'].idle == 5
+        assert profiler.threads['Busy'].idle < 5
+        assert profiler.stop() is None
+
+    def test_socket_wait(self, tmpdir):
+        """ A thread waiting to read from a socket is idle and uses no CPU """
+        sock, peer = socket.socketpair()
+        reader = Thread(target=sock.makefile('rb').readline, name='Reader')
+        reader.start()
+        try:
+            profiler = SamplingProfiler(str(tmpdir))
+            for _ in range(5):
+                profiler.sample()
+                sleep(0.01)
+            assert profiler.threads['Reader'].idle == 5
+            if profiler.threads['Busy'].cpu is not None:
+                assert profiler.threads['Busy'].cpu > 0.02
+                assert profiler.threads['Reader'].cpu < 0.01
+        finally:
+            peer.sendall(b'\n')
+            reader.join()
+            sock.close()
+            peer.close()
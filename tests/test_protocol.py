@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Test the boblight protocol processing
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import logging
+from collections import Counter
+from HueBobLightd.server import BoblightProtocol
+from HueBobLightd.huelights import HueLight, BridgeAddress
+from HueBobLightd.lightupdate import LightRegistry
+from HueBobLightd.logger import LogSampler
+from HueBobLightd.frames import FrameCompositor
+
+
+class FakeUpdater():
+    """ Stands in for the LightsUpdater """
+    def __init__(self, lights):
+        self.registry = LightRegistry()
+        for light in lights:
+            self.registry.add(light)
+        self.frames = FrameCompositor()
+        self.counters = Counter()
+        self.syncs = 0
+
+    @property
+    def lights(self):
+        """ The registered lights """
+        return self.registry.lights
+
+    def update(self):
+        """ Count the sync requests """
+        self.syncs += 1
+
+
+class FakeServer():
+    """ Holds the updater as the real servers do """
+    def __init__(self, updater):
+        self.data = updater
+
+
+class Protocol(BoblightProtocol):
+    """ Protocol without a connection """
+    def __init__(self, server):
+        self.logger = logging.getLogger('Protocol')
+        self.server = server
+        self.client_address = ('127.0.0.1', 0)
+        self.init_protocol()
+        self.connection_made()
+
+
+class TestBoblightProtocol():
+    """ Test the BoblightProtocol class """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create a protocol with two lights """
+        bridge = BridgeAddress('127.0.0.1', 'test')
+        self.lights = [
+            HueLight(address=bridge, name='Left', hue_id='1', scanarea=(0, 100, 0, 50)),
+            HueLight(address=bridge, name='Right', hue_id='2', scanarea=(0, 100, 50, 100)),
+        ]
+        self.updater = FakeUpdater(self.lights)
+        self.protocol = Protocol(FakeServer(self.updater))
+
+    def test_hello(self):
+        """ hello, ping & version responses """
+        assert self.protocol.process_request(b'hello\n') == b'hello\n'
+        assert self.protocol.process_request(b'ping\r\n') == b'ping 2\n'
+        assert self.protocol.process_request(b'get version\n') == b'version 5\n'
+
+    def test_get_lights(self):
+        """ The lights are listed with their scan areas """
+        assert self.protocol.process_request(b'get lights\n') == (
+            b'lights 2\n'
+            b'light Left:1 scan 0 100 0 50\n'
+            b'light Right:2 scan 0 100 50 100\n'
+        )
+
+    def test_set_rgb(self):
+        """ An rgb request sets the color of the matching light only after the sync """
+        slots = self.updater.registry.slots
+        assert self.protocol.process_data(
+            b'set light Right:2 rgb 0.250000 0.500000 1.000000\n') is None
+        self.updater.frames.composite(self.lights, slots)
+        assert self.lights[1].rgb == (0.0, 0.0, 0.0)
+        self.protocol.process_data(b'sync\n')
+        self.updater.frames.composite(self.lights, slots)
+        assert self.lights[1].rgb == (0.25, 0.5, 1.0)
+        assert self.lights[0].rgb == (0.0, 0.0, 0.0)
+        # The color carries the times it was received and synced
+        assert 0 < self.lights[1].received <= self.lights[1].synced
+
+    def test_set_speed(self):
+        """ The speed request sets the transition time """
+        self.protocol.process_request(b'set light Left:1 speed 100\n')
+        assert self.lights[0].transition == 1
+
+    def test_interpolation(self):
+        """ interpolation turns the light's color filter on and off """
+        self.protocol.process_request(b'set light Left:1 interpolation 1\n')
+        assert self.lights[0].filter.time_constant > 0
+        self.protocol.process_request(b'set light Left:1 singlechange\n')
+        assert self.lights[0].filter.single_change
+        self.protocol.process_request(b'set light Left:1 interpolation false\n')
+        assert self.lights[0].filter.time_constant == 0
+
+    def test_sync(self):
+        """ sync is passed on to the updater """
+        self.protocol.process_request(b'sync\n')
+        assert self.updater.syncs == 1
+
+    def test_bad_requests(self):
+        """ Blank, unknown and malformed requests are ignored """
+        assert self.protocol.process_request(b'\n') is None
+        assert self.protocol.process_request(b'jump\n') is None
+        assert self.protocol.process_request(b'set light Left:1 dance\n') is None
+        assert self.protocol.process_data(b'set light Left:1 rgb 0.1 x 0.2\n') is None
+        assert self.protocol.process_request(b'set\n') is None
+        assert self.lights[0].rgb == (0.0, 0.0, 0.0)
+
+    def test_coalesce_rgb(self):
+        """ Only the last rgb for a light in a block is applied """
+        calls = list()
+        layer = self.protocol.layer
+        layer.set_color = lambda light, *color: calls.append(color[:3])
+        response = self.protocol.process_data(
+            b'set light Left:1 rgb 0.1 0.1 0.1\n'
+            b'set light Left:1 rgb 0.2 0.2 0.2\n'
+            b'set light Right:2 rgb 0.3 0.3 0.3\n'
+            b'set light Left:1 rgb 0.4 0.4 0.4\n'
+            b'sync\n'
+            b'set light Left:1 rgb 0.5 0.5 0.5\n'
+            b'ping\n'
+        )
+        assert response == b'ping 2\n'
+        assert calls == [(0.4, 0.4, 0.4), (0.3, 0.3, 0.3), (0.5, 0.5, 0.5)]
+        assert self.updater.syncs == 1
+        assert self.protocol.counters['rgb'] == 5
+        assert self.protocol.counters['coalesced'] == 2
+
+    def test_partial_requests(self):
+        """ A request split across reads is processed once complete """
+        assert self.protocol.process_data(b'hel') is None
+        assert self.protocol.process_data(b'lo\nget vers') == b'hello\n'
+        assert self.protocol.process_data(b'ion\n') == b'version 5\n'
+        # The socket closing processes an unterminated request
+        assert self.protocol.process_data(b'ping') is None
+        assert self.protocol.process_data(b'') == b'ping 2\n'
+
+    def test_lights_rebuilt(self):
+        """ Cached light lookups follow the registry when lights are rebuilt """
+        self.protocol.process_data(b'set light Left:1 rgb 0.5 0.5 0.5\nsync\n')
+        self.updater.frames.composite(self.lights, self.updater.registry.slots)
+        assert self.lights[0].rgb == (0.5, 0.5, 0.5)
+        # Replace the light as a SIGHUP would
+        registry = self.updater.registry
+        registry.remove(self.lights[0])
+        new_light = HueLight(address=BridgeAddress('127.0.0.1', 'test'),
+                             name='Left', hue_id='1')
+        registry.add(new_light)
+        self.protocol.process_data(b'set light Left:1 rgb 0.1 0.2 0.3\nsync\n')
+        self.updater.frames.composite(self.updater.lights, self.updater.registry.slots)
+        assert new_light.rgb == (0.1, 0.2, 0.3)
+        assert self.lights[0].rgb == (0.5, 0.5, 0.5)
+
+
+    def test_priority(self):
+        """ The highest priority client owns the lights until it goes quiet """
+        other = Protocol(self.protocol.server)
+        other.process_data(b'set priority 50\n'
+                           b'set light Left:1 rgb 1.0 0.0 0.0\n'
+                           b'sync\n')
+        self.protocol.process_data(b'set light Left:1 rgb 0.0 0.0 1.0\n'
+                                   b'set light Right:2 rgb 0.0 0.0 1.0\n'
+                                   b'sync\n')
+        frames = self.updater.frames
+        frames.composite(self.lights, self.updater.registry.slots)
+        assert self.lights[0].rgb == (1.0, 0.0, 0.0)
+        assert self.lights[1].rgb == (0.0, 0.0, 1.0)
+        assert self.protocol.process_request(b'ping\n') == b'ping 1\n'
+        assert other.process_request(b'ping\n') == b'ping 2\n'
+        # The higher priority client stops sending frames
+        other.layer.updated -= frames.timeout
+        frames.composite(self.lights, self.updater.registry.slots)
+        assert self.lights[0].rgb == (0.0, 0.0, 1.0)
+        # Then disconnects
+        other.connection_lost()
+        assert other.layer not in frames.layers
+
+    def test_use(self):
+        """ rgb requests for a light the client does not use are ignored """
+        self.protocol.process_data(b'set light Left:1 use 0\n'
+                                   b'set light Left:1 rgb 1.0 1.0 1.0\n')
+        self.protocol.layer.publish()
+        assert self.protocol.layer.color(0) is None
+        assert self.protocol.process_request(b'ping\n') == b'ping 1\n'
+
+
+class TestLightRegistry():
+    """ Test the LightRegistry class """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create an empty registry """
+        self.bridge = BridgeAddress('127.0.0.1', 'test')
+        self.registry = LightRegistry()
+
+    def test_add_and_get(self):
+        """ Lights are found by their str or bytes id and not duplicated """
+        light = HueLight(address=self.bridge, name='Left', hue_id='1')
+        assert self.registry.add(light)
+        assert not self.registry.add(HueLight(address=self.bridge, name='Left', hue_id='1'))
+        assert self.registry.get('Left:1') is light
+        assert self.registry.get(b'Left:1') is light
+        assert self.registry.get(b'Left:2') is None
+        assert len(self.registry) == 1
+
+    def test_remove(self):
+        """ Removing a light bumps the generation """
+        light = HueLight(address=self.bridge, name='Left', hue_id='1')
+        self.registry.add(light)
+        generation = self.registry.generation
+        assert self.registry.remove(light)
+        assert not self.registry.remove(light)
+        assert self.registry.generation > generation
+        assert b'Left:1' not in self.registry
+        assert not list(self.registry)
+
+    def test_slots(self):
+        """ A light's slot is its position, the lights after a removal move down """
+        lights = [HueLight(address=self.bridge, name=name, hue_id=str(hue_id))
+                  for hue_id, name in enumerate(('Left', 'Top', 'Right'))]
+        for light in lights:
+            self.registry.add(light)
+        assert self.registry.slot(b'Right:2') == 2
+        self.registry.remove(lights[1])
+        assert self.registry.slot(b'Right:2') == 1
+        assert self.registry.slot('Top:1') is None
+
+
+class TestLogSampler():
+    """ Test the LogSampler class """
+
+    def test_sample(self):
+        """ Only one message per key is allowed each interval """
+        sampler = LogSampler(interval=60)
+        assert sampler.sample('rgb')
+        assert not sampler.sample('rgb')
+        assert not sampler.sample('rgb')
+        assert sampler.sample('sync')
+        assert sampler.skipped('rgb') == 2
+        assert sampler.skipped('rgb') == 0
+
+    def test_no_interval(self):
+        """ An interval of 0 allows every message """
+        sampler = LogSampler(interval=0)
+        assert sampler.sample('rgb')
+        assert sampler.sample('rgb')
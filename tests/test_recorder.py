@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Test the session recorder
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import pytest
+from HueBobLightd.recorder import SessionRecorder, read_session
+
+
+@pytest.mark.parametrize('filename', ['session.rec', 'session.rec.gz'])
+def test_record_and_read(tmpdir, filename):
+    """ Recorded lines are read back in order with their connections """
+    filename = str(tmpdir.join(filename))
+    recorder = SessionRecorder(filename)
+    first = recorder.new_connection()
+    second = recorder.new_connection()
+    recorder.record(first, [b'hello', b'set light Left:1 rgb 0.1 0.2 0.3\r', b''])
+    recorder.record(second, [b'sync'])
+    recorder.connection_closed(first)
+    recorder.close()
+
+    records = list(read_session(filename))
+    assert [(conn, line) for _, conn, line in records] == [
+        (first, b'hello'),
+        (first, b'set light Left:1 rgb 0.1 0.2 0.3'),
+        (second, b'sync'),
+        (first, b''),
+    ]
+    # Lines received together have the same time
+    assert records[0][0] == records[1][0]
+    assert records[0][0] <= records[2][0] <= records[3][0]
+    assert recorder.records == 3
+
+
+def test_not_a_recording(tmpdir):
+    """ Other files are rejected """
+    filename = tmpdir.join('other.txt')
+    filename.write('hello\n')
+    with pytest.raises(ValueError):
+        list(read_session(str(filename)))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Test the boblight servers
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import socket
+from collections import Counter
+from threading import Thread
+from HueBobLightd.server import BobHueAsyncServer
+from HueBobLightd.lightupdate import LightRegistry
+from HueBobLightd.frames import FrameCompositor
+
+
+class FakeUpdater():
+    """ Stands in for the LightsUpdater """
+    def __init__(self):
+        self.registry = LightRegistry()
+        self.lights = self.registry.lights
+        self.frames = FrameCompositor()
+        self.counters = Counter()
+        self.syncs = 0
+
+    def update(self):
+        """ Count the sync requests """
+        self.syncs += 1
+
+
+class TestAsyncServer():
+    """ Test the BobHueAsyncServer class """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Start an asyncio server on a free port """
+        self.server = BobHueAsyncServer(('127.0.0.1', 0))
+        self.server.data = FakeUpdater()
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def teardown_method(self):
+        """ Stop the server """
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def connect(self):
+        """ Connect a client to the server """
+        client = socket.create_connection(self.server.server_address, timeout=2)
+        return client
+
+    def test_stalled_client_does_not_block(self):
+        """ A silent client must not stop another client being served """
+        stalled = self.connect()
+        stalled.sendall(b'hello')  # No line terminator
+        client = self.connect()
+        client.sendall(b'hello\nget version\n')
+        response = b''
+        while response.count(b'\n') < 2:
+            response += client.recv(1000)
+        assert response == b'hello\nversion 5\n'
+        client.close()
+        stalled.close()
+
+    def test_sync(self):
+        """ A sync request is passed to the updater """
+        client = self.connect()
+        client.sendall(b'sync\nhello\n')
+        assert client.recv(1000) == b'hello\n'
+        assert self.server.data.syncs == 1
+        client.close()
+
+    def test_server_close_with_clients(self):
+        """ Closing the server disconnects connected clients """
+        client = self.connect()
+        client.sendall(b'hello\n')
+        assert client.recv(1000) == b'hello\n'
+        self.teardown_method()
+        assert client.recv(1000) == b''
+        client.close()
+        self.setup_method()
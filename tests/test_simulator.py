@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Test the bridge simulator, and the updater sending to it
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+from threading import Thread
+from time import monotonic
+from HueBobLightd.simulator import BridgeSimulator
+from HueBobLightd.huelights import HueLight, BridgeAddress, close_sessions
+from HueBobLightd.lightupdate import LightsUpdater, TokenBucket
+from HueBobLightd.frames import FrameLayer
+
+
+class TestBridgeSimulator():
+    """ Test the simulated hue API """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Create a bridge with 3 lights, without serving it """
+        self.bridge = BridgeSimulator(('127.0.0.1', 0), 'user')
+
+    def teardown_method(self):
+        """ Close the bridge """
+        self.bridge.server_close()
+
+    def test_get(self):
+        """ The lights and groups can be read """
+        assert sorted(self.bridge.handle_api('GET', '/api/user/lights', b'')) == ['1', '2', '3']
+        light = self.bridge.handle_api('GET', '/api/user/lights/2', b'')
+        assert light['state']['on'] is False
+        assert self.bridge.handle_api('GET', '/api/user', b'')['groups']['1']['lights'] \
+            == ['1', '2', '3']
+        assert self.bridge.handle_api('GET', '/api/user/lights/9', b'')[0]['error']['type'] == 3
+        assert self.bridge.handle_api('GET', '/api/other/lights', b'')[0]['error']['type'] == 1
+        assert '0' not in self.bridge.handle_api('GET', '/api/user/groups', b'')
+        assert self.bridge.handle_api('GET', '/api/user/groups/9', b'')[0]['error']['type'] == 3
+
+    def test_group_zero(self):
+        """ Group 0 has all the lights and follows their state """
+        group = self.bridge.handle_api('GET', '/api/user/groups/0', b'')
+        assert group['lights'] == ['1', '2', '3']
+        assert group['state'] == {'all_on': False, 'any_on': False}
+        self.bridge.handle_api('PUT', '/api/user/lights/2/state', b'{"on":true}')
+        assert self.bridge.handle_api('GET', '/api/user/groups/0/state', b'') == \
+            {'all_on': False, 'any_on': True}
+        assert self.bridge.handle_api('POST', '/api/user/groups/0', b'')[0]['error']['type'] == 4
+
+    def test_state(self):
+        """ A light that is off only accepts being turned on """
+        results = self.bridge.handle_api('PUT', '/api/user/lights/1/state', b'{"xy":[0.3,0.3]}')
+        assert results[0]['error']['type'] == 201
+        results = self.bridge.handle_api('PUT', '/api/user/lights/1/state',
+                                         b'{"on":true,"xy":[0.3,0.3],"transitiontime":1}')
+        assert all('success' in result for result in results)
+        assert self.bridge.lights['1']['state']['xy'] == [0.3, 0.3]
+        assert [change.state for change in self.bridge.changes] == \
+            [{'on': True, 'xy': [0.3, 0.3], 'transitiontime': 1}]
+        assert self.bridge.handle_api('PUT', '/api/user/lights/1/state', b'{on')[0]['error'] \
+            ['type'] == 2
+
+    def test_group(self):
+        """ A group action changes all the lights in the group """
+        self.bridge.handle_api('PUT', '/api/user/groups/0/action', b'{"on":true,"bri":10}')
+        assert all(light['state']['bri'] == 10 for light in self.bridge.lights.values())
+        assert self.bridge.changes[0].address == '/groups/0/action'
+
+    def test_rate(self):
+        """ The requests over the rate are answered busy """
+        self.bridge = BridgeSimulator(('127.0.0.1', 0), 'user', rate=2)
+        results = [self.bridge.handle_api('GET', '/api/user/lights', b'') for _ in range(3)]
+        assert isinstance(results[1], dict)
+        assert results[2][0]['error']['type'] == 901
+        assert self.bridge.counters['busy'] == 1
+
+
+class TestUpdater():
+    """ Test the updater sending the frames to a simulated bridge """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Serve a bridge and start an updater with two of its lights """
+        self.bridge = BridgeSimulator(('127.0.0.1', 0), 'user', latency=0.005)
+        Thread(target=self.bridge.serve_forever, daemon=True).start()
+        address = BridgeAddress('127.0.0.1:{}'.format(self.bridge.server_address[1]), 'user')
+        self.lights = [HueLight(address=address, name='Left', hue_id='1'),
+                       HueLight(address=address, name='Right', hue_id='2')]
+        self.updater = LightsUpdater()
+        self.updater.set_rate(address, 50, 2)
+        for light in self.lights:
+            self.updater.add(light)
+        self.layer = FrameLayer('test')
+        self.updater.frames.add_layer(self.layer)
+        self.thread = Thread(target=self.updater.update_forever)
+        self.thread.start()
+
+    def teardown_method(self):
+        """ Stop the updater and the bridge """
+        self.updater.shutdown()
+        self.thread.join()
+        close_sessions()
+        self.bridge.shutdown()
+        self.bridge.server_close()
+
+    def send(self, *colors):
+        """ Send a frame with a color per light and sync """
+        slots = self.updater.registry.slots
+        for light, rgb in zip(self.lights, colors):
+            self.layer.set_color(slots[light], *rgb, received=monotonic())
+        self.layer.publish()
+        self.updater.update()
+
+    def wait_for(self, condition, timeout=2.0):
+        """ Wait until the condition is true """
+        deadline = monotonic() + timeout
+        while not condition():
+            if monotonic() > deadline:
+                return False
+            self.updater.exit_event.wait(0.01)
+        return True
+
+    def sent(self):
+        """ True when the bridge has the latest color of every light """
+        return all(self.bridge.lights[light.hue_id]['state']['xy'] == list(light.xy_new)
+                   and not light.pending for light in self.lights)
+
+    def test_frames(self):
+        """ The lights are turned on and sent each frame's colors """
+        assert self.wait_for(lambda: all(light.is_on for light in self.lights))
+        self.send((0.0, 0.0, 1.0), (0.0, 1.0, 0.0))
+        assert self.wait_for(self.sent)
+        assert self.lights[0].trace['total'].count == 1
+        assert self.bridge.lights['1']['state']['on'] is True
+        assert self.bridge.lights['3']['state']['on'] is False
+
+    def test_busy(self):
+        """ A busy bridge slows the updater down and the colors still arrive """
+        assert self.wait_for(lambda: all(light.is_on for light in self.lights))
+        self.bridge.bucket = TokenBucket(5, 1)
+        for step in range(10):
+            self.send((step / 10, 0.0, 1.0), (0.0, step / 10, 1.0))
+            self.updater.exit_event.wait(0.02)
+        assert self.wait_for(self.sent, 5)
+        assert self.bridge.counters.get('busy', 0) > 0
+        assert self.updater.workers[0].bucket.rate < 50
+
+    def test_missing_light(self):
+        """ A light that is not on the bridge does not stop the others being sent """
+        self.updater.shutdown()
+        self.thread.join()
+        address = self.lights[0].bridge
+        missing = HueLight(address=address, name='Top', hue_id='9')
+        self.lights = [HueLight(address=address, name='Left', hue_id='1'),
+                       HueLight(address=address, name='Right', hue_id='2')]
+        self.updater = LightsUpdater()
+        self.updater.set_rate(address, 50, 2)
+        for light in self.lights + [missing]:
+            self.updater.add(light)
+        self.updater.frames.add_layer(self.layer)
+        self.thread = Thread(target=self.updater.update_forever)
+        self.thread.start()
+        assert self.wait_for(lambda: all(light.is_on for light in self.lights))
+        assert not missing.in_use
+        self.send((0.0, 0.0, 1.0), (0.0, 1.0, 0.0))
+        assert self.wait_for(self.sent)
+        assert self.updater.workers[0].thread.is_alive()
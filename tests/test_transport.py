@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Test the pipelined transport
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import asyncio
+from time import sleep, monotonic
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from HueBobLightd.transport import PipelinedTransport, TransportTimeout, StaleRequest
+from HueBobLightd.transport import read_response, close_transport
+from HueBobLightd.huelights import HueLight, BridgeAddress
+from HueBobLightd.lightupdate import LightsUpdater, BridgeWorker
+
+
+class BridgeHandler(BaseHTTPRequestHandler):
+    """ Echoes the request path, after the server's delay """
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        """ Answer with the path and record the connection """
+        #pylint: disable=C0103
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.clients.add(self.client_address)
+        sleep(self.server.delay)
+        body = '[{{"success": {{"{}": true}}}}]'.format(self.path).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Keep the test output quiet """
+        #pylint: disable=W0622
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ A bridge that answers each connection in its own thread """
+    daemon_threads = True
+
+
+def test_chunked_response():
+    """ A chunked body is joined and the connection kept open """
+    loop = asyncio.new_event_loop()
+    reader = asyncio.StreamReader(loop=loop)
+    reader.feed_data(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                     b'4\r\n[{"s\r\n9\r\nuccess":1\r\n2\r\n}]\r\n0\r\n\r\n')
+    assert loop.run_until_complete(read_response(reader)) == \
+        (200, b'[{"success":1}]', False)
+    loop.close()
+
+
+class TestPipelinedTransport():
+    """ Test requests to a local bridge """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Start a bridge and the transport """
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BridgeHandler)
+        self.server.clients = set()
+        self.server.delay = 0.0
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.address = '127.0.0.1:{}'.format(self.server.server_address[1])
+        self.transport = PipelinedTransport()
+
+    def teardown_method(self):
+        """ Stop the transport and the bridge """
+        self.transport.close()
+        close_transport()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def put(self, results, index, timeout=1.0):
+        """ Send a request and keep the answer or exception """
+        try:
+            results[index] = self.transport.request(
+                self.address, b'PUT', '/api/user/lights/{}/state'.format(index).encode(),
+                b'{"on":true}', timeout)
+        except TransportTimeout as exc:
+            results[index] = exc
+
+    def test_pipelined(self):
+        """ Concurrent requests share the keep-alive connections """
+        results = dict()
+        threads = [Thread(target=self.put, args=(results, index)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for index in range(8):
+            status, body = results[index]
+            assert status == 200
+            assert '/lights/{}/state'.format(index).encode() in body
+        assert len(self.server.clients) <= self.transport.connections
+
+    def test_stale(self):
+        """ A request that cannot be sent before its deadline is dropped """
+        self.transport.connections = 1
+        self.transport.depth = 1
+        self.server.delay = 0.3
+        results = dict()
+        first = Thread(target=self.put, args=(results, 1, 0.2))
+        first.start()
+        sleep(0.05)
+        self.put(results, 2, 0.1)
+        first.join()
+        assert isinstance(results[1], TransportTimeout)
+        assert not isinstance(results[1], StaleRequest)
+        assert isinstance(results[2], StaleRequest)
+
+    def test_light(self):
+        """ A light on a pipelined bridge sends its state over the transport """
+        light = HueLight(address=BridgeAddress(self.address, 'user'), name='Left', hue_id='1',
+                         transport='pipelined')
+        assert light.transport is not None
+        assert light._put({'on': True})
+        assert light.error is None
+        self.server.delay = 1.5
+        assert not light._put({'on': False}, timeout=0.1)
+        assert light.error == 'timeout'
+
+    def test_worker(self):
+        """ A bridge worker has requests for several lights in flight at once """
+        self.server.delay = 0.2
+        bridge = BridgeAddress(self.address, 'user')
+        lights = [HueLight(address=bridge, name='Light', hue_id=str(hue_id),
+                           transport='pipelined') for hue_id in range(1, 5)]
+        worker = BridgeWorker(LightsUpdater(), bridge, lights, rate=20, burst=4)
+        assert worker.depth == PipelinedTransport.connections * PipelinedTransport.depth
+        for light in lights:
+            light.set_color(0.0, 0.0, 1.0)
+        start = monotonic()
+        assert worker.send(lights)
+        # One at a time the four requests would take 0.8s
+        assert monotonic() - start < 0.6
+        assert all(light.stats['puts'] == 1 and light.error is None for light in lights)
+        assert worker.latency.count == 4
+        assert not any(light.changed() for light in lights)
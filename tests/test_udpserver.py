@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Test the UDP frame server
+"""
+
+__author__ = "David Dix"
+__copyright__ = "Copyright 2017, David Dix"
+
+import socket
+from threading import Thread
+import pytest
+from HueBobLightd.udpserver import BobHueUdpServer, encode_frame, decode_frame, is_newer
+from HueBobLightd.huelights import HueLight, BridgeAddress
+from HueBobLightd.lightupdate import LightsUpdater
+
+
+def test_frame_round_trip():
+    """ Frames decode to what was encoded, in 8 and 16 bits """
+    colors = [(0, 1.0, 0.0, 0.5), (2, 0.25, 0.75, 0.0)]
+    sequence, decoded = decode_frame(encode_frame(7, colors, wide=True))
+    assert sequence == 7
+    assert decoded == [(slot, pytest.approx(r, abs=1e-4), pytest.approx(g, abs=1e-4),
+                        pytest.approx(b, abs=1e-4)) for slot, r, g, b in colors]
+    _, decoded = decode_frame(encode_frame(8, colors))
+    assert decoded[0] == (0, 1.0, 0.0, pytest.approx(0.5, abs=1 / 255))
+
+
+def test_bad_frames():
+    """ Short, foreign and truncated datagrams are rejected """
+    frame = encode_frame(1, [(0, 1.0, 1.0, 1.0)])
+    for data in (b'HB', b'XX' + frame[2:], frame[:-1]):
+        with pytest.raises(ValueError):
+            decode_frame(data)
+
+
+def test_sequence():
+    """ Sequence numbers are compared allowing for wrap around """
+    assert is_newer(0, None)
+    assert is_newer(2, 1)
+    assert not is_newer(1, 1)
+    assert not is_newer(1, 2)
+    assert is_newer(1, 0xFFFFFFFF)
+
+
+class TestUdpServer():
+    """ Test the BobHueUdpServer class """
+    #pylint: disable=W0201
+    def setup_method(self):
+        """ Start a UDP server on a free port with two lights """
+        self.updater = LightsUpdater()
+        bridge = BridgeAddress('127.0.0.1', 'test')
+        for hue_id in ('1', '2'):
+            self.updater.add(HueLight(address=bridge, name='Light', hue_id=hue_id))
+        self.server = BobHueUdpServer(('127.0.0.1', 0))
+        self.server.data = self.updater
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def teardown_method(self):
+        """ Stop the server """
+        self.client.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def send(self, sequence, colors):
+        """ Send a frame to the server """
+        self.client.sendto(encode_frame(sequence, colors), self.server.server_address)
+
+    def wait(self, count):
+        """ Wait for the server to have handled a number of datagrams """
+        for _ in range(200):
+            if sum(self.server.counters.values()) >= count:
+                return
+            self.updater.exit_event.wait(0.01)
+        raise AssertionError('Datagrams not handled')
+
+    def test_frames(self):
+        """ Frames set the light colors and late frames are dropped """
+        lights = self.updater.lights
+        self.send(10, [(0, 1.0, 0.0, 0.0), (1, 0.0, 1.0, 0.0), (5, 1.0, 1.0, 1.0)])
+        self.send(9, [(0, 0.0, 0.0, 1.0)])
+        self.wait(2)
+        self.updater.frames.composite(lights, self.updater.registry.slots)
+        assert lights[0].rgb == (1.0, 0.0, 0.0)
+        assert lights[1].rgb == (0.0, 1.0, 0.0)
+        assert self.server.counters['frames'] == 1
+        assert self.server.counters['dropped'] == 1